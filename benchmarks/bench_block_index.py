@@ -0,0 +1,40 @@
+import io
+import os
+import sys
+import time
+import argparse
+import contextlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'functions'))
+
+from textract_util import groupBlocksByType, extractTextBody
+from synthetic import generateBlocks
+
+#Function to time grouping and text extraction for one synthetic document
+def timeDocument(pages, linesPerPage, wordsPerLine):
+    blocks = generateBlocks(pages, linesPerPage, wordsPerLine)
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        index = groupBlocksByType(blocks)
+        document_text, total_line = extractTextBody(index)
+        elapsed = time.perf_counter() - start
+    return elapsed, total_line
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark block indexing and text extraction on synthetic documents')
+    parser.add_argument('--lines-per-page', type=int, default=50)
+    parser.add_argument('--words-per-line', type=int, default=0)
+    parser.add_argument('--pages', type=int, nargs='+', default=[250, 500, 1000, 2000, 4000])
+    args = parser.parse_args()
+
+    print("{:>8} {:>10} {:>10} {:>12}".format("Pages", "Lines", "Seconds", "us/Line"))
+    baseline = None
+    for pages in args.pages:
+        elapsed, total_line = timeDocument(pages, args.lines_per_page, args.words_per_line)
+        perLine = elapsed / total_line * 1e6
+        if baseline is None:
+            baseline = perLine
+        print("{:>8} {:>10} {:>10.3f} {:>12.2f}  (x{:.2f} of smallest)".format(pages, total_line, elapsed, perLine, perLine / baseline))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'functions'))
+
+import textract_util
+from textract_util import BlockIndex, readingOrder
+from synthetic import generateBlocks
+
+#Function to time the reading order of one synthetic page, checking it against the order it was laid out in
+def timePage(linesPerPage, columns, repeat):
+    index = BlockIndex(generateBlocks(1, linesPerPage, 0, columns=columns))
+    lines = index.pageLines(index.blocksOfType('PAGE')[0])
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        order = readingOrder(lines)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    expected = ['page 1 line {} of synthetic text'.format(n + 1) for n in range(len(lines))]
+    return best, [lines[i].text for i in order] == expected
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark geometry based reading order on synthetic multi-column pages')
+    parser.add_argument('--lines-per-page', type=int, nargs='+', default=[100, 1000, 5000])
+    parser.add_argument('--columns', type=int, nargs='+', default=[1, 2, 3])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    engines = [('numpy', textract_util.optionalNumpy()), ('python', False)]
+    print("{:>8} {:>8} {:>8} {:>10} {:>8}".format("Engine", "Lines", "Columns", "ms/Page", "Correct"))
+    for name, module in engines:
+        if module is None:
+            print("{:>8} numpy is not installed".format(name))
+            continue
+        textract_util.numpyModule = module
+        for linesPerPage in args.lines_per_page:
+            for columns in args.columns:
+                elapsed, correct = timePage(linesPerPage, columns, args.repeat)
+                print("{:>8} {:>8} {:>8} {:>10.2f} {:>8}".format(name, linesPerPage, columns, elapsed * 1000, 'yes' if correct else 'NO'))
+    textract_util.numpyModule = None
+
+if __name__ == '__main__':
+    main()
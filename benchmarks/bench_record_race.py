@@ -0,0 +1,130 @@
+import io
+import os
+import sys
+import json
+import argparse
+import threading
+import contextlib
+
+from bench_startup import ENVIRONMENT, loadHandler
+from fakes import FakeAWS, FakeContext
+from synthetic import generateBlocks
+
+#Offline check of the job records when the submit and post-process handlers write them at the same time.
+#Textract completes every job as soon as the submit handler starts the next one, so post-process records
+#the outcome of jobs while their submission is still running. The batch is then submitted again and the
+#completions delivered again, as S3 and SNS redeliver events, and every record must still hold its outcome
+#with each text file listed once. A checkpoint saved for a job must survive its resubmission.
+
+#Stand-in for Textract that runs post-process for the jobs already started whenever another one starts
+class CompletingTextract(object):
+
+    def __init__(self, textract, postprocess):
+        self.textract = textract
+        self.postprocess = postprocess
+        self.pending = []
+        self.lock = threading.Lock()
+        self.responses = []
+
+    def complete(self):
+        with self.lock:
+            pending, self.pending = self.pending, []
+        if len(pending) > 0:
+            event = {'Records': [self.textract.completionRecord(jobId) for jobId in pending]}
+            self.responses.append(self.postprocess.lambda_handler(event, FakeContext('postprocess')))
+
+    def start_document_text_detection(self, **kwargs):
+        self.complete()
+        response = self.textract.start_document_text_detection(**kwargs)
+        with self.lock:
+            if response['JobId'] not in self.pending:
+                self.pending.append(response['JobId'])
+        return response
+
+    def __getattr__(self, name):
+        return getattr(self.textract, name)
+
+#Function to return the problems found in the records of the completed jobs
+def checkRecords(records, jobIds):
+    problems = []
+    for jobId in jobIds:
+        item = records.get(jobId)
+        if item is None:
+            problems.append("{}: no record".format(jobId))
+            continue
+        textFiles = [textFile['S'] for textFile in item.get('TextFiles', {}).get('L', [])]
+        if item.get('JobStatus', {}).get('S') != 'SUCCEEDED':
+            problems.append("{}: JobStatus is {}".format(jobId, item.get('JobStatus')))
+        if float(item.get('JobCompleteTimeStamp', {}).get('N', '0')) == 0:
+            problems.append("{}: JobCompleteTimeStamp is not set".format(jobId))
+        if len(textFiles) == 0:
+            problems.append("{}: TextFiles is empty".format(jobId))
+        if len(textFiles) != len(set(textFiles)):
+            problems.append("{}: TextFiles lists {} files, {} distinct".format(jobId, len(textFiles), len(set(textFiles))))
+    return problems
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the job records written while jobs complete during their submission')
+    parser.add_argument('--documents', type=int, default=12)
+    parser.add_argument('--pages', type=int, default=3)
+    parser.add_argument('--unprocessed-rate', type=int, default=0, help='leave every Nth request of a batch write unprocessed, as a throttled table does')
+    parser.add_argument('--verbose', dest='quiet', action='store_false', help='show handler output')
+    args = parser.parse_args()
+
+    os.environ.update(ENVIRONMENT)
+    os.environ.update({'output_layout': 'pages', 'retry_base_delay': '0.01'})
+    blocks = generateBlocks(args.pages, 20, 5)
+    aws = FakeAWS(lambda bucket, key: blocks).install()
+    aws.dynamodb.unprocessedRate = args.unprocessed_rate
+    submit = loadHandler('submit')
+    postprocess = loadHandler('postprocess')
+    textract = CompletingTextract(aws.textract, postprocess)
+    import textract_util
+    textract_util.registerClient('textract', textract)
+
+    bucket = 'documentbucket'
+    documents = ['race/document-{:04d}.pdf'.format(i) for i in range(args.documents)]
+    for document in documents:
+        aws.s3.putBytes(bucket, document, '%PDF-1.4 {}'.format(document).encode())
+    event = {'Records': [aws.s3.createdRecord(bucket, document) for document in documents]}
+    table = aws.dynamodb.table(ENVIRONMENT['table_name'])
+
+    sink = io.StringIO() if args.quiet else sys.stdout
+    problems = []
+    with contextlib.redirect_stdout(sink):
+        submit.lambda_handler(event, FakeContext('submit'))
+        textract.complete()
+        jobIds = list(aws.textract.jobs.keys())
+        records = lambda: dict((item['JobId']['S'], item) for item in table.values())
+        problems.extend("Completed during submission: " + problem for problem in checkRecords(records(), jobIds))
+
+        #A checkpoint saved for a job still running is kept when its submission is delivered again
+        checkpointed = 'race/checkpointed.pdf'
+        aws.s3.putBytes(bucket, checkpointed, b'%PDF-1.4 checkpointed')
+        textract_util.registerClient('textract', aws.textract)
+        submit.lambda_handler({'Records': [aws.s3.createdRecord(bucket, checkpointed)]}, FakeContext('submit'))
+        checkpointJobId = [jobId for jobId in aws.textract.jobs.keys() if jobId not in jobIds][0]
+        aws.dynamodb.update_item(TableName=ENVIRONMENT['table_name'],
+                                 Key={'JobId': {'S': checkpointJobId}, 'JobType': {'S': 'TextDetection'}},
+                                 ExpressionAttributeNames={'#cp': 'Checkpoint'}, UpdateExpression='SET #cp = :checkpoint',
+                                 ExpressionAttributeValues={':checkpoint': {'S': json.dumps({'NextToken': '1', 'NumPages': 1, 'Pages': []})}})
+
+        #S3 and SNS deliver their events again
+        submit.lambda_handler(event, FakeContext('submit'))
+        submit.lambda_handler({'Records': [aws.s3.createdRecord(bucket, checkpointed)]}, FakeContext('submit'))
+        repeated = postprocess.lambda_handler({'Records': [aws.textract.completionRecord(jobId) for jobId in jobIds]},
+                                              FakeContext('postprocess'))
+
+    problems.extend("Delivered again: " + problem for problem in checkRecords(records(), jobIds))
+    if 'Checkpoint' not in records()[checkpointJobId]:
+        problems.append("Resubmitted: the checkpoint of {} was lost".format(checkpointJobId))
+    problems.extend("Delivered again: {JobId}: {Error}".format(**failure) for failure in repeated['Failures'])
+
+    print("{} jobs completed during submission in {} post-process invocations, {} problems".format(
+        len(jobIds), len(textract.responses), len(problems)))
+    for problem in problems:
+        print(problem)
+    return 1 if len(problems) > 0 else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,130 @@
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import importlib
+import contextlib
+import subprocess
+
+FUNCTIONS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'functions')
+sys.path.insert(0, FUNCTIONS)
+
+#Handler modules and the environment each one is deployed with in textract-api-stack.yml
+HANDLERS = {
+    'submit': 'textract-job-submit-async',
+    'postprocess': 'detect-text-postprocess-page',
+    'retrieval': 'detect-text-result-retrieval'
+}
+ENVIRONMENT = {
+    'table_name': 'TextractJobTable',
+    'role_name': 'LambdaTextractRole',
+    'role_arn': 'arn:aws:iam::123456789012:role/TextractSNSRole',
+    'text_detection_token_prefix': 'TextDetection',
+    'text_detection_topic_arn': 'arn:aws:sns:us-east-1:123456789012:TextDetectionTopic',
+    'max_retry_attempt': '3',
+    'max_results': '1000'
+}
+
+def loadHandler(name):
+    return importlib.import_module(HANDLERS[name])
+
+#Function to submit and post-process one document so that later handlers find a completed job
+def seedJob(aws, bucket, document):
+    submit = loadHandler('submit')
+    postprocess = loadHandler('postprocess')
+    aws.s3.putBytes(bucket, document, b'%PDF-1.4')
+    response = submit.lambda_handler({'Records': [aws.s3.createdRecord(bucket, document)]}, None)
+    return response.get('TextDetectionJobId') or list(aws.textract.jobs.keys())[-1], postprocess
+
+#Function to measure one handler inside a fresh interpreter and print the timings as JSON
+def child(name, pages, linesPerPage):
+    from fakes import FakeAWS
+    from synthetic import generateBlocks
+
+    os.environ.update(ENVIRONMENT)
+    bucket, document = 'documentbucket', 'bench/document.pdf'
+    timings = {'Handler': name}
+    sink = io.StringIO()
+    with contextlib.redirect_stdout(sink):
+        start = time.perf_counter()
+        handler = loadHandler(name)
+        timings['ImportSeconds'] = time.perf_counter() - start
+        timings['Boto3Imported'] = 'boto3' in sys.modules
+
+        aws = FakeAWS(lambda b, k: generateBlocks(pages, linesPerPage, 5)).install()
+        events = []
+        if name == 'submit':
+            for i in range(2):
+                key = "bench/document-{}.pdf".format(i)
+                aws.s3.putBytes(bucket, key, b'%PDF-1.4')
+                events.append({'Records': [aws.s3.createdRecord(bucket, key)]})
+        else:
+            jobId, postprocess = seedJob(aws, bucket, document)
+            if name == 'postprocess':
+                events = [{'Records': [aws.textract.completionRecord(jobId)]} for i in range(2)]
+            else:
+                postprocess.lambda_handler({'Records': [aws.textract.completionRecord(jobId)]}, None)
+                events = [{'DocumentBucket': bucket, 'DocumentKey': document} for i in range(2)]
+
+        for label, event in zip(('FirstCallSeconds', 'WarmCallSeconds'), events):
+            aws.calls.reset()
+            start = time.perf_counter()
+            handler.lambda_handler(event, None)
+            timings[label] = time.perf_counter() - start
+            timings[label.replace('Seconds', 'ApiCalls')] = sum(aws.calls.snapshot().values())
+    print(json.dumps(timings))
+
+#Function to time real boto3 client creation through the registry, when boto3 is installed
+def childClients():
+    timings = {'Handler': 'clients'}
+    start = time.perf_counter()
+    try:
+        import boto3
+    except ImportError:
+        print(json.dumps({'Handler': 'clients', 'Skipped': 'boto3 is not installed'}))
+        return
+    timings['ImportSeconds'] = time.perf_counter() - start
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    from textract_util import getClient, getResource
+    for label in ('FirstCallSeconds', 'WarmCallSeconds'):
+        start = time.perf_counter()
+        for service in ('s3', 'textract', 'dynamodb', 'iam'):
+            getClient(service)
+        getResource('dynamodb')
+        timings[label] = time.perf_counter() - start
+    print(json.dumps(timings))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark cold start and warm invocation latency of the Lambda handlers')
+    parser.add_argument('--pages', type=int, default=20)
+    parser.add_argument('--lines-per-page', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=3, help='fresh interpreters per handler')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child == 'clients':
+        childClients()
+        return
+    if args.child is not None:
+        child(args.child, args.pages, args.lines_per_page)
+        return
+
+    print("{:>12} {:>10} {:>12} {:>12} {:>10}".format("Handler", "Import ms", "First ms", "Warm ms", "boto3"))
+    for name in list(HANDLERS.keys()) + ['clients']:
+        runs = []
+        for i in range(args.repeat):
+            output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--child', name,
+                                              '--pages', str(args.pages), '--lines-per-page', str(args.lines_per_page)])
+            runs.append(json.loads(output.decode('utf-8').strip().splitlines()[-1]))
+        if 'Skipped' in runs[0]:
+            print("{:>12} {}".format(name, runs[0]['Skipped']))
+            continue
+        best = lambda field: min(run[field] for run in runs) * 1000
+        print("{:>12} {:>10.1f} {:>12.1f} {:>12.1f} {:>10}".format(
+            name, best('ImportSeconds'), best('FirstCallSeconds'), best('WarmCallSeconds'),
+            'loaded' if runs[0].get('Boto3Imported') else 'lazy'))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import platform
+import contextlib
+
+from bench_startup import ENVIRONMENT, loadHandler
+from fakes import FakeAWS, FakeContext
+from synthetic import generateBlocks
+
+#Offline benchmark of the three handlers against the in-process fakes. Each phase reports wall time,
+#the process peak RSS and the AWS API calls it made. A JSON report of an earlier run can be passed as
+#a baseline, and the run fails when a phase gets slower than the tolerance allows or makes more calls.
+
+#Function to return the peak resident set size of this process in MB
+def peakRSS():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #ru_maxrss is reported in bytes on macOS and in KB elsewhere
+    return peak / (1024.0 * 1024.0) if platform.system() == 'Darwin' else peak / 1024.0
+
+#Function to run one phase, returning its measurements and the handler responses
+def runPhase(aws, name, handler, events, quiet=True):
+    aws.calls.reset()
+    rssBefore = peakRSS()
+    responses = []
+    sink = io.StringIO() if quiet else sys.stdout
+    with contextlib.redirect_stdout(sink):
+        start = time.perf_counter()
+        for event in events:
+            responses.append(handler.lambda_handler(event, FakeContext(name)))
+        elapsed = time.perf_counter() - start
+    calls = aws.calls.snapshot()
+    return {
+        'Phase': name,
+        'Invocations': len(events),
+        'WallSeconds': elapsed,
+        'PeakRSSMB': peakRSS(),
+        'RSSGrowthMB': peakRSS() - rssBefore,
+        'ApiCalls': sum(calls.values()),
+        'Calls': calls
+    }, responses
+
+#Function to run the submit, post-process and retrieval phases over a set of synthetic documents
+def runSuite(args):
+    os.environ.update(ENVIRONMENT)
+    os.environ.update({
+        'max_results': str(args.max_results),
+        'result_mode': args.result_mode,
+        'output_layout': args.output_layout,
+        'output_compression': args.output_compression,
+        'reading_order': args.reading_order,
+        'word_export': args.word_export,
+        'start_tps': str(args.start_tps),
+        'retry_base_delay': '0.01'
+    })
+    #Every document shares one synthetic result so that generating it is not part of any phase
+    blocks = generateBlocks(args.pages, args.lines_per_page, args.words_per_line, columns=args.columns)
+    aws = FakeAWS(lambda bucket, key: blocks, validate=args.validate).install()
+    aws.dynamodb.unprocessedRate = args.unprocessed_rate
+    bucket = 'documentbucket'
+    documents = ["bench/document-{:04d}.{}".format(i, args.document_type) for i in range(args.documents)]
+    for document in documents:
+        aws.s3.putBytes(bucket, document, b'%PDF-1.4')
+
+    submit = loadHandler('submit')
+    postprocess = loadHandler('postprocess')
+    retrieval = loadHandler('retrieval')
+    phases = []
+
+    submitEvent = {'Records': [aws.s3.createdRecord(bucket, document) for document in documents]}
+    result, responses = runPhase(aws, 'submit', submit, [submitEvent], args.quiet)
+    phases.append(result)
+
+    completions = [aws.textract.completionRecord(jobId) for jobId in aws.textract.jobs.keys()]
+    batches = [{'Records': completions[i:i+args.sns_batch]} for i in range(0, len(completions), args.sns_batch)]
+    result, responses = runPhase(aws, 'postprocess', postprocess, batches, args.quiet)
+    failures = [failure for response in responses for failure in response.get('Failures', [])]
+    if len(failures) > 0:
+        raise RuntimeError("Post-processing failed: {}".format(failures[:3]))
+    phases.append(result)
+
+    events = [{'DocumentBucket': bucket, 'DocumentKey': document} for document in documents]
+    result, responses = runPhase(aws, 'retrieve', retrieval, events, args.quiet)
+    phases.append(result)
+
+    #Polling clients ask for the same documents again, which a warm container serves from its cache
+    result, responses = runPhase(aws, 'retrieve-again', retrieval, events, args.quiet)
+    phases.append(result)
+
+    if args.pages > 1:
+        events = [{'DocumentBucket': bucket, 'DocumentKey': document, 'Pages': '2', 'LineLimit': str(args.lines_per_page)} for document in documents]
+        result, responses = runPhase(aws, 'retrieve-page', retrieval, events, args.quiet)
+        phases.append(result)
+
+    #Searches read only the per-document indexes, one document at a time and across the whole prefix
+    events = [{'DocumentBucket': bucket, 'DocumentKey': document, 'Search': '"{}"'.format(blocks[1]['Text'])} for document in documents]
+    events.append({'DocumentBucket': bucket, 'DocumentKey': '', 'DocumentPrefix': 'bench/', 'Search': blocks[1]['Text']})
+    result, responses = runPhase(aws, 'search', retrieval, events, args.quiet)
+    phases.append(result)
+
+    return {
+        'Parameters': dict((k, v) for k, v in vars(args).items() if k not in ('json', 'baseline', 'tolerance', 'quiet')),
+        'Python': platform.python_version(),
+        'Phases': phases
+    }
+
+#Function to compare a report with a baseline report, returning the regressions found
+def compareReports(report, baseline, tolerance):
+    regressions = []
+    if report['Parameters'] != baseline['Parameters']:
+        return ["parameters differ from the baseline: {} against {}".format(report['Parameters'], baseline['Parameters'])]
+    baselinePhases = dict((phase['Phase'], phase) for phase in baseline['Phases'])
+    for phase in report['Phases']:
+        previous = baselinePhases.get(phase['Phase'])
+        if previous is None:
+            continue
+        if phase['WallSeconds'] > previous['WallSeconds'] * (1 + tolerance):
+            regressions.append("{}: {:.3f}s against {:.3f}s".format(phase['Phase'], phase['WallSeconds'], previous['WallSeconds']))
+        if phase['ApiCalls'] > previous['ApiCalls']:
+            regressions.append("{}: {} API calls against {}".format(phase['Phase'], phase['ApiCalls'], previous['ApiCalls']))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the Lambda handlers offline against in-process AWS fakes')
+    parser.add_argument('--documents', type=int, default=20)
+    parser.add_argument('--pages', type=int, default=20)
+    parser.add_argument('--lines-per-page', type=int, default=50)
+    parser.add_argument('--words-per-line', type=int, default=8)
+    parser.add_argument('--columns', type=int, default=1, help='text columns per page')
+    parser.add_argument('--document-type', default='pdf', choices=('pdf', 'png'), help='png documents are detected inline at submit')
+    parser.add_argument('--max-results', type=int, default=1000, help='blocks per GetDocumentTextDetection page')
+    parser.add_argument('--start-tps', type=float, default=1000, help='Textract start rate allowed to the submit handler')
+    parser.add_argument('--sns-batch', type=int, default=10, help='completion records per post-process invocation')
+    parser.add_argument('--result-mode', default='streaming', choices=('buffered', 'streaming'))
+    parser.add_argument('--output-layout', default='pages', choices=('document', 'pages'))
+    parser.add_argument('--output-compression', default='gzip', choices=('none', 'gzip'))
+    parser.add_argument('--reading-order', default='geometry', choices=('none', 'geometry'))
+    parser.add_argument('--word-export', default='none', choices=('none', 'columnar'), help='also write lines and words as columns')
+    parser.add_argument('--unprocessed-rate', type=int, default=0, help='leave every Nth request of a batch write unprocessed, as a throttled table does')
+    parser.add_argument('--validate', action='store_true', help='check fake Textract responses against the service model')
+    parser.add_argument('--json', help='write the report to this file')
+    parser.add_argument('--baseline', help='report of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed wall time growth over the baseline')
+    parser.add_argument('--verbose', dest='quiet', action='store_false', help='show handler output')
+    args = parser.parse_args()
+
+    report = runSuite(args)
+    print("{:>14} {:>6} {:>10} {:>10} {:>10} {:>9}".format("Phase", "Calls", "Seconds", "PeakRSS", "Growth", "APICalls"))
+    for phase in report['Phases']:
+        print("{:>14} {:>6} {:>10.3f} {:>8.1f}MB {:>8.1f}MB {:>9}".format(
+            phase['Phase'], phase['Invocations'], phase['WallSeconds'], phase['PeakRSSMB'], phase['RSSGrowthMB'], phase['ApiCalls']))
+        for call, count in sorted(phase['Calls'].items()):
+            print("{:>14} {:>46} {:>9}".format("", call, count))
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = compareReports(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("Regression - {}".format(regression))
+        if len(regressions) > 0:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
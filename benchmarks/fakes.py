@@ -0,0 +1,717 @@
+import io
+import re
+import copy
+import json
+import uuid
+import hashlib
+import threading
+from decimal import Decimal
+from email.utils import formatdate
+from urllib.parse import quote_plus
+
+from synthetic import generateBlocks, textDetectionResponse, validateShape
+
+#In-process stand-ins for the S3, Textract and DynamoDB APIs used by the Lambda functions. They keep
+#their state in memory, count every call per service and operation, and raise errors shaped like
+#botocore's ClientError so that the functions' error handling runs unchanged.
+
+#Error raised by the fakes, carrying the same response structure as botocore.exceptions.ClientError
+class ClientError(Exception):
+    def __init__(self, code, operation, message=None, status=400):
+        self.response = {'Error': {'Code': code, 'Message': message or code},
+                         'ResponseMetadata': {'HTTPStatusCode': status}}
+        self.operation_name = operation
+        super(ClientError, self).__init__("An error occurred ({}) when calling the {} operation: {}".format(
+            code, operation, message or code))
+
+#Thread safe counter of API calls, shared by all fakes of a harness. Failures can be injected
+#per operation to exercise the retry handling of the functions.
+class CallCounter(object):
+    def __init__(self):
+        self.counts = {}
+        self.failures = {}
+        self.lock = threading.Lock()
+
+    def count(self, service, operation):
+        with self.lock:
+            key = "{}.{}".format(service, operation)
+            self.counts[key] = self.counts.get(key, 0) + 1
+            failure = self.failures.get(key)
+            if failure is not None and failure[1] > 0:
+                self.failures[key] = (failure[0], failure[1] - 1)
+                raise ClientError(failure[0], operation, status=400 if 'Throttl' in failure[0] else 500)
+
+    #Function to make the next calls of an operation fail with the given error code
+    def failNext(self, service, operation, code='ThrottlingException', times=1):
+        with self.lock:
+            self.failures["{}.{}".format(service, operation)] = (code, times)
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counts)
+
+    def reset(self):
+        with self.lock:
+            self.counts.clear()
+
+def responseMetadata():
+    return {'RequestId': str(uuid.uuid4()), 'HTTPStatusCode': 200,
+            'HTTPHeaders': {'date': formatdate(usegmt=True)}}
+
+#Stand-in for the S3 client
+class FakeS3(object):
+    def __init__(self, calls=None):
+        self.calls = calls or CallCounter()
+        self.objects = {}
+        self.uploads = {}
+        self.lock = threading.Lock()
+
+    def putBytes(self, bucket, key, body, **meta):
+        if not isinstance(body, bytes):
+            body = body.read() if hasattr(body, 'read') else body.encode('utf-8')
+        etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+        with self.lock:
+            self.objects[(bucket, key)] = {'Body': body, 'ETag': etag, 'Meta': meta}
+        return etag
+
+    #Function to build the S3 event record of an object created with putBytes, its key URL-encoded as S3 does
+    def createdRecord(self, bucket, key):
+        obj = self.objects[(bucket, key)]
+        return {'s3': {'bucket': {'name': bucket}, 'object': {'key': quote_plus(key, safe='/'), 'size': len(obj['Body']), 'eTag': obj['ETag'].strip('"')}}}
+
+    def lookup(self, operation, bucket, key):
+        with self.lock:
+            obj = self.objects.get((bucket, key))
+        if obj is None:
+            raise ClientError('NoSuchKey', operation, 'The specified key does not exist.', 404)
+        return obj
+
+    def put_object(self, Bucket, Key, Body=b'', **meta):
+        self.calls.count('s3', 'PutObject')
+        return {'ETag': self.putBytes(Bucket, Key, Body, **meta), 'ResponseMetadata': responseMetadata()}
+
+    def get_object(self, Bucket, Key, Range=None, IfNoneMatch=None, **kwargs):
+        self.calls.count('s3', 'GetObject')
+        obj = self.lookup('GetObject', Bucket, Key)
+        if IfNoneMatch is not None and IfNoneMatch == obj['ETag']:
+            raise ClientError('304', 'GetObject', 'Not Modified', 304)
+        body = obj['Body']
+        if Range is not None:
+            start, end = Range[len('bytes='):].split('-')
+            body = body[int(start):int(end)+1]
+        response = {'Body': io.BytesIO(body), 'ContentLength': len(body), 'ETag': obj['ETag'],
+                    'ResponseMetadata': responseMetadata()}
+        response.update(obj['Meta'])
+        return response
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self.calls.count('s3', 'HeadObject')
+        obj = self.lookup('HeadObject', Bucket, Key)
+        response = {'ContentLength': len(obj['Body']), 'ETag': obj['ETag'], 'ResponseMetadata': responseMetadata()}
+        response.update(obj['Meta'])
+        return response
+
+    def upload_file(self, Filename, Bucket, Key, **kwargs):
+        self.calls.count('s3', 'UploadFile')
+        with open(Filename, 'rb') as f:
+            self.putBytes(Bucket, Key, f.read())
+
+    def list_objects_v2(self, Bucket, Prefix='', Delimiter=None, ContinuationToken=None, MaxKeys=1000, StartAfter='', **kwargs):
+        self.calls.count('s3', 'ListObjectsV2')
+        with self.lock:
+            keys = sorted(key for bucket, key in self.objects.keys() if bucket == Bucket and key.startswith(Prefix) and key > StartAfter)
+        if Delimiter is not None:
+            keys = [key for key in keys if Delimiter not in key[len(Prefix):]]
+        start = int(ContinuationToken or 0)
+        page = keys[start:start+MaxKeys]
+        response = {'KeyCount': len(page), 'IsTruncated': start + MaxKeys < len(keys), 'ResponseMetadata': responseMetadata()}
+        if len(page) > 0:
+            response['Contents'] = [{'Key': key, 'Size': len(self.objects[(Bucket, key)]['Body']),
+                                     'ETag': self.objects[(Bucket, key)]['ETag']} for key in page]
+        if response['IsTruncated']:
+            response['NextContinuationToken'] = str(start + MaxKeys)
+        return response
+
+    def create_multipart_upload(self, Bucket, Key, **meta):
+        self.calls.count('s3', 'CreateMultipartUpload')
+        uploadId = str(uuid.uuid4())
+        with self.lock:
+            self.uploads[uploadId] = {'Bucket': Bucket, 'Key': Key, 'Meta': meta, 'Parts': {}}
+        return {'UploadId': uploadId, 'ResponseMetadata': responseMetadata()}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        self.calls.count('s3', 'UploadPart')
+        body = Body if isinstance(Body, bytes) else Body.read()
+        with self.lock:
+            self.uploads[UploadId]['Parts'][PartNumber] = body
+        return {'ETag': '"{}"'.format(hashlib.md5(body).hexdigest()), 'ResponseMetadata': responseMetadata()}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        self.calls.count('s3', 'CompleteMultipartUpload')
+        with self.lock:
+            upload = self.uploads.pop(UploadId)
+        body = b''.join(upload['Parts'][part['PartNumber']] for part in MultipartUpload['Parts'])
+        return {'ETag': self.putBytes(Bucket, Key, body, **upload['Meta']), 'ResponseMetadata': responseMetadata()}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        self.calls.count('s3', 'AbortMultipartUpload')
+        with self.lock:
+            self.uploads.pop(UploadId, None)
+        return {'ResponseMetadata': responseMetadata()}
+
+#Stand-in for the Textract client. Documents are turned into synthetic blocks by documentFactory,
+#called with the bucket and key of the document, and async jobs complete immediately. With validate
+#set, every response is checked against the bundled service model.
+class FakeTextract(object):
+    def __init__(self, calls=None, documentFactory=None, validate=False):
+        self.calls = calls or CallCounter()
+        self.documentFactory = documentFactory or (lambda bucket, key: generateBlocks(2, 20, 5))
+        self.validate = validate
+        self.jobs = {}
+        self.tokens = {}
+        self.lock = threading.Lock()
+
+    def checkResponse(self, response, shapeName):
+        if self.validate:
+            errors = validateShape(dict((k, v) for k, v in response.items() if k != 'ResponseMetadata'), shapeName)
+            if len(errors) > 0:
+                raise AssertionError("{} does not match the service model: {}".format(shapeName, errors[:5]))
+        return response
+
+    def start_document_text_detection(self, DocumentLocation, ClientRequestToken=None, NotificationChannel=None, JobTag=None, **kwargs):
+        self.calls.count('textract', 'StartDocumentTextDetection')
+        with self.lock:
+            if ClientRequestToken is not None and ClientRequestToken in self.tokens:
+                return {'JobId': self.tokens[ClientRequestToken], 'ResponseMetadata': responseMetadata()}
+        s3Object = DocumentLocation['S3Object']
+        blocks = self.documentFactory(s3Object['Bucket'], s3Object['Name'])
+        jobId = uuid.uuid4().hex
+        with self.lock:
+            self.jobs[jobId] = {'Blocks': blocks, 'Bucket': s3Object['Bucket'], 'Name': s3Object['Name'], 'JobTag': JobTag,
+                                'Pages': sum(1 for block in blocks if block['BlockType'] == 'PAGE')}
+            if ClientRequestToken is not None:
+                self.tokens[ClientRequestToken] = jobId
+        return self.checkResponse({'JobId': jobId, 'ResponseMetadata': responseMetadata()}, 'StartDocumentTextDetectionResponse')
+
+    def get_document_text_detection(self, JobId, MaxResults=1000, NextToken=None, **kwargs):
+        self.calls.count('textract', 'GetDocumentTextDetection')
+        job = self.jobs.get(JobId)
+        if job is None:
+            raise ClientError('InvalidJobIdException', 'GetDocumentTextDetection')
+        response = textDetectionResponse(job['Blocks'], MaxResults, NextToken, job['Pages'])
+        response['ResponseMetadata'] = responseMetadata()
+        return self.checkResponse(response, 'GetDocumentTextDetectionResponse')
+
+    def detect_document_text(self, Document, **kwargs):
+        self.calls.count('textract', 'DetectDocumentText')
+        s3Object = Document['S3Object']
+        blocks = self.documentFactory(s3Object['Bucket'], s3Object['Name'])
+        pages = sum(1 for block in blocks if block['BlockType'] == 'PAGE')
+        response = {'DocumentMetadata': {'Pages': pages}, 'Blocks': blocks, 'ResponseMetadata': responseMetadata()}
+        return self.checkResponse(response, 'DetectDocumentTextResponse')
+
+    #Function to build the SNS record Textract publishes when a job completes
+    def completionRecord(self, jobId, timestamp=None):
+        job = self.jobs[jobId]
+        message = {
+            'JobId': jobId,
+            'Status': 'SUCCEEDED',
+            'API': 'StartDocumentTextDetection',
+            'JobTag': job['JobTag'],
+            'Timestamp': timestamp if timestamp is not None else 4102444800000,
+            'DocumentLocation': {'S3ObjectName': job['Name'], 'S3Bucket': job['Bucket']}
+        }
+        return {'EventSource': 'aws:sns', 'Sns': {'Message': json.dumps(message)}}
+
+#Conversion between DynamoDB attribute values and Python values, as done by the boto3 resource layer
+def serializeValue(value):
+    if isinstance(value, bool):
+        return {'BOOL': value}
+    if isinstance(value, (int, float, Decimal)):
+        return {'N': str(value)}
+    if isinstance(value, str):
+        return {'S': value}
+    if isinstance(value, (bytes, bytearray)):
+        return {'B': bytes(value)}
+    if value is None:
+        return {'NULL': True}
+    if isinstance(value, (list, tuple)):
+        return {'L': [serializeValue(v) for v in value]}
+    if isinstance(value, dict):
+        return {'M': dict((k, serializeValue(v)) for k, v in value.items())}
+    if isinstance(value, set):
+        if all(isinstance(v, str) for v in value):
+            return {'SS': sorted(value)}
+        return {'NS': sorted(str(v) for v in value)}
+    raise TypeError("Unsupported DynamoDB value {!r}".format(value))
+
+def deserializeValue(value):
+    kind, data = list(value.items())[0]
+    if kind == 'N':
+        return Decimal(data)
+    if kind == 'L':
+        return [deserializeValue(v) for v in data]
+    if kind == 'M':
+        return dict((k, deserializeValue(v)) for k, v in data.items())
+    if kind == 'SS':
+        return set(data)
+    if kind == 'NS':
+        return set(Decimal(v) for v in data)
+    if kind == 'NULL':
+        return None
+    return data
+
+#Minimal evaluator for the DynamoDB expression syntax used by the functions
+class Expression(object):
+    tokenPattern = re.compile(r'\s*(<>|<=|>=|[=<>(),+]|[#:]?[A-Za-z0-9_\-]+(?:\.#?[A-Za-z0-9_\-]+)*)')
+
+    def __init__(self, text, names, values):
+        self.tokens = self.tokenPattern.findall(text or '')
+        self.position = 0
+        self.names = names or {}
+        self.values = values or {}
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def take(self, expected=None):
+        token = self.peek()
+        if expected is not None and (token is None or token.lower() != expected):
+            raise ClientError('ValidationException', 'Expression', "Expected {} but found {}".format(expected, token))
+        self.position += 1
+        return token
+
+    #Function to resolve an attribute token, a document path such as #map.#key giving a tuple of names
+    def name(self, token):
+        if '.' in token:
+            return tuple(self.names.get(part, part) for part in token.split('.'))
+        return self.names.get(token, token)
+
+    #Parses an operand, returning a function of the item producing an attribute value or None
+    def operand(self):
+        token = self.take()
+        if token in ('if_not_exists', 'list_append', 'size'):
+            self.take('(')
+            first = self.operand()
+            second = None
+            if token != 'size':
+                self.take(',')
+                second = self.operand()
+            self.take(')')
+            if token == 'if_not_exists':
+                return lambda item: first(item) if first(item) is not None else second(item)
+            if token == 'size':
+                return lambda item: {'N': str(len(list(first(item).values())[0]))}
+            return lambda item: {'L': (first(item) or {'L': []})['L'] + (second(item) or {'L': []})['L']}
+        if token.startswith(':'):
+            value = self.values[token]
+            operand = lambda item: value
+        else:
+            attribute = self.name(token)
+            operand = lambda item: getPath(item, attribute)
+        if self.peek() in ('+', '-'):
+            sign = 1 if self.take() == '+' else -1
+            other = self.operand()
+            return lambda item: {'N': str(deserializeValue(operand(item)) + sign * deserializeValue(other(item)))}
+        return operand
+
+    def condition(self):
+        terms = [self.term()]
+        while self.peek() is not None and self.peek().lower() in ('and', 'or'):
+            joiner = self.take().lower()
+            terms.append((joiner, self.term()))
+        def evaluate(item):
+            result = terms[0](item)
+            for joiner, term in terms[1:]:
+                result = (result and term(item)) if joiner == 'and' else (result or term(item))
+            return result
+        return evaluate
+
+    def term(self):
+        token = self.peek()
+        if token is not None and token.lower() == 'not':
+            self.take()
+            inner = self.term()
+            return lambda item: not inner(item)
+        if token in ('attribute_exists', 'attribute_not_exists', 'begins_with', 'contains'):
+            self.take()
+            self.take('(')
+            attribute = self.name(self.take())
+            argument = None
+            if self.peek() == ',':
+                self.take(',')
+                argument = self.operand()
+            self.take(')')
+            if token == 'attribute_exists':
+                return lambda item: getPath(item, attribute) is not None
+            if token == 'attribute_not_exists':
+                return lambda item: getPath(item, attribute) is None
+            if token == 'begins_with':
+                return lambda item: getPath(item, attribute) is not None and deserializeValue(getPath(item, attribute)).startswith(deserializeValue(argument(item)))
+            return lambda item: getPath(item, attribute) is not None and deserializeValue(argument(item)) in deserializeValue(getPath(item, attribute))
+        left = self.operand()
+        comparator = self.take()
+        right = self.operand()
+        compare = {
+            '=': lambda a, b: a == b, '<>': lambda a, b: a != b,
+            '<': lambda a, b: a < b, '<=': lambda a, b: a <= b,
+            '>': lambda a, b: a > b, '>=': lambda a, b: a >= b
+        }[comparator]
+        def evaluate(item):
+            a, b = left(item), right(item)
+            return a is not None and b is not None and compare(deserializeValue(a), deserializeValue(b))
+        return evaluate
+
+    #Function to apply an update expression to an item in place
+    def update(self, item):
+        actions = []
+        while self.peek() is not None:
+            clause = self.take().upper()
+            while True:
+                attribute = self.name(self.take())
+                if clause == 'SET':
+                    self.take('=')
+                    actions.append((clause, attribute, self.operand()))
+                elif clause in ('ADD', 'DELETE'):
+                    actions.append((clause, attribute, self.operand()))
+                else:
+                    actions.append((clause, attribute, None))
+                if self.peek() != ',':
+                    break
+                self.take(',')
+        #Right hand sides see the item as it was before the update
+        original = copy.deepcopy(item)
+        for clause, attribute, operand in actions:
+            if clause == 'SET' and isinstance(attribute, tuple):
+                parent = getPath(item, attribute[:-1])
+                if parent is None or 'M' not in parent:
+                    raise ClientError('ValidationException', 'UpdateItem', 'The document path provided in the update expression is invalid for update')
+                parent['M'][attribute[-1]] = operand(original)
+            elif clause == 'SET':
+                item[attribute] = operand(original)
+            elif clause == 'REMOVE':
+                item.pop(attribute, None)
+            elif clause == 'ADD':
+                value = operand(original)
+                if 'N' in value:
+                    current = deserializeValue(item[attribute]) if attribute in item else 0
+                    item[attribute] = {'N': str(current + Decimal(value['N']))}
+                else:
+                    kind = list(value.keys())[0]
+                    current = set(item.get(attribute, {kind: []})[kind])
+                    item[attribute] = {kind: sorted(current | set(value[kind]))}
+            elif clause == 'DELETE':
+                value = operand(original)
+                kind = list(value.keys())[0]
+                remaining = sorted(set(item.get(attribute, {kind: []})[kind]) - set(value[kind]))
+                if len(remaining) > 0:
+                    item[attribute] = {kind: remaining}
+                else:
+                    item.pop(attribute, None)
+
+#Function to read an attribute, or a value inside nested maps for a tuple of names, None when it is missing
+def getPath(item, attribute):
+    if not isinstance(attribute, tuple):
+        return item.get(attribute)
+    value = item.get(attribute[0])
+    for name in attribute[1:]:
+        if value is None or 'M' not in value:
+            return None
+        value = value['M'].get(name)
+    return value
+
+#Stand-in for the DynamoDB client, holding tables keyed by JobId and JobType with the stack's indexes
+class FakeDynamoDB(object):
+    keySchema = ('JobId', 'JobType')
+    indexes = {
+        'DocumentIndex': ('DocumentBucket', 'DocumentPath'),
+        'ContentIndex': ('ContentId', 'JobStartTimeStamp')
+    }
+    #Attributes projected by an index besides the keys
+    indexAttributes = {
+        'ContentIndex': ('JobStatus',)
+    }
+
+    def __init__(self, calls=None):
+        self.calls = calls or CallCounter()
+        self.tables = {}
+        self.lock = threading.RLock()
+        self.unprocessedRate = 0
+
+    def table(self, name):
+        return self.tables.setdefault(name, {})
+
+    def itemKey(self, key):
+        return tuple(deserializeValue(key[attribute]) for attribute in self.keySchema)
+
+    def checkCondition(self, operation, item, kwargs):
+        if 'ConditionExpression' in kwargs:
+            condition = Expression(kwargs['ConditionExpression'], kwargs.get('ExpressionAttributeNames'),
+                                   kwargs.get('ExpressionAttributeValues')).condition()
+            if not condition(item):
+                raise ClientError('ConditionalCheckFailedException', operation, 'The conditional request failed')
+
+    def get_item(self, TableName, Key, **kwargs):
+        self.calls.count('dynamodb', 'GetItem')
+        with self.lock:
+            item = self.table(TableName).get(self.itemKey(Key))
+            response = {'ResponseMetadata': responseMetadata()}
+            if item is not None:
+                response['Item'] = copy.deepcopy(item)
+            return response
+
+    def put_item(self, TableName, Item, **kwargs):
+        self.calls.count('dynamodb', 'PutItem')
+        with self.lock:
+            key = self.itemKey(Item)
+            self.checkCondition('PutItem', self.table(TableName).get(key, {}), kwargs)
+            self.table(TableName)[key] = copy.deepcopy(Item)
+            return {'ResponseMetadata': responseMetadata()}
+
+    def delete_item(self, TableName, Key, **kwargs):
+        self.calls.count('dynamodb', 'DeleteItem')
+        with self.lock:
+            key = self.itemKey(Key)
+            self.checkCondition('DeleteItem', self.table(TableName).get(key, {}), kwargs)
+            self.table(TableName).pop(key, None)
+            return {'ResponseMetadata': responseMetadata()}
+
+    def update_item(self, TableName, Key, ReturnValues='NONE', **kwargs):
+        self.calls.count('dynamodb', 'UpdateItem')
+        with self.lock:
+            table = self.table(TableName)
+            key = self.itemKey(Key)
+            existing = table.get(key)
+            item = copy.deepcopy(existing) if existing is not None else copy.deepcopy(Key)
+            self.checkCondition('UpdateItem', existing or {}, kwargs)
+            if 'UpdateExpression' in kwargs:
+                Expression(kwargs['UpdateExpression'], kwargs.get('ExpressionAttributeNames'),
+                           kwargs.get('ExpressionAttributeValues')).update(item)
+            for attribute, update in kwargs.get('AttributeUpdates', {}).items():
+                if update.get('Action', 'PUT') == 'DELETE':
+                    item.pop(attribute, None)
+                else:
+                    item[attribute] = update['Value']
+            table[key] = item
+            response = {'ResponseMetadata': responseMetadata()}
+            changed = [attribute for attribute in item.keys() if existing is None or existing.get(attribute) != item[attribute] or attribute in kwargs.get('ExpressionAttributeNames', {}).values()]
+            if ReturnValues == 'ALL_NEW':
+                response['Attributes'] = copy.deepcopy(item)
+            elif ReturnValues == 'ALL_OLD' and existing is not None:
+                response['Attributes'] = copy.deepcopy(existing)
+            elif ReturnValues == 'UPDATED_NEW':
+                response['Attributes'] = dict((a, copy.deepcopy(item[a])) for a in changed if a not in self.keySchema)
+            elif ReturnValues == 'UPDATED_OLD' and existing is not None:
+                response['Attributes'] = dict((a, copy.deepcopy(existing[a])) for a in changed if a in existing and a not in self.keySchema)
+            return response
+
+    def query(self, TableName, KeyConditionExpression, IndexName=None, FilterExpression=None, ScanIndexForward=True,
+              Limit=None, ExclusiveStartKey=None, **kwargs):
+        self.calls.count('dynamodb', 'Query')
+        names = kwargs.get('ExpressionAttributeNames')
+        values = kwargs.get('ExpressionAttributeValues')
+        keyCondition = Expression(KeyConditionExpression, names, values).condition()
+        keys = self.indexes[IndexName] if IndexName is not None else self.keySchema
+        with self.lock:
+            items = [item for item in self.table(TableName).values() if all(k in item for k in keys) and keyCondition(item)]
+            items.sort(key=lambda item: deserializeValue(item[keys[1]]), reverse=not ScanIndexForward)
+            if IndexName is not None:
+                projected = set(keys + self.keySchema + self.indexAttributes.get(IndexName, ()))
+                items = [dict((k, item[k]) for k in projected if k in item) for item in items]
+            return self.page(items, FilterExpression, names, values, Limit, ExclusiveStartKey, keys)
+
+    def scan(self, TableName, FilterExpression=None, Limit=None, ExclusiveStartKey=None, Segment=0, TotalSegments=1, **kwargs):
+        self.calls.count('dynamodb', 'Scan')
+        with self.lock:
+            #Items are spread over the segments of a parallel scan by their position in the table
+            items = list(self.table(TableName).values())[Segment::TotalSegments]
+            return self.page(items, FilterExpression, kwargs.get('ExpressionAttributeNames'),
+                             kwargs.get('ExpressionAttributeValues'), Limit, ExclusiveStartKey, self.keySchema)
+
+    def page(self, items, filterExpression, names, values, limit, exclusiveStartKey, keys):
+        start = 0
+        if exclusiveStartKey is not None:
+            start = int(deserializeValue(exclusiveStartKey['Position']))
+        evaluated = items[start:start+limit] if limit is not None else items[start:]
+        matched = evaluated
+        if filterExpression is not None:
+            condition = Expression(filterExpression, names, values).condition()
+            matched = [item for item in evaluated if condition(item)]
+        response = {'Items': copy.deepcopy(matched), 'Count': len(matched), 'ScannedCount': len(evaluated),
+                    'ResponseMetadata': responseMetadata()}
+        if start + len(evaluated) < len(items):
+            response['LastEvaluatedKey'] = {'Position': {'N': str(start + len(evaluated))}}
+        return response
+
+    def batch_get_item(self, RequestItems, **kwargs):
+        self.calls.count('dynamodb', 'BatchGetItem')
+        responses = {}
+        with self.lock:
+            for tableName, request in RequestItems.items():
+                responses[tableName] = []
+                for key in request['Keys']:
+                    item = self.table(tableName).get(self.itemKey(key))
+                    if item is not None:
+                        responses[tableName].append(copy.deepcopy(item))
+        return {'Responses': responses, 'UnprocessedKeys': {}, 'ResponseMetadata': responseMetadata()}
+
+    def batch_write_item(self, RequestItems, **kwargs):
+        self.calls.count('dynamodb', 'BatchWriteItem')
+        unprocessed = {}
+        with self.lock:
+            for tableName, requests in RequestItems.items():
+                for i, request in enumerate(requests):
+                    #Optionally leave some writes unprocessed, as a throttled table would
+                    if self.unprocessedRate > 0 and i % self.unprocessedRate == 0 and len(requests) > 1:
+                        unprocessed.setdefault(tableName, []).append(request)
+                        continue
+                    if 'PutRequest' in request:
+                        item = request['PutRequest']['Item']
+                        self.table(tableName)[self.itemKey(item)] = copy.deepcopy(item)
+                    else:
+                        self.table(tableName).pop(self.itemKey(request['DeleteRequest']['Key']), None)
+        return {'UnprocessedItems': unprocessed, 'ResponseMetadata': responseMetadata()}
+
+#Stand-in for a boto3 DynamoDB Table resource, converting between Python and attribute values
+class FakeTable(object):
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def serializeArgs(self, kwargs):
+        kwargs = dict(kwargs)
+        for argument in ('Key', 'Item', 'ExclusiveStartKey'):
+            if argument in kwargs:
+                kwargs[argument] = dict((k, serializeValue(v)) for k, v in kwargs[argument].items())
+        if 'ExpressionAttributeValues' in kwargs:
+            kwargs['ExpressionAttributeValues'] = dict((k, serializeValue(v)) for k, v in kwargs['ExpressionAttributeValues'].items())
+        return kwargs
+
+    def deserializeResponse(self, response):
+        for argument in ('Item', 'Attributes', 'LastEvaluatedKey'):
+            if argument in response:
+                response[argument] = dict((k, deserializeValue(v)) for k, v in response[argument].items())
+        if 'Items' in response:
+            response['Items'] = [dict((k, deserializeValue(v)) for k, v in item.items()) for item in response['Items']]
+        return response
+
+    def get_item(self, **kwargs):
+        return self.deserializeResponse(self.client.get_item(TableName=self.name, **self.serializeArgs(kwargs)))
+
+    def put_item(self, **kwargs):
+        return self.deserializeResponse(self.client.put_item(TableName=self.name, **self.serializeArgs(kwargs)))
+
+    def update_item(self, **kwargs):
+        return self.deserializeResponse(self.client.update_item(TableName=self.name, **self.serializeArgs(kwargs)))
+
+    def query(self, **kwargs):
+        return self.deserializeResponse(self.client.query(TableName=self.name, **self.serializeArgs(kwargs)))
+
+    def scan(self, **kwargs):
+        return self.deserializeResponse(self.client.scan(TableName=self.name, **self.serializeArgs(kwargs)))
+
+#Stand-in for the boto3 DynamoDB service resource
+class FakeDynamoDBResource(object):
+    def __init__(self, client):
+        self.client = client
+
+    def Table(self, name):
+        return FakeTable(self.client, name)
+
+#Stand-in for the IAM client, only tracking policies and their attachments
+class FakeIAM(object):
+    def __init__(self, calls=None, accountId='123456789012'):
+        self.calls = calls or CallCounter()
+        self.accountId = accountId
+        self.policies = {}
+        self.attached = {}
+
+    def policyArn(self, name):
+        return "arn:aws:iam::{}:policy/{}".format(self.accountId, name)
+
+    def list_policies(self, MaxItems=100, **kwargs):
+        self.calls.count('iam', 'ListPolicies')
+        return {'Policies': [{'PolicyName': name, 'Arn': arn} for name, arn in self.policies.items()][:MaxItems]}
+
+    def get_policy(self, PolicyArn):
+        self.calls.count('iam', 'GetPolicy')
+        for name, arn in self.policies.items():
+            if arn == PolicyArn:
+                return {'Policy': {'PolicyName': name, 'Arn': arn}}
+        raise ClientError('NoSuchEntity', 'GetPolicy', 'Policy {} was not found.'.format(PolicyArn), 404)
+
+    def create_policy(self, PolicyName, PolicyDocument, Description=None, **kwargs):
+        self.calls.count('iam', 'CreatePolicy')
+        if PolicyName in self.policies:
+            raise ClientError('EntityAlreadyExists', 'CreatePolicy', 'A policy called {} already exists.'.format(PolicyName), 409)
+        self.policies[PolicyName] = self.policyArn(PolicyName)
+        return {'Policy': {'PolicyName': PolicyName, 'Arn': self.policies[PolicyName]}}
+
+    def list_attached_role_policies(self, RoleName, MaxItems=100, **kwargs):
+        self.calls.count('iam', 'ListAttachedRolePolicies')
+        attached = [{'PolicyArn': arn, 'PolicyName': arn[arn.rfind('/')+1:]} for arn in self.attached.get(RoleName, [])]
+        return {'AttachedPolicies': attached[:MaxItems], 'IsTruncated': False}
+
+    def attach_role_policy(self, RoleName, PolicyArn):
+        self.calls.count('iam', 'AttachRolePolicy')
+        if PolicyArn not in self.policies.values():
+            raise ClientError('NoSuchEntity', 'AttachRolePolicy', 'Policy {} does not exist.'.format(PolicyArn), 404)
+        if PolicyArn not in self.attached.setdefault(RoleName, []):
+            self.attached[RoleName].append(PolicyArn)
+        return {}
+
+    def detach_role_policy(self, RoleName, PolicyArn):
+        self.calls.count('iam', 'DetachRolePolicy')
+        self.attached.get(RoleName, []).remove(PolicyArn)
+        return {}
+
+    def delete_policy(self, PolicyArn):
+        self.calls.count('iam', 'DeletePolicy')
+        self.policies = dict((name, arn) for name, arn in self.policies.items() if arn != PolicyArn)
+        return {}
+
+#Set of fakes sharing one call counter, registered in place of the real AWS clients
+class FakeAWS(object):
+    def __init__(self, documentFactory=None, validate=False):
+        self.calls = CallCounter()
+        self.s3 = FakeS3(self.calls)
+        self.textract = FakeTextract(self.calls, documentFactory, validate)
+        self.dynamodb = FakeDynamoDB(self.calls)
+        self.iam = FakeIAM(self.calls)
+        self.lambdaClient = FakeLambda(self.calls)
+
+    #Function to register the fakes with the textract_util client registry
+    def install(self):
+        import textract_util
+        textract_util.resetClients()
+        textract_util.registerClient('s3', self.s3)
+        textract_util.registerClient('textract', self.textract)
+        textract_util.registerClient('dynamodb', self.dynamodb)
+        textract_util.registerClient('dynamodb', FakeDynamoDBResource(self.dynamodb), 'resource')
+        textract_util.registerClient('iam', self.iam)
+        textract_util.registerClient('lambda', self.lambdaClient)
+        return self
+
+#Stand-in for the Lambda client, keeping asynchronous invocations for the caller to run
+class FakeLambda(object):
+    def __init__(self, calls=None):
+        self.calls = calls or CallCounter()
+        self.invocations = []
+
+    def invoke(self, FunctionName, InvocationType='RequestResponse', Payload=b'', **kwargs):
+        self.calls.count('lambda', 'Invoke')
+        self.invocations.append((FunctionName, json.loads(Payload)))
+        return {'StatusCode': 202 if InvocationType == 'Event' else 200, 'ResponseMetadata': responseMetadata()}
+
+#Stand-in for the Lambda context object
+class FakeContext(object):
+    def __init__(self, functionName='benchmark', timeoutSeconds=900):
+        import time
+        self.function_name = functionName
+        self.invoked_function_arn = "arn:aws:lambda:us-east-1:123456789012:function:{}".format(functionName)
+        self.aws_request_id = str(uuid.uuid4())
+        self.deadline = time.time() + timeoutSeconds
+
+    def get_remaining_time_in_millis(self):
+        import time
+        return int(max(self.deadline - time.time(), 0) * 1000)
@@ -0,0 +1,157 @@
+import os
+import re
+import json
+import uuid
+import random
+
+#Textract service model bundled with the functions, used to shape and check the synthetic responses
+MODEL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'functions', 'models', 'textract', '2019-01-03', 'service-2.json')
+MAX_RESULTS_LIMIT = 1000
+modelShapes = None
+
+#Function to load the shapes of the Textract service model once
+def loadShapes():
+    global modelShapes
+    if modelShapes is None:
+        with open(MODEL_PATH) as f:
+            modelShapes = json.load(f)['shapes']
+    return modelShapes
+
+#Function to check a value against a shape of the service model, returning a list of violations
+def validateShape(value, shapeName, path=None):
+    shapes = loadShapes()
+    shape = shapes[shapeName]
+    path = path or shapeName
+    errors = []
+    kind = shape['type']
+    if kind == 'structure':
+        if not isinstance(value, dict):
+            return ["{}: expected a structure".format(path)]
+        for member in shape.get('required', []):
+            if member not in value:
+                errors.append("{}: missing required member {}".format(path, member))
+        for member, memberValue in value.items():
+            if member not in shape['members']:
+                errors.append("{}: unknown member {}".format(path, member))
+            else:
+                errors.extend(validateShape(memberValue, shape['members'][member]['shape'], "{}.{}".format(path, member)))
+    elif kind == 'list':
+        if not isinstance(value, list):
+            return ["{}: expected a list".format(path)]
+        for i, item in enumerate(value):
+            errors.extend(validateShape(item, shape['member']['shape'], "{}[{}]".format(path, i)))
+    elif kind == 'string':
+        if not isinstance(value, str):
+            return ["{}: expected a string".format(path)]
+        if 'enum' in shape and value not in shape['enum']:
+            errors.append("{}: {} is not one of {}".format(path, value, shape['enum']))
+        if 'pattern' in shape and re.match(shape['pattern'], value) is None:
+            errors.append("{}: {} does not match {}".format(path, value, shape['pattern']))
+        if len(value) < shape.get('min', 0) or len(value) > shape.get('max', len(value)):
+            errors.append("{}: length {} out of range".format(path, len(value)))
+    elif kind in ('integer', 'long', 'float', 'double'):
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or (kind in ('integer', 'long') and not isinstance(value, int)):
+            return ["{}: expected {}".format(path, kind)]
+        if value < shape.get('min', value) or value > shape.get('max', value):
+            errors.append("{}: {} out of range".format(path, value))
+    elif kind == 'boolean' and not isinstance(value, bool):
+        errors.append("{}: expected a boolean".format(path))
+    return errors
+
+#Function to build a Textract Geometry structure for an axis aligned box
+def makeGeometry(left, top, width, height):
+    return {
+        'BoundingBox': {'Width': width, 'Height': height, 'Left': left, 'Top': top},
+        'Polygon': [
+            {'X': left, 'Y': top},
+            {'X': left + width, 'Y': top},
+            {'X': left + width, 'Y': top + height},
+            {'X': left, 'Y': top + height}
+        ]
+    }
+
+#Function to place the lines of a page as (left, top, width, height) boxes, in reading order. Pages
+#with several columns start with a heading spanning all of them, and each column is filled in turn.
+def lineLayout(linesPerPage, columns=1):
+    if columns <= 1:
+        lineHeight = 0.9 / max(linesPerPage, 1)
+        return [(0.1, 0.05 + lineNumber * lineHeight, 0.8, lineHeight * 0.8) for lineNumber in range(linesPerPage)]
+    rows = -(-(linesPerPage - 1) // columns)
+    lineHeight = 0.85 / max(rows, 1)
+    columnWidth = 0.8 / columns
+    boxes = [(0.1, 0.03, 0.8, 0.04)]
+    for lineNumber in range(linesPerPage - 1):
+        column, row = divmod(lineNumber, rows)
+        boxes.append((0.1 + column * columnWidth, 0.1 + row * lineHeight, columnWidth * 0.9, lineHeight * 0.8))
+    return boxes[:linesPerPage]
+
+#Function to generate the blocks of a synthetic text detection result, page by page. Blocks only
+#carry the members the bundled service model defines, and the same seed gives the same document.
+#With several columns the PAGE block lists its lines row by row across the columns, the way Textract
+#often does, while line numbers in the text follow the reading order.
+def generateBlocks(pages, linesPerPage, wordsPerLine=0, seed=0, columns=1):
+    rng = random.Random(seed)
+    newId = lambda: str(uuid.UUID(int=rng.getrandbits(128), version=4))
+    blockMembers = loadShapes()['Block']['members']
+    blocks = []
+    boxes = lineLayout(linesPerPage, columns)
+    for pageNumber in range(1, pages + 1):
+        page = {
+            'BlockType': 'PAGE',
+            'Geometry': makeGeometry(0.0, 0.0, 1.0, 1.0),
+            'Id': newId(),
+            'Relationships': [{'Type': 'CHILD', 'Ids': []}],
+            'Page': pageNumber
+        }
+        blocks.append(page)
+        placed = []
+        for lineNumber, (left, top, width, height) in enumerate(boxes):
+            words = ['word{}'.format(rng.randint(1, 5000)) for wordNumber in range(wordsPerLine)]
+            line = {
+                'BlockType': 'LINE',
+                'Confidence': round(rng.uniform(90.0, 100.0), 4),
+                'Text': ' '.join(words) if wordsPerLine > 0 else 'page {} line {} of synthetic text'.format(pageNumber, lineNumber + 1),
+                'Geometry': makeGeometry(left, top, width, height),
+                'Id': newId(),
+                'Relationships': [{'Type': 'CHILD', 'Ids': []}],
+                'Page': pageNumber
+            }
+            placed.append((top, left, line['Id']))
+            blocks.append(line)
+            wordWidth = width / max(wordsPerLine, 1)
+            for wordNumber, text in enumerate(words):
+                word = {
+                    'BlockType': 'WORD',
+                    'Confidence': round(rng.uniform(85.0, 100.0), 4),
+                    'Text': text,
+                    'TextType': 'PRINTED',
+                    'Geometry': makeGeometry(left + wordNumber * wordWidth, top, wordWidth * 0.9, height),
+                    'Id': newId(),
+                    'Page': pageNumber
+                }
+                if 'TextType' not in blockMembers:
+                    del word['TextType']
+                line['Relationships'][0]['Ids'].append(word['Id'])
+                blocks.append(word)
+        if columns > 1:
+            placed.sort()
+        page['Relationships'][0]['Ids'] = [lineId for top, left, lineId in placed]
+        if len(page['Relationships'][0]['Ids']) == 0:
+            del page['Relationships']
+    return blocks
+
+#Function to build one GetDocumentTextDetection response over the blocks of a job, paginated the way
+#Textract does: at most MaxResults blocks, capped at 1000, and a NextToken while blocks remain
+def textDetectionResponse(blocks, maxResults=MAX_RESULTS_LIMIT, nextToken=None, numPages=None):
+    maxResults = min(max(int(maxResults), 1), MAX_RESULTS_LIMIT)
+    start = int(nextToken) if nextToken is not None else 0
+    if numPages is None:
+        numPages = sum(1 for block in blocks if block['BlockType'] == 'PAGE')
+    response = {
+        'DocumentMetadata': {'Pages': numPages},
+        'JobStatus': 'SUCCEEDED',
+        'Blocks': blocks[start:start+maxResults]
+    }
+    if start + maxResults < len(blocks):
+        response['NextToken'] = str(start + maxResults)
+    return response
@@ -1,137 +1,368 @@
 from textract_util import *
-import io
 import os
 import json
 import time
-import boto3
+from concurrent.futures import ThreadPoolExecutor
+
+#Raised when a record stops at a checkpoint because the invocation is about to time out
+class JobContinued(Exception):
+    pass
+
+#Raised once the whole batch is processed when some of its records failed, so that Lambda retries the event.
+#SNS invokes the function asynchronously and drops its response, a failure only returned would be lost.
+class RecordsFailed(Exception):
+    def __init__(self, failures):
+        super(RecordsFailed, self).__init__("{} records failed: {}".format(len(failures), failures))
+        self.failures = failures
+
+#Function to read the progress saved for a job by an earlier invocation, None when there is none
+def loadCheckpoint(dynamodb, table_name, jobId):
+    response = callWithRetry(dynamodb.get_item,
+        TableName=table_name,
+        Key={
+            'JobId':{'S':jobId},
+            'JobType':{'S':'TextDetection'}
+        },
+        ProjectionExpression='#cp',
+        ExpressionAttributeNames={"#cp": "Checkpoint"},
+        ConsistentRead=True
+    )
+    if 'Checkpoint' not in response.get('Item', {}):
+        return None
+    return json.loads(response['Item']['Checkpoint']['S'])
+
+#Function to save the progress of a job: the NextToken to resume reading from, and the pages written so far
+#with their line counts and sizes
+def saveCheckpoint(dynamodb, table_name, jobId, nextToken, writer, num_pages):
+    checkpoint = {'NextToken': nextToken, 'NumPages': num_pages, 'Pages': writer.checkpoint()}
+    with getMetrics().timer('Checkpoint'):
+        callWithRetry(dynamodb.update_item,
+            TableName=table_name,
+            Key={
+                'JobId':{'S':jobId},
+                'JobType':{'S':'TextDetection'}
+            },
+            ExpressionAttributeNames={"#cp": "Checkpoint"},
+            UpdateExpression='SET #cp = :checkpoint',
+            ExpressionAttributeValues={":checkpoint": {"S": json.dumps(checkpoint, separators=(',', ':'))}}
+        )
+    logger.info("Checkpoint of job %s saved with %d pages written", jobId, len(checkpoint['Pages']))
+
+#Function to write the parent output of a split document from the pages its chunks wrote: the manifest
+#and, with search_index set, the index, which reads the pages back for their terms. Returns the objects
+#the merge wrote itself.
+def mergeChunks(jobState, s3, parent, textractTimestamp, bucket, compress, search_index, words, ioExecutor):
+    pages = []
+    num_pages = 0
+    for chunk in parent['ChunkPages']['M'].values():
+        chunk = json.loads(chunk['S'])
+        pages.extend(chunk['Pages'])
+        num_pages += chunk['NumPages']
+    writer = DocumentWriter(s3, bucket, parent['UploadPrefix']['S'], parent['DocumentName']['S'], 'pages', ioExecutor,
+                            compress=compress, index=search_index, words=words)
+    writer.resume(pages)
+    with getMetrics().timer('Merge'):
+        text_files, manifest_file = writer.close()
+        outputs = writer.outputFiles()
+    completeJob(jobState, parent['JobId']['S'], 'SUCCEEDED', textractTimestamp, bucket, num_pages, writer.numLines,
+                writer, text_files, manifest_file, outputs)
+    logger.info("%d chunks of job %s merged into %d pages", len(parent['ChunkPages']['M']), parent['JobId']['S'], len(pages))
+    getMetrics().add('ChunksMerged', len(parent['ChunkPages']['M']))
+    return [output for output in outputs if output['Key'] in (manifest_file, writer.index_file)]
+
+#Function to hand the pages written for one chunk of a split document to its parent job. Chunks are counted
+#with an atomic ADD, and the chunk completing the count merges every chunk into the parent's output. A
+#repeated notification finds its chunk already recorded and only retries a merge that did not finish.
+#Returns the objects written by the merge, None when this chunk did not merge.
+def finishChunk(dynamodb, s3, table_name, jobState, parentJobId, chunkJobId, first_page, textractStatus, textractTimestamp,
+                bucket, num_pages, writer, compress, search_index, words, ioExecutor):
+    metrics = getMetrics()
+    parentKey = {
+        'JobId':{'S':parentJobId},
+        'JobType':{'S':'TextDetection'}
+    }
+    if textractStatus != 'SUCCEEDED':
+        logger.error("Chunk job %s of job %s ended with status %s", chunkJobId, parentJobId, textractStatus)
+        with metrics.timer('DynamoDBUpdate'):
+            callWithRetry(dynamodb.update_item,
+                TableName=table_name,
+                Key=parentKey,
+                ExpressionAttributeNames={"#jst": "JobStatus", "#jct": "JobCompleteTimeStamp"},
+                UpdateExpression='SET #jst = :job_status, #jct = :job_complete',
+                ExpressionAttributeValues={
+                    ":job_status": {"S": textractStatus},
+                    ":job_complete": {"N": str(textractTimestamp)}
+                }
+            )
+        return None
+
+    chunk = {'NumPages': num_pages, 'Pages': writer.checkpoint()}
+    try:
+        with metrics.timer('DynamoDBUpdate'):
+            parent = callWithRetry(dynamodb.update_item,
+                TableName=table_name,
+                Key=parentKey,
+                ExpressionAttributeNames={"#cp": "ChunkPages", "#chunk": str(first_page), "#cd": "ChunksDone"},
+                UpdateExpression='SET #cp.#chunk = :chunk ADD #cd :one',
+                ConditionExpression='attribute_not_exists(#cp.#chunk)',
+                ExpressionAttributeValues={
+                    ":chunk": {"S": json.dumps(chunk, separators=(',', ':'))},
+                    ":one": {"N": "1"}
+                },
+                ReturnValues='ALL_NEW'
+            )['Attributes']
+    except Exception as e:
+        if errorCode(e) != 'ConditionalCheckFailedException':
+            raise
+        logger.info("Chunk at page %d of job %s already recorded", first_page, parentJobId)
+        parent = callWithRetry(dynamodb.get_item, TableName=table_name, Key=parentKey, ConsistentRead=True)['Item']
+    chunksDone, chunkCount = int(parent['ChunksDone']['N']), int(parent['ChunkCount']['N'])
+    logger.info("%d of %d chunks of job %s done", chunksDone, chunkCount, parentJobId)
+    #A failed chunk leaves its status on the parent, which is then never merged
+    if chunksDone == chunkCount and 'JobStatus' not in parent:
+        return mergeChunks(jobState, s3, parent, textractTimestamp, bucket, compress, search_index, words, ioExecutor)
+    return None
+
+#Function to post-process the Textract completion notification carried by one SNS record, returning the
+#result of the record with the objects written for it
+def processRecord(record, s3, textract, dynamodb, table_name, jobState, result_mode, output_layout, compress, search_index, words, ioExecutor):
+    documentBlocks = None
+    text_files = []
+    num_pages = 0     
+    num_lines = 0
+    bucket = ""
+    upload_prefix = ""            
+    textractJobId = ""
+    textractStatus = ""
+    textractAPI = ""
+    textractJobTag = ""
+    textractS3ObjectName = ""
+    textractS3Bucket = ""  
+    textractTimestamp = ""            
+    manifest_file = None
+    writer = None
+    parentJobId = None
+    pageOffset = 0
+    checkpointed = False
+    metrics = getMetrics()
+    if 'Sns' in record.keys():
+        sns = record['Sns']
+        if 'Message' in sns.keys():
+            message = json.loads(sns['Message'])
+            textractJobId = message['JobId']
+            textractStatus = message['Status']
+            textractTimestamp =  str(int(float(message['Timestamp'])/1000))
+            textractAPI = message['API']
+            textractJobTag = message['JobTag']
+            documentLocation = message['DocumentLocation']
+            textractS3ObjectName = documentLocation['S3ObjectName']
+            textractS3Bucket = documentLocation['S3Bucket']
+            logger.debug("JobId = %s, Status = %s, Timestamp = %s, API = %s, JobTag = %s, S3ObjectName = %s, S3Bucket = %s",
+                         textractJobId, textractStatus, textractTimestamp, textractAPI, textractJobTag, textractS3ObjectName, textractS3Bucket)
+            
+            bucket = 'postprocessedbucket'
+            document_path = textractS3ObjectName[:textractS3ObjectName.rfind("/")] if textractS3ObjectName.find("/") >= 0 else ""
+            document_name = textractS3ObjectName[textractS3ObjectName.rfind("/")+1:textractS3ObjectName.rfind(".")] if textractS3ObjectName.find("/") >= 0 else textractS3ObjectName[:textractS3ObjectName.rfind(".")]
+            document_type = textractS3ObjectName[textractS3ObjectName.rfind(".")+1:].upper()                        
+
+            if document_path == "":
+                upload_prefix = textractJobId
+            else:
+                upload_prefix = "{}/{}".format(document_path, textractJobId)
+
+            #A chunk of a split document writes its pages, numbered within the whole document, to its parent's output
+            chunk = chunkFromKey(textractS3ObjectName)
+            if chunk is not None:
+                upload_prefix, parentJobId, document_name, first_page = chunk
+                pageOffset = first_page - 1
+                logger.info("Job %s is the chunk of job %s starting at page %d", textractJobId, parentJobId, first_page)
+
+            logger.debug("upload_prefix = %s", upload_prefix)
+
+            if parentJobId is None:
+                writer = DocumentWriter(s3, bucket, upload_prefix, document_name, output_layout, ioExecutor, compress=compress, index=search_index,
+                                        words=words)
+            else:
+                writer = DocumentWriter(s3, bucket, upload_prefix, document_name, 'pages', ioExecutor, compress=compress, pageOffset=pageOffset,
+                                        words=words)
+            if result_mode == 'streaming':
+                #Large jobs record their progress in the job item so that a later invocation can resume them
+                checkpoint_interval = float(os.environ.get('checkpoint_interval', '60'))
+                checkpoint_margin = float(os.environ.get('checkpoint_margin', '60'))
+                checkpointing = writer.layout == 'pages' and checkpoint_interval > 0
+                checkpoint = loadCheckpoint(dynamodb, table_name, textractJobId) if checkpointing else None
+                resumeToken = None
+                if checkpoint is not None:
+                    logger.info("Resuming job %s with %d pages already written", textractJobId, len(checkpoint['Pages']))
+                    metrics.add('Resumes')
+                    writer.resume(checkpoint['Pages'])
+                    resumeToken = checkpoint['NextToken']
+                    num_pages = checkpoint['NumPages']
+                    checkpointed = True
+                startToken = resumeToken
+                fetchToken = resumeToken
+                lastCheckpoint = time.time()
+
+                #Write every page as soon as all of its lines, and words when they are exported, have been retrieved
+                assembler = PageAssembler(words)
+                for response_pages, responseBlocks, nextToken in iterTextDetectionResult(textract, textractJobId, resumeToken):
+                    num_pages = max(num_pages, response_pages)
+                    with metrics.timer('Parse'):
+                        completePages = assembler.addBlocks(responseBlocks, fetchToken, writer)
+                    fetchToken = nextToken
+                    for page in completePages:
+                        with metrics.timer('Parse'):
+                            page_words = assembler.pageWords(page) if words else None
+                            page_text = assembler.popPage(page)
+                        writer.writePage(page.page, page_text, page_words)
+                    if not checkpointing or nextToken is None:
+                        continue
+                    #A resume must read again every response holding blocks of pages not yet written, and
+                    #stopping before that point moved on would leave the next invocation no further ahead
+                    resumeToken = assembler.resumeToken(nextToken)
+                    remaining = remainingSeconds()
+                    outOfTime = remaining is not None and remaining < checkpoint_margin and resumeToken != startToken
+                    if outOfTime or time.time() - lastCheckpoint >= checkpoint_interval:
+                        saveCheckpoint(dynamodb, table_name, textractJobId, resumeToken, writer, num_pages)
+                        lastCheckpoint = time.time()
+                        checkpointed = True
+                    if outOfTime:
+                        raise JobContinued(textractJobId)
+                for page in assembler.remainingPages():
+                    logger.warning("Page-%d of job %s is missing blocks from the Textract response", page.page, textractJobId)
+                    page_words = assembler.pageWords(page) if words else None
+                    writer.writePage(page.page, assembler.popPage(page), page_words)
+            else:
+                num_pages, documentBlocks = GetTextDetectionResult(textract, textractJobId) 
+                if documentBlocks is not None and len(documentBlocks) > 0:
+                    logger.debug("%d Blocks retrieved", len(documentBlocks))
+
+                    #Extract lines of texts into a Python dictionary by parsing the raw JSON from Textract
+                    with metrics.timer('Parse'):
+                        blocks = groupBlocksByType(documentBlocks)
+                        document_text, num_lines = extractTextBody(blocks)
+                        document_words = extractDocumentWords(blocks) if words else {}
+                    for page_name in sorted(document_text.keys(), key=pageNumberFromName):
+                        page_number = pageNumberFromName(page_name)
+                        writer.writePage(page_number, document_text[page_name], document_words.get(page_number))
+
+            #Remaining uploads finish while the job record is updated, chunks leave the manifest to the merge
+            if parentJobId is None:
+                text_files, manifest_file = writer.close()
+            num_lines = writer.numLines
+
+    #The writer knows every object it wrote, so the output is reported without listing it
+    outputs = writer.outputFiles() if writer is not None else []
+    result = {'JobId': textractJobId, 'Status': 'Processed', 'OutputFiles': outputs}
+    if parentJobId is not None:
+        result['ParentJobId'] = parentJobId
+        merged = finishChunk(dynamodb, s3, table_name, jobState, parentJobId, textractJobId, pageOffset + 1, textractStatus, textractTimestamp,
+                             bucket, num_pages, writer, compress, search_index, words, ioExecutor)
+        if merged is not None:
+            result['Merged'] = True
+            outputs.extend(merged)
+        #Chunk jobs have no record of their own beyond the progress saved for them
+        if checkpointed:
+            jobState.delete(textractJobId)
+    else:
+        completeJob(jobState, textractJobId, textractStatus, textractTimestamp, bucket, num_pages, num_lines,
+                    writer, text_files, manifest_file, outputs)
+
+    logger.debug("Output files: %s", outputs)
+    metrics.add('Pages', num_pages)
+    metrics.add('Lines', num_lines)
+    metrics.add('OutputFiles', len(outputs))
+    return result
+
+#Function to hand the records that stopped at a checkpoint to a new asynchronous invocation of this function
+def continueRecords(context, records):
+    with getMetrics().timer('Continuation'):
+        callWithRetry(getClient('lambda').invoke,
+            FunctionName=context.invoked_function_arn,
+            InvocationType='Event',
+            Payload=json.dumps({'Records': records}).encode('utf-8')
+        )
+
+#Function to find the Textract job a record refers to, for reporting failures
+def recordJobId(record):
+    try:
+        return json.loads(record['Sns']['Message'])['JobId']
+    except Exception:
+        return ""
 
 def lambda_handler(event, context):
     
+    beginInvocation(context)
+    metrics = getMetrics()
+
     #Initialize Boto Resource	
-    s3 = boto3.resource('s3')
-    textract = boto3.client('textract')
-    dynamodb = boto3.client('dynamodb')
+    s3 = getClient('s3')
+    textract = getClient('textract')
+    dynamodb = getClient('dynamodb')
     table_name=os.environ['table_name']
-    file_list = []
+    result_mode=os.environ.get('result_mode', 'buffered').lower()
+    output_layout=os.environ.get('output_layout', 'document').lower()
+    compress=os.environ.get('output_compression', 'none').lower() == 'gzip'
+    search_index=os.environ.get('search_index', 'true').lower() == 'true'
+    words=os.environ.get('word_export', 'none').lower() == 'columnar'
+    workers=int(os.environ.get('record_workers', '4'))
+    results = []
+    failures = []
+    continued = []
+    jobState = JobStateWriter(dynamodb, table_name)
 
     if "Records" in event:        
         records = event['Records']
         numRecords = len(records)
 
-        print("{} messages recieved".format(numRecords))
-        for record in records:
-            documentBlocks = None
-            num_pages = 0     
-            num_lines = 0
-            bucket = ""
-            upload_prefix = ""            
-            textractJobId = ""
-            textractStatus = ""
-            textractAPI = ""
-            textractJobTag = ""
-            textractS3ObjectName = ""
-            textractS3Bucket = ""  
-            textractTimestamp = ""            
-            if 'Sns' in record.keys():
-                sns = record['Sns']
-                if 'Message' in sns.keys():
-                    message = json.loads(sns['Message'])
-                    textractJobId = message['JobId']
-                    print("{} = {}".format("JobId", textractJobId))
-                    textractStatus = message['Status']
-                    print("{} = {}".format("Status",textractStatus)) 
-                    textractTimestamp =  str(int(float(message['Timestamp'])/1000))
-                    print("{} = {}".format("Timestamp",textractTimestamp))                         
-                    textractAPI = message['API']
-                    print("{} = {}".format("API", textractAPI))                    
-                    textractJobTag = message['JobTag']
-                    print("{} = {}".format("JobTag", textractJobTag))    
-                    documentLocation = message['DocumentLocation']
-                    textractS3ObjectName = documentLocation['S3ObjectName']
-                    print("{} = {}".format("S3ObjectName", textractS3ObjectName))    
-                    textractS3Bucket = documentLocation['S3Bucket']
-                    print("{} = {}".format("S3Bucket", textractS3Bucket))      
-                    
-                    bucket = 'postprocessedbucket'
-                    document_path = textractS3ObjectName[:textractS3ObjectName.rfind("/")] if textractS3ObjectName.find("/") >= 0 else ""
-                    document_name = textractS3ObjectName[textractS3ObjectName.rfind("/")+1:textractS3ObjectName.rfind(".")] if textractS3ObjectName.find("/") >= 0 else textractS3ObjectName[:textractS3ObjectName.rfind(".")]
-                    document_type = textractS3ObjectName[textractS3ObjectName.rfind(".")+1:].upper()                        
-
-                    if document_path == "":
-                        upload_prefix = textractJobId
-                    else:
-                        upload_prefix = "{}/{}".format(document_path, textractJobId)
-
-                    print("upload_prefix = " + upload_prefix)  
-
-                    num_pages, documentBlocks = GetTextDetectionResult(textract, textractJobId) 
-
-            if documentBlocks is not None and len(documentBlocks) > 0:
-                print("{} Blocks retrieved".format(len(documentBlocks)))
-        
-                #Extract lines of texts into a Python dictionary by parsing the raw JSON from Textract
-                blocks = groupBlocksByType(documentBlocks)
-                document_text, num_lines = extractTextBody(blocks)
+        logger.info("%d messages received", numRecords)
+        metrics.add('Records', numRecords)
 
+        #A failed record does not stop the others in the batch, the batch fails once they are processed
+        def process(record):
+            try:
+                return processRecord(record, s3, textract, dynamodb, table_name, jobState, result_mode, output_layout, compress, search_index, words, ioExecutor), None, None
+            except JobContinued:
+                return {'JobId': recordJobId(record), 'Status': 'Continued'}, None, record
+            except Exception as e:
+                logger.error("Processing of job %s failed: %s", recordJobId(record), e)
+                metrics.add('RecordFailures')
+                failure = {'JobId': recordJobId(record), 'Error': str(e)}
+                return dict(failure, Status='Failed'), failure, None
+
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as ioExecutor:
+            with ThreadPoolExecutor(max_workers=max(min(workers, numRecords), 1)) as recordExecutor:
+                for result, failure, continuedRecord in recordExecutor.map(process, records):
+                    results.append(result)
+                    if failure is not None:
+                        failures.append(failure)
+                    if continuedRecord is not None:
+                        continued.append(continuedRecord)
+
+        #The chunk records left behind by the batch are deleted together, a chunk whose record is left fails the batch
+        unwritten = set(jobState.flush())
+        failures.extend({'JobId': jobId, 'Error': 'Job record not written'} for jobId in unwritten)
+        for result in results:
+            if result['Status'] == 'Processed' and result['JobId'] in unwritten:
+                result.update(Status='Failed', Error='Job record not written')
+
+        #Jobs stopped at a checkpoint carry on from it in a new invocation
+        if len(continued) > 0:
+            try:
+                continueRecords(context, continued)
+                metrics.add('Continuations', len(continued))
+            except Exception as e:
+                logger.error("Continuation of %d jobs failed: %s", len(continued), e)
+                failures.extend({'JobId': recordJobId(record), 'Error': 'Continuation failed: {}'.format(e)} for record in continued)
+                for result in results:
+                    if result['Status'] == 'Continued':
+                        result.update(Status='Failed', Error='Continuation failed: {}'.format(e))
+                continued = []
+
+        logger.info("%d of %d messages processed, %d continued", numRecords - len(failures) - len(continued), numRecords, len(continued))
         
-                #Generate JSON document using form fields information          
-                json_document = "{}-text.json".format(document_name)
-                json_file = open("/tmp/"+json_document,'w+')
-                json_file.write(json.dumps(document_text, indent=4, sort_keys=True))
-                json_file.close()
-                s3.meta.client.upload_file("/tmp/"+json_document, bucket, "{}/{}".format(upload_prefix,json_document))         
-
-                try:
-                    response = dynamodb.update_item(
-                        TableName=table_name,
-                        Key={
-                            'JobId':{'S':textractJobId},
-                            'JobType':{'S':'TextDetection'}
-                        },
-                        ExpressionAttributeNames={"#tf": "TextFiles", "#jst": "JobStatus", "#jct": "JobCompleteTimeStamp", "#nl": "NumLines", "#np": "NumPages"},
-                        UpdateExpression='SET #tf = list_append(#tf, :text_files), #jst = :job_status, #jct = :job_complete, #nl = :num_lines, #np = :num_pages',
-                        ExpressionAttributeValues={
-                            ":text_files": {"L": [{"S": "{}/{}".format(upload_prefix,json_document)}]},
-                            ":job_status": {"S": textractStatus},
-                            ":job_complete": {"N": str(textractTimestamp)},
-                            ":num_lines": {"N": str(num_lines)},
-                            ":num_pages": {"N": str(num_pages)}
-                        }
-                    )
-                except Exception as e:
-                    print('DynamoDB Insertion Error is: {0}'.format(e))                            
-            else:
-                try:
-                    response = dynamodb.update_item(
-                        TableName=table_name,
-                        Key={
-                            'JobId':{'S':textractJobId},
-                            'JobType':{'S':'TextDetection'}
-                        },
-                        ExpressionAttributeNames={"#jst": "JobStatus", "#jct": "JobCompleteTimeStamp"},
-                        UpdateExpression='SET #jst = :job_status, #jct = :job_complete',
-                        ExpressionAttributeValues={
-                            ":job_status": {"S": textractStatus},
-                            ":job_complete": {"N": str(textractTimestamp)}
-                        }
-                    )
-                except Exception as e:
-                    print('DynamoDB Insertion Error is: {0}'.format(e))  
-                    
-            s3_result = s3.meta.client.list_objects_v2(Bucket=bucket, Prefix="{}/".format(upload_prefix), Delimiter = "/")
-            if 'Contents' in s3_result:
-                
-                for key in s3_result['Contents']:
-                    if key['Key'].endswith("json"):
-                        file_list.append("https://s3.amazonaws.com/{}/{}".format(bucket, key['Key']))
-                
-                while s3_result['IsTruncated']:
-                    continuation_key = s3_result['NextContinuationToken']
-                    s3_result = s3.meta.client.list_objects_v2(Bucket=bucket, Prefix="{}/".format(upload_prefix), Delimiter="/", ContinuationToken=continuation_key)
-                    for key in s3_result['Contents']:
-                        if key['Key'].endswith("json"):
-                            file_list.append("https://s3.amazonaws.com/{}/{}".format(bucket, key['Key']))            
-        
-            print(file_list)   
-        
-    return file_list
+    metrics.emit()
+    #Records processed before are processed again by the retry, which leaves their output and job records as they are
+    if len(failures) > 0:
+        raise RecordsFailed(failures)
+    return {'Records': results, 'Failures': failures, 'Continued': [recordJobId(record) for record in continued]}
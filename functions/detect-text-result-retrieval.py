@@ -1,46 +1,339 @@
-import io
 import os
+import sys
 import json
-import time
-import boto3
-from datetime import datetime
-from xml.etree import ElementTree
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from textract_util import *
 
+#Function to find the most recent job of a document through the DocumentIndex GSI
+def findLatestJob(table, documentBucket, documentKey):
+    queryArgs = {
+        'IndexName': 'DocumentIndex',
+        'KeyConditionExpression': "DocumentBucket = :bucket and begins_with(DocumentPath, :path)",
+        'FilterExpression': "JobType = :jobType",
+        'ExpressionAttributeValues': {
+            ":bucket": documentBucket,
+            ":path": documentKey + "#",
+            ":jobType": 'TextDetection'
+        },
+        'ScanIndexForward': False
+    }
+    while True:
+        response = callWithRetry(table.query, **queryArgs)
+        #Keys sharing the same prefix may belong to other documents, newest jobs come first
+        for key in response['Items']:
+            if documentFromIndexPath(key['DocumentPath']) == documentKey:
+                logger.debug("Latest job for %s/%s is %s", documentBucket, documentKey, key['JobId'])
+                return callWithRetry(table.get_item, Key={'JobId': key['JobId'], 'JobType': key['JobType']}).get('Item')
+        if 'LastEvaluatedKey' not in response:
+            break
+        queryArgs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    logger.info("No matching records found for %s/%s", documentBucket, documentKey)
+    return None
+
+#Function to find the most recent job of a document written before DocumentPath was populated
+def scanLatestJob(table, documentBucket, documentKey):
+    scanArgs = {
+        'FilterExpression': "DocumentBucket = :bucket and DocumentKey = :key and JobType =:jobType",
+        'ExpressionAttributeValues': {
+            ":bucket": documentBucket,
+            ":key": documentKey,
+            ":jobType": 'TextDetection'
+        }
+    }
+    item = None
+    recordsMatched = 0
+    while True:
+        response = callWithRetry(table.scan, **scanArgs)
+        for candidate in response['Items']:
+            recordsMatched += 1
+            if item is None or candidate['JobStartTimeStamp'] > item['JobStartTimeStamp']:
+                item = candidate
+        if 'LastEvaluatedKey' not in response:
+            break
+        scanArgs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    logger.info("%d matching records found for %s/%s", recordsMatched, documentBucket, documentKey)
+    return item
+
+#Function to find the latest jobs of the documents under a key prefix through the DocumentIndex GSI, returning
+#the items of at most maxDocuments documents and whether further documents were left out
+def findLatestJobs(table, documentBucket, documentPrefix, maxDocuments, executor):
+    queryArgs = {
+        'IndexName': 'DocumentIndex',
+        'KeyConditionExpression': "DocumentBucket = :bucket and begins_with(DocumentPath, :path)",
+        'FilterExpression': "JobType = :jobType",
+        'ExpressionAttributeValues': {
+            ":bucket": documentBucket,
+            ":path": documentPrefix,
+            ":jobType": 'TextDetection'
+        },
+        'ScanIndexForward': True
+    }
+    #The keys of a document are adjacent and oldest first, so its last key is its latest job
+    latestKeys = OrderedDict()
+    truncated = False
+    while not truncated:
+        response = callWithRetry(table.query, **queryArgs)
+        for key in response['Items']:
+            document = documentFromIndexPath(key['DocumentPath'])
+            if document not in latestKeys and len(latestKeys) >= maxDocuments:
+                truncated = True
+                break
+            latestKeys[document] = key
+        if 'LastEvaluatedKey' not in response:
+            break
+        queryArgs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    logger.debug("%d documents found under %s/%s", len(latestKeys), documentBucket, documentPrefix)
+    getItem = lambda key: callWithRetry(table.get_item, Key={'JobId': key['JobId'], 'JobType': key['JobType']}).get('Item')
+    items = [item for item in executor.map(getItem, latestKeys.values()) if item is not None]
+    return items, truncated
+
+#Parsed text of recently read jobs, kept across invocations of a warm container and keyed by
+#(document bucket, document key, JobId). Each entry records the completion time of the job it was
+#read for and every object read so far with its ETag.
+resultCache = LRUCache(int(os.environ.get('result_cache_bytes', 64*1024*1024)))
+
+#Function to estimate the memory held by parsed page text, a dictionary of (line text list, reading order) pairs
+def pageTextSize(pages):
+    size = sys.getsizeof(pages)
+    for page_name, (lines, lineOrder) in pages.items():
+        size += sys.getsizeof(page_name) + sys.getsizeof(lines) + sum(sys.getsizeof(line) for line in lines)
+        if lineOrder is not None:
+            size += sys.getsizeof(lineOrder) + 28 * len(lineOrder)
+    return size
+
+#Function to keep the postings of a parsed search index as compact integer arrays, together with their estimated size
+def parseIndex(body):
+    terms = {}
+    size = 0
+    for term, postings in json.loads(body)['Terms'].items():
+        terms[term] = array('i', postings)
+        size += sys.getsizeof(term) + sys.getsizeof(terms[term])
+    return terms, size + sys.getsizeof(terms)
+
+#Function to return the cache entry of a job, starting a new one when the job completed again since it was cached
+def jobCacheEntry(cacheKey, jobCompleteTimeStamp):
+    entry = resultCache.get(cacheKey)
+    if entry is None or entry['JobCompleteTimeStamp'] != jobCompleteTimeStamp:
+        entry = {'JobCompleteTimeStamp': jobCompleteTimeStamp, 'Objects': {}}
+    return entry
+
+#Function to keep only the line text of parsed output, in line order, and the reading order of each page
+#when it was stored, together with its estimated size. The order is kept as the line numbers in reading
+#order, from the Order of every line, or from the ReadingOrder list of pages written by earlier versions.
+def parsePageLines(documentjson):
+    pages = {}
+    for page_name, page_text in documentjson.items():
+        lineNames = sorted((line for line in page_text.keys() if line.startswith('Line-')), key=pageNumberFromName)
+        lines = [page_text[line]['Text'] for line in lineNames]
+        lineOrder = page_text.get('ReadingOrder')
+        if len(lineNames) > 0 and 'Order' in page_text[lineNames[0]]:
+            lineOrder = [number for order, number in sorted((page_text[line]['Order'], i + 1) for i, line in enumerate(lineNames))]
+        pages[page_name] = (lines, lineOrder)
+    return pages, pageTextSize(pages)
+
+#Function to read an object through the cache entry of its job. A cached copy is returned as is when
+#the entry is known to be current, or after a conditional GET confirms its ETag; otherwise it is read again.
+def readCachedObject(s3, bucket, key, entry, trusted, parse, **getArgs):
+    objectKey = (key, getArgs.get('Range'))
+    cached = entry['Objects'].get(objectKey) if entry is not None else None
+    if cached is not None and trusted:
+        getMetrics().add('CacheHits')
+        return cached[1], True
+    if cached is not None:
+        getArgs['IfNoneMatch'] = cached[0]
+    try:
+        body, etag = readObject(s3, bucket, key, **getArgs)
+    except Exception as e:
+        if cached is None or not notModified(e):
+            raise
+        getMetrics().add('CacheRevalidations')
+        return cached[1], True
+    getMetrics().add('CacheMisses')
+    value, size = parse(body)
+    if entry is not None:
+        entry['Objects'][objectKey] = (etag, value, size)
+    return value, False
+
+#Function to download and parse one text output object, or a single page of it when a byte range is given
+def readTextFile(s3, bucket, textRead, entry=None, trusted=False):
+    textFile, page_name, offset, size = textRead
+    with getMetrics().timer('TextRead'):
+        if offset is None:
+            logger.debug("Reading Document text from %s", textFile)
+            parse = lambda body: parsePageLines(json.loads(body))
+            return readCachedObject(s3, bucket, textFile, entry, trusted, parse)[0]
+        #A cached copy of the whole document already holds the page
+        wholeDocument = entry['Objects'].get((textFile, None)) if entry is not None and trusted else None
+        if wholeDocument is not None and page_name in wholeDocument[1]:
+            getMetrics().add('CacheHits')
+            return {page_name: wholeDocument[1][page_name]}
+        logger.debug("Reading %s from bytes %d-%d of %s", page_name, offset, offset+size-1, textFile)
+        parse = lambda body: parsePageLines({page_name: json.loads(body)})
+        return readCachedObject(s3, bucket, textFile, entry, trusted, parse, Range='bytes={}-{}'.format(offset, offset+size-1))[0]
+
+#Function to list the reads covering the requested pages, as (key, page name, offset, size) tuples
+def planTextReads(s3, bucket, item, pageRanges, manifest=None):
+    recordedFiles = item['TextFiles']
+    #A page layout output is recorded by its manifest, which lists the page objects
+    if 'ManifestFile' in item and item['ManifestFile'] in recordedFiles:
+        if manifest is None:
+            manifest = json.loads(getObjectBytes(s3, bucket, item['ManifestFile']))
+        recordedFiles = [entry['Key'] for entry in manifest['Pages']]
+    textFiles = []
+    wholeDocument = False
+    for textFile in recordedFiles:
+        page_number = pageNumberFromTextFile(textFile)
+        if page_number is None:
+            wholeDocument = True
+        if page_number is None or pageSelected(page_number, pageRanges):
+            textFiles.append((page_number or 0, textFile))
+    textFiles.sort()
+    textReads = [(textFile, None, None, None) for page_number, textFile in textFiles]
+
+    #A whole document output can be read page by page through the byte offsets in its manifest
+    if wholeDocument and pageRanges is not None and 'ManifestFile' in item:
+        if manifest is None:
+            manifest = json.loads(getObjectBytes(s3, bucket, item['ManifestFile']))
+        if manifest['Layout'] == 'document' and manifest.get('ContentEncoding', 'identity') == 'identity':
+            textReads = []
+            for entry in manifest['Pages']:
+                if 'Offset' not in entry:
+                    return [(item['TextFiles'][0], None, None, None)]
+                if pageSelected(entry['Page'], pageRanges):
+                    textReads.append((entry['Key'], 'Page-{0:02d}'.format(entry['Page']), entry['Offset'], entry['Bytes']))
+    return textReads
+
+#Function to search the index of one job, returning its (page, line) matches
+def searchJob(s3, item, query, phrase):
+    outputBucket = item.get('OutputBucket', item['DocumentBucket'])
+    cacheKey = (item['DocumentBucket'], item['DocumentKey'], item['JobId'])
+    entry = jobCacheEntry(cacheKey, item['JobCompleteTimeStamp'])
+    with getMetrics().timer('IndexRead'):
+        terms = readCachedObject(s3, outputBucket, item['IndexFile'], entry, False, parseIndex)[0]
+    resultCache.put(cacheKey, entry, sum(cached[2] for cached in entry['Objects'].values()))
+    with getMetrics().timer('Search'):
+        return searchTerms(terms, query, phrase)
+
+#Function to answer a term query, or a phrase query when it is quoted, from the search indexes of one
+#document or of every document under a key prefix. Only the indexes are read, never the text.
+def searchDocuments(event, s3, table, workers, matchLimit=None):
+    metrics = getMetrics()
+    documentBucket = event['DocumentBucket']
+    query = event['Search'].strip()
+    phrase = len(query) > 1 and query.startswith('"') and query.endswith('"')
+    documentPrefix = event.get('DocumentPrefix') or ""
+    jsonresponse = {'Search': query, 'Phrase': phrase, 'Documents': [], 'NotIndexed': [], 'Failures': []}
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        with metrics.timer('JobLookup'):
+            if documentPrefix != "":
+                items, truncated = findLatestJobs(table, documentBucket, documentPrefix, int(os.environ.get('search_max_documents', '100')), executor)
+            else:
+                item = findLatestJob(table, documentBucket, event['DocumentKey'])
+                items, truncated = ([item] if item is not None else []), False
+        jsonresponse['DocumentsTruncated'] = truncated
+
+        indexed = []
+        for item in items:
+            if 'IndexFile' in item:
+                indexed.append(item)
+            else:
+                jsonresponse['NotIndexed'].append(item['DocumentKey'])
+        metrics.add('IndexReads', len(indexed))
+
+        #A document that cannot be searched is reported without failing the others
+        def search(item):
+            try:
+                return searchJob(s3, item, query, phrase), None
+            except Exception as e:
+                logger.error("Search of %s failed: %s", item['DocumentKey'], e)
+                return [], {'DocumentKey': item['DocumentKey'], 'Error': str(e)}
+
+        matchesReturned = 0
+        truncated = False
+        for item, (matches, failure) in zip(indexed, mapInOrder(executor, search, indexed, workers)):
+            if failure is not None:
+                jsonresponse['Failures'].append(failure)
+            if len(matches) == 0:
+                continue
+            if matchLimit is not None and matchesReturned + len(matches) > matchLimit:
+                matches = matches[:matchLimit - matchesReturned]
+                truncated = True
+            jsonresponse['Documents'].append({
+                'DocumentKey': item['DocumentKey'],
+                'JobId': item['JobId'],
+                'Matches': [{'Page': page, 'Line': line} for page, line in matches]
+            })
+            matchesReturned += len(matches)
+            if truncated:
+                break
+
+    jsonresponse['MatchesReturned'] = matchesReturned
+    jsonresponse['Truncated'] = truncated
+    metrics.add('MatchesReturned', matchesReturned)
+    return jsonresponse
+
+#Function to read an optional integer request parameter, API Gateway passes missing ones as ""
+def intParameter(event, name):
+    value = event.get(name)
+    if value is None or str(value).strip() == "":
+        return None
+    return int(value)
+
 def lambda_handler(event, context):    
-    s3 = boto3.resource('s3')
-    textract = boto3.client('textract')
-    dynamodb = boto3.resource('dynamodb')
+    beginInvocation(context)
+    metrics = getMetrics()
+    s3 = getClient('s3')
+    dynamodb = getResource('dynamodb')
     table_name=os.environ['table_name']
     table = dynamodb.Table(table_name)    
+    workers = int(os.environ.get('read_workers', '8'))
    
+    #Search requests are answered from the search indexes alone
+    if (event.get('Search') or "").strip() != "":
+        try:
+            matchLimit = intParameter(event, 'MatchLimit')
+            if (event.get('DocumentKey') or "") == "" and (event.get('DocumentPrefix') or "") == "":
+                raise ValueError("DocumentKey or DocumentPrefix is required")
+        except ValueError as e:
+            metrics.add('InvalidRequests')
+            metrics.emit()
+            return {'Error': 'Invalid request parameter: {}'.format(e)}
+        jsonresponse = searchDocuments(event, s3, table, workers, matchLimit)
+        metrics.emit()
+        return jsonresponse
+
     documentBucket = event['DocumentBucket']
     documentKey = event['DocumentKey']
 
-    print("Invoking retrieval function for text detection result")
+    logger.debug("Invoking retrieval function for text detection result")
 
     jsonresponse = {}
  
+    try:
+        pageRanges = parsePageRanges(event.get('Pages'))
+        lineLimit = intParameter(event, 'LineLimit')
+        lineOrder = event.get('Order') or 'original'
+        if lineOrder not in ('original', 'reading'):
+            raise ValueError("Invalid order {}".format(lineOrder))
+    except ValueError as e:
+        metrics.add('InvalidRequests')
+        metrics.emit()
+        return {'Error': 'Invalid request parameter: {}'.format(e)}
+
     item = None
     jobStartTimeStamp = None
     jobCompleteTimeStamp = None  
 
     try:
-        response = table.scan(
-            FilterExpression = "DocumentBucket = :bucket and DocumentKey = :key and JobType =:jobType",
-            ExpressionAttributeValues = {
-                ":bucket": documentBucket,
-                ":key": documentKey,
-                ":jobType": 'TextDetection'
-
-            }
-        )
-        recordsMatched = len(response['Items'])
-        print("{} matching records found for {}/{}".format(recordsMatched, documentBucket, documentKey))
-        if recordsMatched > 0:
-            item = response['Items'][-1]
+        with metrics.timer('JobLookup'):
+            item = findLatestJob(table, documentBucket, documentKey)
+            if item is None and os.environ.get('legacy_scan_fallback', 'false').lower() == 'true':
+                item = scanLatestJob(table, documentBucket, documentKey)
     except Exception as e:
-        print('Actual error is: {0}'.format(e))
+        logger.error('Actual error is: %s', e)
 
     if item is not None:
         jsonresponse['JobId'] = item['JobId']
@@ -61,22 +354,52 @@ def lambda_handler(event, context):
         jsonresponse['UploadPrefix'] = item['UploadPrefix']
         jsonresponse['NumPages'] = str(item['NumPages'])
         jsonresponse['NumLines'] = str(item['NumLines'])            
+        outputBucket = item.get('OutputBucket', documentBucket)
     
-        textFiles = item['TextFiles']
-        print("Document Text stored in {} files".format(len(textFiles)))
-        for textFile in textFiles:
-            s3_object = s3.Object(documentBucket,textFile)
-            print("Reading Document text from {}".format(textFile))
-            s3_response = s3_object.get()
-            jsonstring = s3_response['Body'].read()
-
-            documentjson = json.loads(jsonstring)
+        #Reuse text read by earlier invocations for the same job. The manifest is written after all
+        #of the text, so when it is unchanged the cached text of the job is current as well.
+        cacheKey = (documentBucket, documentKey, item['JobId'])
+        entry = jobCacheEntry(cacheKey, jobCompleteTimeStamp)
+        trusted = False
+        manifest = None
+        if 'ManifestFile' in item:
+            parseManifest = lambda body: (json.loads(body), len(body))
+            manifest, trusted = readCachedObject(s3, outputBucket, item['ManifestFile'], entry, False, parseManifest)
 
-            jsonresponse = {}
-            for page in documentjson.keys():
-                jsonresponse[page] = []
-                for line in documentjson[page].keys():
-                    jsonresponse[page].append(documentjson[page][line]['Text'])
+        #Text may be stored as a single document or as one object per page, skip pages that were not requested
+        textReads = planTextReads(s3, outputBucket, item, pageRanges, manifest)
+        logger.debug("Document Text needs %d reads", len(textReads))
+        metrics.add('TextReads', len(textReads))
 
+        linesReturned = 0
+        truncated = False
+        with ThreadPoolExecutor(max_workers=max(min(workers, len(textReads)), 1)) as executor:
+            documents = mapInOrder(executor, lambda textRead: readTextFile(s3, outputBucket, textRead, entry, trusted), textReads, workers)
+            for documentjson in documents:
+                for page in sorted(documentjson.keys(), key=pageNumberFromName):
+                    if not pageSelected(pageNumberFromName(page), pageRanges):
+                        continue
+                    lines, pageOrder = documentjson[page]
+                    #Pages written without reading_order keep the order of their lines
+                    if lineOrder == 'reading' and pageOrder is not None:
+                        lines = [lines[number-1] for number in pageOrder]
+                    if lineLimit is not None and linesReturned + len(lines) > lineLimit:
+                        lines = lines[:lineLimit - linesReturned]
+                        truncated = True
+                        #A page past the limit is left out rather than returned empty
+                        if len(lines) == 0:
+                            break
+                    jsonresponse[page] = list(lines)
+                    linesReturned += len(lines)
+                    if truncated:
+                        break
+                if truncated:
+                    documents.close()
+                    break
+        resultCache.put(cacheKey, entry, sum(cached[2] for cached in entry['Objects'].values()))
+        jsonresponse['LinesReturned'] = linesReturned
+        jsonresponse['Truncated'] = truncated
+        metrics.add('LinesReturned', linesReturned)
 
+    metrics.emit()
     return jsonresponse
\ No newline at end of file
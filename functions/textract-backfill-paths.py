@@ -0,0 +1,73 @@
+import sys
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from textract_util import beginInvocation, getClient, callWithRetry, errorCode, logger, documentIndexPath
+
+#One-off backfill of DocumentPath on the job records written before it was populated. Retrieval finds the
+#jobs of a document through the DocumentIndex GSI keyed by DocumentPath, which leaves out earlier records.
+#Run it once after deploying, then set legacy_scan_fallback to false on the retrieval function.
+
+#Function to give DocumentPath to the records of one scan segment that have none, returning the counts
+def backfillSegment(dynamodb, table_name, segment, segments, dryRun):
+    counts = {'Scanned': 0, 'Updated': 0, 'Skipped': 0}
+    scanArgs = {
+        'TableName': table_name,
+        'Segment': segment,
+        'TotalSegments': segments,
+        'FilterExpression': 'attribute_not_exists(#dp)',
+        'ProjectionExpression': '#id, #jt, #db, #dk, #js',
+        'ExpressionAttributeNames': {'#dp': 'DocumentPath', '#id': 'JobId', '#jt': 'JobType', '#db': 'DocumentBucket',
+                                     '#dk': 'DocumentKey', '#js': 'JobStartTimeStamp'}
+    }
+    while True:
+        response = callWithRetry(dynamodb.scan, **scanArgs)
+        counts['Scanned'] += response.get('ScannedCount', 0)
+        for item in response['Items']:
+            if 'DocumentBucket' not in item or 'DocumentKey' not in item or 'JobStartTimeStamp' not in item:
+                logger.warning("Job record %s has no document to index", item['JobId']['S'])
+                counts['Skipped'] += 1
+                continue
+            documentPath = documentIndexPath(item['DocumentKey']['S'], item['JobStartTimeStamp']['N'])
+            if dryRun:
+                counts['Updated'] += 1
+                continue
+            #A record deleted or given a path since it was scanned is left as it is
+            try:
+                callWithRetry(dynamodb.update_item,
+                    TableName=table_name,
+                    Key={'JobId': item['JobId'], 'JobType': item['JobType']},
+                    ExpressionAttributeNames={'#dp': 'DocumentPath', '#id': 'JobId'},
+                    UpdateExpression='SET #dp = :path',
+                    ConditionExpression='attribute_exists(#id) AND attribute_not_exists(#dp)',
+                    ExpressionAttributeValues={':path': {'S': documentPath}}
+                )
+                counts['Updated'] += 1
+            except Exception as e:
+                if errorCode(e) != 'ConditionalCheckFailedException':
+                    raise
+                counts['Skipped'] += 1
+        if 'LastEvaluatedKey' not in response:
+            return counts
+        scanArgs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def main():
+    parser = argparse.ArgumentParser(description='Write DocumentPath on job records written before it was populated')
+    parser.add_argument('table', help='name of the job table')
+    parser.add_argument('--segments', type=int, default=4, help='segments of the parallel scan, each scanned by its own thread')
+    parser.add_argument('--dry-run', action='store_true', help='count the records to update without writing them')
+    args = parser.parse_args()
+
+    beginInvocation()
+    dynamodb = getClient('dynamodb')
+    segments = max(args.segments, 1)
+    totals = {'Scanned': 0, 'Updated': 0, 'Skipped': 0}
+    with ThreadPoolExecutor(max_workers=segments) as executor:
+        for counts in executor.map(lambda segment: backfillSegment(dynamodb, args.table, segment, segments, args.dry_run), range(segments)):
+            for name, value in counts.items():
+                totals[name] += value
+    print("{Scanned} records scanned, {Updated} {action}, {Skipped} skipped".format(
+        action='to update' if args.dry_run else 'updated', **totals))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,92 +1,124 @@
+import io
 import os
 import time
-import boto3
+import hashlib
+import json
+import logging
 from datetime import datetime
+from urllib.parse import quote_plus, unquote_plus
+from concurrent.futures import ThreadPoolExecutor
+from textract_util import documentIndexPath, TokenBucket, getClient, errorCode, isRetryable, callWithRetry, beginInvocation, getMetrics, logger, \
+    remainingSeconds,     getObjectBytes, putObject, mapInOrder, chunkFileKey, groupBlocksByType, extractTextBody, pageNumberFromName, DocumentWriter, completeJob, \
+    JobStateWriter, extractDocumentWords
 
+supportedDocumentTypes = ('PDF', 'JPG', 'JPEG', 'PNG')
+
+
+#Bucket access policy ARNs already attached to the role by this container, with their expiry time
+bucketPolicyCache = {}
+
+#Function to derive the ARN a customer managed policy gets when created without a path,
+#from the account and partition of the configured role ARN
+def policyArnFor(policyName):
+    arnParts = os.environ.get('role_arn', '').split(':')
+    if len(arnParts) < 6 or arnParts[4] == '':
+        return None
+    return "arn:{}:iam::{}:policy/{}".format(arnParts[1], arnParts[4], policyName)
+
+#Function to look up a policy ARN by name, paging through the account's customer managed policies
+def findPolicyArn(iam, policyName):
+    listArgs = {'Scope': 'Local', 'MaxItems': 1000}
+    while True:
+        response = callWithRetry(iam.list_policies, **listArgs)
+        for policy in response['Policies']:
+            if policy['PolicyName'] == policyName:
+                return policy['Arn']
+        if not response.get('IsTruncated', False):
+            return None
+        listArgs['Marker'] = response['Marker']
 
 def attachExternalBucketPolicy(externalBucketName):
-    iam = boto3.client('iam')
+    cached = bucketPolicyCache.get(externalBucketName)
+    if cached is not None and cached[1] > time.time():
+        logger.debug("Bucket Access Policy for %s already attached, using cached %s", externalBucketName, cached[0])
+        return cached[0]
+
+    iam = getClient('iam')
     roleName = os.environ['role_name']
     policyName = externalBucketName+'-bucketaccesspolicy'
+    cacheTTL = float(os.environ.get('policy_cache_ttl', '300'))
     
-    policyExists = False
-    policyAttached = False
-    
-    targetPolicy = None
-    policies = iam.list_policies(    
-        MaxItems=1000
-    )['Policies']
-    for policy in policies:
-        if policy['PolicyName'] == policyName:
-            policyExists = True
-            targetPolicy = policy['Arn']
-            print("Bucket Access Policy for {} already exists".format(externalBucketName))
-            break
+    policyExists = True
+    targetPolicy = policyArnFor(policyName)
+    if targetPolicy is None:
+        targetPolicy = findPolicyArn(iam, policyName)
+        policyExists = targetPolicy is not None
             
     if policyExists:
-        attached_policies = iam.list_attached_role_policies(
-            RoleName=roleName,
-            MaxItems=100
-        )['AttachedPolicies']   
-        for policy in attached_policies:
-            if policy['PolicyName'] == policyName:
-                policyAttached = True
-                print("Bucket Access Policy for {} already attached to Role {}".format(externalBucketName, roleName))
-                targetPolicy = policy['PolicyArn']
-                break;     
+        #Attaching is idempotent, so an already attached policy costs a single call
+        try:
+            callWithRetry(iam.attach_role_policy,
+                RoleName=roleName,
+                PolicyArn=targetPolicy
+            )
+            logger.info("Bucket Access Policy for %s attached to Role %s", externalBucketName, roleName)
+        except Exception as e:
+            if errorCode(e) != 'NoSuchEntity':
+                raise
+            policyExists = False
             
     if not policyExists:            
-        newPolicy = iam.create_policy(
-            PolicyName=externalBucketName+'-bucketaccesspolicy',
-            PolicyDocument='{\
-                                "Version": "2012-10-17",\
-                                "Statement": [\
-                                    {\
-                                        "Effect": "Allow",\
-                                        "Action": [\
-                                            "s3:ListBucket",\
-                                            "s3:ListBucketVersions"\
-                                        ],\
-                                        "Resource": [\
-                                            "arn:aws:s3:::'+externalBucketName+'"\
-                                        ]\
-                                    },\
-                                    {\
-                                        "Effect": "Allow",\
-                                        "Action": [\
-                                            "s3:GetObject",\
-                                            "s3:GetGetObjectVersionObject",\
-                                            "s3:PutObject",\
-                                            "s3:PutObjectAcl"\
-                                        ],\
-                                        "Resource": [\
-                                            "arn:aws:s3:::'+externalBucketName+'/*"\
-                                        ]\
-                                    }\
-                                ]\
-                            }',
-            Description='Grant access to an external S3 bucket'
-        )
-        targetPolicy = newPolicy['Policy']['Arn']
-        print("Policy - {} created\Policy ARN: {}".format(newPolicy['Policy']['PolicyName'], 
-                                                       newPolicy['Policy']['Arn']))
-
-    if not policyAttached:
-        response = iam.attach_role_policy(
-            RoleName='LambdaTextractRole',
+        try:
+            newPolicy = callWithRetry(iam.create_policy,
+                PolicyName=externalBucketName+'-bucketaccesspolicy',
+                PolicyDocument='{\
+                                    "Version": "2012-10-17",\
+                                    "Statement": [\
+                                        {\
+                                            "Effect": "Allow",\
+                                            "Action": [\
+                                                "s3:ListBucket",\
+                                                "s3:ListBucketVersions"\
+                                            ],\
+                                            "Resource": [\
+                                                "arn:aws:s3:::'+externalBucketName+'"\
+                                            ]\
+                                        },\
+                                        {\
+                                            "Effect": "Allow",\
+                                            "Action": [\
+                                                "s3:GetObject",\
+                                                "s3:GetGetObjectVersionObject",\
+                                                "s3:PutObject",\
+                                                "s3:PutObjectAcl"\
+                                            ],\
+                                            "Resource": [\
+                                                "arn:aws:s3:::'+externalBucketName+'/*"\
+                                            ]\
+                                        }\
+                                    ]\
+                                }',
+                Description='Grant access to an external S3 bucket'
+            )
+            targetPolicy = newPolicy['Policy']['Arn']
+            logger.info("Policy - %s created, Policy ARN: %s", newPolicy['Policy']['PolicyName'], newPolicy['Policy']['Arn'])
+        except Exception as e:
+            #Another submission created the policy since it was looked up
+            if errorCode(e) != 'EntityAlreadyExists' or policyArnFor(policyName) is None:
+                raise
+            targetPolicy = policyArnFor(policyName)
+        response = callWithRetry(iam.attach_role_policy,
+            RoleName=roleName,
             PolicyArn=targetPolicy
         )
-        
-    policies = iam.list_attached_role_policies(
-        RoleName=roleName,
-        MaxItems=100
-    )
-    print(policies) 
+        logger.info("Bucket Access Policy for %s attached to Role %s", externalBucketName, roleName)
+
+    bucketPolicyCache[externalBucketName] = (targetPolicy, time.time() + cacheTTL)
     return targetPolicy
     
 def detachExternalBucketPolicy(bucketAccessPolicyArn, event):
     
-    iam = boto3.client('iam')
+    iam = getClient('iam')
     roleName = os.environ['role_name']
     
     cleanUpAction = ""
@@ -94,28 +126,299 @@ def detachExternalBucketPolicy(bucketAccessPolicyArn, event):
         cleanUpAction = event['ExternalPolicyCleanup'].lower()
     
     if cleanUpAction == "detach" or cleanUpAction == "delete":
-        response = iam.detach_role_policy(
+        response = callWithRetry(iam.detach_role_policy,
             RoleName=roleName,
             PolicyArn=bucketAccessPolicyArn
         )
-        policies = iam.list_attached_role_policies(
-            RoleName=roleName,
-            MaxItems=10
-        )
-        print(policies)
+        logger.info("Policy - %s detached from Role %s", bucketAccessPolicyArn, roleName)
+        for externalBucketName, cached in list(bucketPolicyCache.items()):
+            if cached[0] == bucketAccessPolicyArn:
+                del bucketPolicyCache[externalBucketName]
     
     if cleanUpAction == "delete":    
-        iam.delete_policy(
+        callWithRetry(iam.delete_policy,
             PolicyArn=bucketAccessPolicyArn
         )
-        print("Policy - {} deleted".format(bucketAccessPolicyArn))    
+        logger.info("Policy - %s deleted", bucketAccessPolicyArn)    
+
+#Function to build the content identity of a document, from the ETag and size S3 reports for it or, with
+#content_identity set to sha256, from a hash of its bytes. Identities of different kinds never match.
+def documentContentId(s3, bucket, document, etag, size):
+    if os.environ.get('content_identity', 'etag').lower() == 'sha256':
+        digest = hashlib.sha256()
+        body = callWithRetry(s3.get_object, Bucket=bucket, Key=document)['Body']
+        for chunk in iter(lambda: body.read(1024*1024), b''):
+            digest.update(chunk)
+        return "sha256:{}".format(digest.hexdigest())
+    return "etag:{}:{}".format(etag.strip('"'), size)
+
+#Function to build the ClientRequestToken of one version of a document. Textract returns the same job for
+#a repeated token, so the token covers the content as well as the key, within Textract's 64 characters.
+def requestToken(tokenPrefix, bucket, document, contentId):
+    digest = hashlib.sha256("{}/{}#{}".format(bucket, document, contentId).encode('utf-8')).hexdigest()
+    return "{}-{}".format(tokenPrefix, digest)[:64]
+
+#Function to find a job that completed with text for a document of the same content, through the ContentIndex GSI
+def findCompletedJob(dynamodb, table_name, contentId):
+    queryArgs = {
+        'TableName': table_name,
+        'IndexName': 'ContentIndex',
+        'KeyConditionExpression': "ContentId = :content",
+        'FilterExpression': "JobStatus = :succeeded",
+        'ExpressionAttributeValues': {
+            ":content": {'S': contentId},
+            ":succeeded": {'S': 'SUCCEEDED'}
+        },
+        'ScanIndexForward': False
+    }
+    while True:
+        response = callWithRetry(dynamodb.query, **queryArgs)
+        for key in response['Items']:
+            item = callWithRetry(dynamodb.get_item, TableName=table_name, Key={'JobId': key['JobId'], 'JobType': key['JobType']}).get('Item')
+            if item is not None and len(item.get('TextFiles', {}).get('L', [])) > 0:
+                return item
+        if 'LastEvaluatedKey' not in response:
+            return None
+        queryArgs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+#Function to record a document as a copy of the completed job of an identical document, so that it is
+#retrieved like any other. The copy shares the output of the job and is keyed by the document version.
+def recordDuplicateJob(jobState, bucket, document, contentId, jobId, source):
+    document_name = document[document.rfind("/")+1:document.rfind(".")] if document.find("/") >= 0 else document[:document.rfind(".")]
+    item = dict((attribute, source[attribute]) for attribute in ('UploadPrefix', 'TextFiles', 'ManifestFile', 'IndexFile',
+        'OutputBucket', 'NumPages', 'NumLines', 'JobStatus', 'JobStartTimeStamp', 'JobCompleteTimeStamp') if attribute in source)
+    item.update({
+        'DocumentBucket': {'S':bucket},
+        'DocumentKey': {'S':document},
+        'DocumentPath': {'S':documentIndexPath(document, time.time())},
+        'DocumentName': {'S':document_name},
+        'DocumentType': {'S':document[document.rfind(".")+1:].upper()},
+        'ContentId': {'S':contentId},
+        'SourceJobId': {'S':source['JobId']['S']}
+    })
+    if 'OutputBucket' not in item:
+        item['OutputBucket'] = source['DocumentBucket']
+    jobState.put(jobId, item)
+    return item
+
+#Function to start a Textract text detection job, pacing every attempt by the batch rate limiter
+def startTextDetection(textract, bucket, document, token, jobTag, topicArn, roleArn, rateLimiter=None):
+    def startJob():
+        if rateLimiter is not None:
+            rateLimiter.acquire()
+        return textract.start_document_text_detection(
+                                ClientRequestToken = token,
+                                DocumentLocation={'S3Object': {'Bucket': bucket, 'Name': document}},
+                                NotificationChannel={'SNSTopicArn': topicArn,'RoleArn': roleArn},
+                                JobTag = jobTag)
+    with getMetrics().timer('TextractStart'):
+        return callWithRetry(startJob)
+
+pdfModule = None
+
+#Function to import pypdf on first use, None when it is not installed. pypdf is not part of the Lambda
+#runtime, and splitting is only turned on with split_pages once it is packaged with the function.
+def optionalPdf():
+    global pdfModule
+    if pdfModule is None:
+        try:
+            import pypdf
+            pdfModule = pypdf
+        except ImportError:
+            logger.warning("split_pages is set but pypdf is not packaged with the function, PDFs are submitted without splitting")
+            pdfModule = False
+    return pdfModule or None
+
+#Function to submit a large PDF as Textract jobs over page ranges of split_pages pages, started in parallel.
+#The chunks are tracked by a parent job record, keyed by the request token of the whole document, which
+#post-processing completes once every chunk is done. Returns None when the document is not split.
+def submitChunkedJob(bucket, document, size, token, contentId, tokenPrefix, topicArn, roleArn, jobState,
+                     textract, s3, rateLimiter):
+    chunkPages = int(os.environ.get('split_pages', '0'))
+    if chunkPages <= 0 or document[document.rfind(".")+1:].upper() != 'PDF' or size < int(os.environ.get('split_min_bytes', '1048576')):
+        return None
+    pdf = optionalPdf()
+    if pdf is None:
+        return None
+    metrics = getMetrics()
+    with metrics.timer('Split'):
+        reader = pdf.PdfReader(io.BytesIO(getObjectBytes(s3, bucket, document)))
+        numPages = len(reader.pages)
+    if numPages <= chunkPages:
+        return None
+
+    document_path = document[:document.rfind("/")] if document.find("/") >= 0 else ""
+    document_name = document[document.rfind("/")+1:document.rfind(".")] if document.find("/") >= 0 else document[:document.rfind(".")]
+    upload_prefix = token if document_path == "" else "{}/{}".format(document_path, token)
+    chunkBucket = os.environ.get('chunk_bucket', 'postprocessedbucket')
+    jobStartTimeStamp = time.time()
+    chunks = [(first, min(first + chunkPages - 1, numPages)) for first in range(1, numPages + 1, chunkPages)]
+
+    #The parent exists before any chunk can complete, and a resubmission keeps its progress
+    jobState.create(token, {
+        'DocumentBucket': {'S':bucket},
+        'DocumentKey': {'S':document},
+        'DocumentPath': {'S':documentIndexPath(document, jobStartTimeStamp)},
+        'UploadPrefix': {'S':upload_prefix},
+        'DocumentName': {'S':document_name},
+        'DocumentType': {'S':'PDF'},
+        'JobStartTimeStamp': {'N':str(jobStartTimeStamp)},
+        'JobCompleteTimeStamp': {'N':'0'},
+        'NumPages': {'N':'0'},
+        'NumLines': {'N':'0'},
+        'TextFiles': {'L':[]},
+        'ContentId': {'S':contentId},
+        'ChunkCount': {'N':str(len(chunks))},
+        'ChunksDone': {'N':'0'},
+        'ChunkPages': {'M':{}}
+    })
+
+    #Chunks are cut one at a time, pypdf readers are not thread safe, and uploaded and started in parallel
+    def chunkFiles():
+        for first, last in chunks:
+            writer = pdf.PdfWriter()
+            with metrics.timer('Split'):
+                for page in reader.pages[first-1:last]:
+                    writer.add_page(page)
+                body = io.BytesIO()
+                writer.write(body)
+            yield chunkFileKey(upload_prefix, document_name, first, last), body.getvalue()
+
+    def startChunk(chunkFile):
+        key, body = chunkFile
+        putObject(s3, chunkBucket, key, body)
+        return startTextDetection(textract, chunkBucket, key, requestToken(tokenPrefix, chunkBucket, key, contentId),
+                                  "{}-{}".format(tokenPrefix, document_name), topicArn, roleArn, rateLimiter)['JobId']
+
+    workers = max(int(os.environ.get('submit_workers', '8')), 1)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        chunkJobs = list(mapInOrder(executor, startChunk, chunkFiles(), workers))
+    logger.info("%s split into %d chunks of %d pages, parent job %s", document, len(chunks), chunkPages, token)
+    metrics.add('JobsSubmitted', len(chunkJobs))
+    metrics.add('DocumentsSplit')
+
+    jobState.update(token, {'ChunkJobs': {'L': [{'S': chunkJob} for chunkJob in chunkJobs]}})
+    return {
+        'TextDetectionJobId': token,
+        'ChunkJobIds': chunkJobs,
+        'DocumentBucket': bucket,
+        'DocumentKey': document,
+        'TextDetectionUploadPrefix': upload_prefix,
+        'DocumentName': document_name,
+        'DocumentType': 'PDF',
+        'TextDetectionJobStartTimeStamp': str(jobStartTimeStamp),
+        'TextDetectionJobCompleteTimeStamp': '0',
+        'NumPages': '0',
+        'NumLines': '0',
+        'TextFiles': []
+    }
+
+#Function to detect the text of a small image inline with DetectDocumentText, which answers without a job
+#or notification to wait for. The text is written and recorded as post-processing does for a job, under
+#a job keyed by the request token. Returns None for documents that go through an asynchronous job.
+def detectTextInline(bucket, document, size, token, contentId, jobState, textract, s3):
+    document_type = document[document.rfind(".")+1:].upper()
+    if document_type not in ('JPG', 'JPEG', 'PNG') or size > int(os.environ.get('sync_max_bytes', '5242880')):
+        return None
+    metrics = getMetrics()
+    document_path = document[:document.rfind("/")] if document.find("/") >= 0 else ""
+    document_name = document[document.rfind("/")+1:document.rfind(".")] if document.find("/") >= 0 else document[:document.rfind(".")]
+    upload_prefix = token if document_path == "" else "{}/{}".format(document_path, token)
+    output_bucket = os.environ.get('output_bucket', 'postprocessedbucket')
 
-def submitTextDetectionJob(bucket, document, tokenPrefix, retryInterval, maxRetryAttempt, topicArn, roleArn, table_name):
+    jobStartTimeStamp = time.time()
+    with metrics.timer('TextractDetect'):
+        response = callWithRetry(textract.detect_document_text, Document={'S3Object': {'Bucket': bucket, 'Name': document}})
+    num_pages = response['DocumentMetadata']['Pages']
 
-    s3 = boto3.resource('s3')
-    textract = boto3.client('textract')
-    dynamodb = boto3.client('dynamodb')    
-    retryCount = 0
+    words = os.environ.get('word_export', 'none').lower() == 'columnar'
+    with metrics.timer('Parse'):
+        blocks = groupBlocksByType(response['Blocks'])
+        document_text, num_lines = extractTextBody(blocks)
+        document_words = extractDocumentWords(blocks) if words else {}
+    writer = DocumentWriter(s3, output_bucket, upload_prefix, document_name, os.environ.get('output_layout', 'document').lower(),
+                            compress=os.environ.get('output_compression', 'none').lower() == 'gzip',
+                            index=os.environ.get('search_index', 'true').lower() == 'true', words=words)
+    for page_name in sorted(document_text.keys(), key=pageNumberFromName):
+        page_number = pageNumberFromName(page_name)
+        writer.writePage(page_number, document_text[page_name], document_words.get(page_number))
+    text_files, manifest_file = writer.close()
+    outputs = writer.outputFiles()
+
+    jobState.create(token, {
+        'DocumentBucket': {'S':bucket},
+        'DocumentKey': {'S':document},
+        'DocumentPath': {'S':documentIndexPath(document, jobStartTimeStamp)},
+        'UploadPrefix': {'S':upload_prefix},
+        'DocumentName': {'S':document_name},
+        'DocumentType': {'S':document_type},
+        'JobStartTimeStamp': {'N':str(jobStartTimeStamp)},
+        'JobCompleteTimeStamp': {'N':'0'},
+        'NumPages': {'N':'0'},
+        'NumLines': {'N':'0'},
+        'TextFiles': {'L':[]},
+        'ContentId': {'S':contentId}
+    })
+    jobCompleteTimeStamp = time.time()
+    completeJob(jobState, token, 'SUCCEEDED', jobCompleteTimeStamp, output_bucket, num_pages, num_lines,
+                writer, text_files, manifest_file, outputs)
+    logger.info("Text of %s detected inline, %d lines recorded as job %s", document, num_lines, token)
+    metrics.add('JobsInline')
+    metrics.add('Pages', num_pages)
+    metrics.add('Lines', num_lines)
+    return {
+        'TextDetectionJobId': token,
+        'DocumentBucket': bucket,
+        'DocumentKey': document,
+        'TextDetectionUploadPrefix': upload_prefix,
+        'DocumentName': document_name,
+        'DocumentType': document_type,
+        'TextDetectionJobStartTimeStamp': str(jobStartTimeStamp),
+        'TextDetectionJobCompleteTimeStamp': str(jobCompleteTimeStamp),
+        'NumPages': str(num_pages),
+        'NumLines': str(num_lines),
+        'TextFiles': text_files,
+        'OutputFiles': outputs
+    }
+
+#Function to log and count a failed submission, returning the response that reports it: the error code
+#when retrying cannot succeed, an empty response otherwise
+def failedSubmission(action, document, e):
+    logger.error("%s of %s failed, aborting: %s", action, document, e)
+    getMetrics().add('JobsFailed')
+    if errorCode(e) is not None and not isRetryable(e):
+        return {'Operation': 'TextDetection', 'Error': errorCode(e)}
+    return {}
+
+#Function to report a job whose record already existed with the values read back when it was created
+def reportExistingRecord(jsonresponse, item):
+    logger.info("Job record for %s already exists", jsonresponse['TextDetectionJobId'])
+    jsonresponse['JobStartTimeStamp'] = int(float(item['JobStartTimeStamp']['N']))
+    jsonresponse['JobCompleteTimeStamp'] = int(float(item['JobCompleteTimeStamp']['N']))
+    jsonresponse['NumPages'] = int(item['NumPages']['N'])
+    jsonresponse['NumLines'] = int(item['NumLines']['N'])
+    jsonresponse['TextFiles'] = [textFile['S'] for textFile in item['TextFiles']['L']]
+
+#Function to write the records of documents found to be copies, queued in jobState by the submissions. As no
+#job was started for them, a copy whose record could not be written is reported as a failure to retry.
+def writeJobRecords(jobState, responses):
+    unwritten = set(jobState.flush())
+    for jsonresponse in responses:
+        if 'SourceJobId' in jsonresponse and jsonresponse['TextDetectionJobId'] in unwritten:
+            getMetrics().add('JobsFailed')
+            jsonresponse.clear()
+
+#Function to submit one document. The job record is created as soon as the job is started, the record of a
+#copy of a processed document is left in jobState, for the caller to write with those of the other copies.
+def submitTextDetectionJob(bucket, document, tokenPrefix, topicArn, roleArn, table_name, jobState,
+                           textract=None, dynamodb=None, rateLimiter=None, s3=None, etag=None, size=None):
+
+    if textract is None:
+        textract = getClient('textract')
+    if dynamodb is None:
+        dynamodb = getClient('dynamodb')    
+    if s3 is None:
+        s3 = getClient('s3')
     jsonresponse = {}
     jobId = ""
     jobStartTimeStamp = 0
@@ -123,41 +426,82 @@ def submitTextDetectionJob(bucket, document, tokenPrefix, retryInterval, maxRetr
     document_path = document[:document.rfind("/")] if document.find("/") >= 0 else ""
     document_name = document[document.rfind("/")+1:document.rfind(".")] if document.find("/") >= 0 else document[:document.rfind(".")]
     document_type = document[document.rfind(".")+1:].upper()
+    metrics = getMetrics()
+
+    #Documents already processed under another key, or earlier under this one, reuse that result
+    try:
+        with metrics.timer('ContentLookup'):
+            if etag is None or size is None:
+                head = callWithRetry(s3.head_object, Bucket=bucket, Key=document)
+                etag, size = head['ETag'], head['ContentLength']
+            contentId = documentContentId(s3, bucket, document, etag, size)
+            token = requestToken(tokenPrefix, bucket, document, contentId)
+            source = findCompletedJob(dynamodb, table_name, contentId)
+        if source is not None:
+            #The request token names this version of the document, so resubmitting it rewrites the same record.
+            #Inline and split jobs are keyed by the token themselves, and a record found for this very version
+            #is reported as it is rather than replaced by a copy of itself.
+            jobId = token
+            if source['JobId']['S'] == token:
+                item = source
+                logger.info("%s was already processed as job %s, no new job started", document, token)
+            else:
+                item = recordDuplicateJob(jobState, bucket, document, contentId, jobId, source)
+                logger.info("%s has the content of job %s, no new job started", document, source['JobId']['S'])
+            metrics.add('JobsDeduplicated')
+            jsonresponse = {
+                'TextDetectionJobId': jobId,
+                'DocumentBucket': bucket,
+                'DocumentKey': document,
+                'TextDetectionUploadPrefix': item['UploadPrefix']['S'],
+                'DocumentName': document_name,
+                'DocumentType': document_type,
+                'TextDetectionJobStartTimeStamp': item['JobStartTimeStamp']['N'],
+                'TextDetectionJobCompleteTimeStamp': item['JobCompleteTimeStamp']['N'],
+                'NumPages': item['NumPages']['N'],
+                'NumLines': item['NumLines']['N'],
+                'TextFiles': [textFile['S'] for textFile in item['TextFiles']['L']]
+            }
+            if 'SourceJobId' in item:
+                jsonresponse['SourceJobId'] = item['SourceJobId']['S']
+            return jsonresponse
+    except Exception as e:
+        return failedSubmission("Content lookup", document, e)
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("TextDetectionJob: ClientRequestToken = %s", token)
+        logger.debug("TextDetectionJob: DocumentLocation = 'S3Object': 'Bucket': %s, 'Name': %s", bucket, document)
+        logger.debug("TextDetectionJob: NotificationChannel = 'SNSTopicArn': %s,'RoleArn': %s", topicArn, roleArn)
+        logger.debug("TextDetectionJob: JobTag = %s-%s", tokenPrefix, document[document.rfind("/")+1:document.rfind(".")])
 
-    print("TextDetectionsJob: ClientRequestToken = {}-{}".format(tokenPrefix, document.replace("/","_").replace(".","-")))
-    print("TextDetectionJob: DocumentLocation = 'S3Object': 'Bucket': {}, 'Name': {}".format(bucket, document))
-    print("TextDetectionJob: NotificationChannel = 'SNSTopicArn': {},'RoleArn': {}".format(topicArn, roleArn))
-    print("TextDetectionJob: JobTag = {}-{}".format(tokenPrefix, document[document.rfind("/")+1:document.rfind(".")]))
+    #Small images are answered inline, and large PDFs are split into page ranges that Textract works through in parallel
+    try:
+        inlineResponse = detectTextInline(bucket, document, size, token, contentId, jobState, textract, s3)
+        if inlineResponse is not None:
+            return inlineResponse
+    except Exception as e:
+        return failedSubmission("Inline text detection", document, e)
+    try:
+        chunkedResponse = submitChunkedJob(bucket, document, size, token, contentId, tokenPrefix, topicArn, roleArn, jobState,
+                                           textract, s3, rateLimiter)
+    except Exception as e:
+        return failedSubmission("Chunked submission", document, e)
+    if chunkedResponse is not None:
+        return chunkedResponse
     
-    #Submit Text Detection job to Textract to detect lines of text    
-    while retryCount >= 0 and retryCount < maxRetryAttempt:
-        try:
-            response = textract.start_document_text_detection(
-                                    ClientRequestToken = "{}-{}".format(tokenPrefix, document.replace("/","_").replace(".","-")),
-                                    DocumentLocation={'S3Object': {'Bucket': bucket, 'Name': document}},
-                                    NotificationChannel={'SNSTopicArn': topicArn,'RoleArn': roleArn},
-                                    JobTag = "{}-{}".format(tokenPrefix, document[document.rfind("/")+1:document.rfind(".")]))
-            jobId = response['JobId']
-            jobStartTimeStamp = datetime.strptime(response['ResponseMetadata']['HTTPHeaders']['date'], '%a, %d %b %Y %H:%M:%S %Z').timestamp()
-            print("Textract Request: {} submitted at {} with JobId - {}".format(
-                response['ResponseMetadata']['RequestId'], jobStartTimeStamp,jobId))    
-            
-            print("Starting Text Detection Job: {}".format(jobId))        
+    #Submit Text Detection job to Textract to detect lines of text
+    try:
+        response = startTextDetection(textract, bucket, document, token,
+                                      "{}-{}".format(tokenPrefix, document[document.rfind("/")+1:document.rfind(".")]),
+                                      topicArn, roleArn, rateLimiter)
+        jobId = response['JobId']
+        jobStartTimeStamp = datetime.strptime(response['ResponseMetadata']['HTTPHeaders']['date'], '%a, %d %b %Y %H:%M:%S %Z').timestamp()
+        logger.info("Textract Request: %s submitted at %s with JobId - %s",
+            response['ResponseMetadata']['RequestId'], jobStartTimeStamp, jobId)
+        metrics.add('JobsSubmitted')
 
-        except Exception as e:
-            print(e.response['Error'])
-            if e.response['Error']['Code'] == 'InvalidParameterException':
-                return {'Operation': 'TextDetection', 'Error': e.response['Error']['Code']}
-            elif retryCount < maxRetryAttempt - 1:
-                retryCount = retryCount + 1
-                print("Job submission failed, retrying after {} seconds".format(retryInterval))            
-                time.sleep(retryInterval)
-            else:
-                print("Job submission failed, after {} retry, aborting".format(maxRetryAttempt))
-                retryCount = -1
-                return jsonresponse
-        else:
-            retryCount = -1    
+    except Exception as e:
+        return failedSubmission("Job submission", document, e)
 
     if document_path == "":
         upload_prefix = jobId
@@ -177,53 +521,27 @@ def submitTextDetectionJob(bucket, document, tokenPrefix, retryInterval, maxRetr
     jsonresponse['TextFiles'] = []        
 
     
-    recordExists = False
-    
+    #Create the job record unless it already exists, reading back the previous values in the same keyed write
+    newRecord = {
+        'DocumentBucket': {'S':bucket},
+        'DocumentKey': {'S':document},
+        'DocumentPath': {'S':documentIndexPath(document, jobStartTimeStamp)},
+        'UploadPrefix': {'S':upload_prefix},
+        'DocumentName': {'S':document_name},
+        'DocumentType': {'S':document_type},
+        'JobStartTimeStamp': {'N':str(jobStartTimeStamp)},
+        'JobCompleteTimeStamp': {'N':'0'},
+        'NumPages': {'N':'0'},
+        'NumLines': {'N':'0'},
+        'TextFiles': {'L':[]},
+        'ContentId': {'S':contentId}
+    }
     try:
-        response = dynamodb.scan(
-            TableName=table_name,
-            ExpressionAttributeNames={'#ID': 'JobId', '#Type': 'JobType'},
-            ExpressionAttributeValues={':jobId' : {'S': jobId}, ':jobType' : {'S': 'TextDetection'}},
-            FilterExpression='#ID = :jobId and #Type = :jobType'
-        )                  
-        if response['Count'] > 0:
-            recordExists = True
-            item = response['Items'][-1]
-            jsonresponse['JobStartTimeStamp'] = int(item['JobStartTimeStamp']['N'])
-            jsonresponse['JobCompleteTimeStamp'] = int(item['JobCompleteTimeStamp']['N'])
-            jsonresponse['NumPages'] = int(item['NumPages']['N'])
-            jsonresponse['NumLines'] = int(item['NumLines']['N'])
-            textFiles = []
-            for textFile in item['TextFiles']['L']:
-                textFiles.append(textFile['S'])            
-            jsonresponse['TextFiles'] = textFiles                  
-            
+        item = jobState.create(jobId, newRecord)
+        if item is not None and 'TextFiles' in item:
+            reportExistingRecord(jsonresponse, item)
     except Exception as e:
-        print('DynamoDB Read Error is: {0}'.format(e))  
-    
-    if not recordExists:
-        try:
-            response = dynamodb.update_item(
-                TableName=table_name,
-                Key={
-                    'JobId':{'S':jobId},
-                    'JobType':{'S':'TextDetection'}
-                },
-                AttributeUpdates={
-                    'DocumentBucket':{'Value': {'S':bucket}},
-                    'DocumentKey':{'Value': {'S':document}},
-                    'UploadPrefix':{'Value': {'S':upload_prefix}},
-                    'DocumentName':{'Value': {'S':document_name}},
-                    'DocumentType':{'Value': {'S':document_type}},                        
-                    'JobStartTimeStamp':{'Value': {'N':str(jobStartTimeStamp)}},
-                    'JobCompleteTimeStamp':{'Value': {'N':'0'}},
-                    'NumPages':{'Value': {'N':'0'}},
-                    'NumLines':{'Value': {'N':'0'}},
-                    'TextFiles':{'Value': {'L':[]}}
-                }
-            )
-        except Exception as e:
-            print('DynamoDB Insertion Error is: {0}'.format(e))
+        logger.error('DynamoDB Insertion Error is: %s', e)
 
     return jsonresponse
         
@@ -246,53 +564,183 @@ def submitTextDetectionJob(bucket, document, tokenPrefix, retryInterval, maxRetr
 
 #         print(selected_entities)
 
+#Function to list the supported documents stored under an S3 prefix, after startAfter when it is given
+def listDocuments(s3, bucket, prefix, startAfter=None):
+    documents = []
+    listArgs = {'Bucket': bucket, 'Prefix': prefix}
+    if startAfter is not None:
+        listArgs['StartAfter'] = startAfter
+    while True:
+        s3_result = callWithRetry(s3.list_objects_v2, **listArgs)
+        for key in s3_result.get('Contents', []):
+            if key['Key'][key['Key'].rfind(".")+1:].upper() in supportedDocumentTypes:
+                documents.append((bucket, key['Key'], key.get('ETag'), key.get('Size')))
+        if not s3_result['IsTruncated']:
+            break
+        listArgs['ContinuationToken'] = s3_result['NextContinuationToken']
+    logger.info("%d documents found under s3://%s/%s", len(documents), bucket, prefix)
+    return documents
+
+#Function to submit many documents concurrently, at no more than the configured Textract start rate. No job
+#is started within submit_margin seconds of the invocation timing out, the response of a document left
+#over is None.
+def submitTextDetectionJobs(documents, tokenPrefix, topicArn, roleArn, table_name):
+    textract = getClient('textract')
+    dynamodb = getClient('dynamodb')
+    s3 = getClient('s3')
+    jobState = JobStateWriter(dynamodb, table_name)
+    rateLimiter = TokenBucket(float(os.environ.get('start_tps', '2')))
+    workers = min(int(os.environ.get('submit_workers', '8')), max(len(documents), 1))
+    margin = float(os.environ.get('submit_margin', '60'))
+
+    def submit(document):
+        remaining = remainingSeconds()
+        if remaining is not None and remaining < margin:
+            return None
+        return submitTextDetectionJob(document[0], document[1], tokenPrefix,
+                                      topicArn, roleArn, table_name, jobState,
+                                      textract=textract, dynamodb=dynamodb,
+                                      rateLimiter=rateLimiter, s3=s3,
+                                      etag=document[2], size=document[3])
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        responses = list(executor.map(submit, documents))
+    writeJobRecords(jobState, [response for response in responses if response is not None])
+    return responses
+
+#Function to hand the documents an invocation had no time left for to a new asynchronous invocation of this
+#function. A listed prefix is listed again from the first document left over, as the resubmission of a
+#document already started reuses its job, other documents are passed on as S3 event records.
+def continueDocuments(context, event, documents, leftOver):
+    if event.get('ExternalDocumentPrefix', '').endswith("/") and "Records" not in event:
+        continuation = dict(event)
+        first = documents.index(leftOver[0])
+        if first > 0:
+            continuation['StartAfter'] = documents[first - 1][1]
+    else:
+        continuation = dict((name, event[name]) for name in ('ExternalBucketName', 'ExternalPolicyCleanup') if name in event)
+        continuation['Records'] = [{'s3': {'bucket': {'name': bucket}, 'object': dict(
+            [('key', quote_plus(document, safe='/'))] + ([('eTag', etag), ('size', size)] if etag is not None and size is not None else []))}}
+            for bucket, document, etag, size in leftOver]
+    with getMetrics().timer('Continuation'):
+        callWithRetry(getClient('lambda').invoke,
+            FunctionName=context.invoked_function_arn,
+            InvocationType='Event',
+            Payload=json.dumps(continuation).encode('utf-8')
+        )
+
+#Function to tell whether a job submission response describes a started job
+def jobSubmitted(textDetectionResponse):
+    return 'Error' not in textDetectionResponse and textDetectionResponse.get('TextDetectionJobId', '') != ''
+
 def lambda_handler(event, context): 
-    print(event)
+    logger.debug("Event = %s", event)
+    beginInvocation(context)
+    metrics = getMetrics()
     
     #Initialize Boto Resource	
     table_name=os.environ['table_name']
     textDetectionTokenPrefix = os.environ['text_detection_token_prefix']  
     roleArn = os.environ['role_arn']
     textDetectionTopicArn = os.environ['text_detection_topic_arn']
-
-    retryInterval = int(os.environ['retry_interval']) #30
-    maxRetryAttempt = int(os.environ['max_retry_attempt']) #5
     
     external_bucket = ""
-    bucket = ""
-    document = ""
+    documents = []
+    batchTasks = None
     bucketAccessPolicyArn = None
     
     if 'ExternalBucketName' in event:
-        bucketAccessPolicyArn = attachExternalBucketPolicy(event['ExternalBucketName'])
+        with metrics.timer('PolicyResolution'):
+            bucketAccessPolicyArn = attachExternalBucketPolicy(event['ExternalBucketName'])
         external_bucket = event['ExternalBucketName']
         
+    #Keys arrive URL-encoded both in S3 event notifications and in S3 Batch Operations tasks
     if "Records" in event:        
-        record, = event["Records"]        
-        print(record)
-        bucket = record['s3']['bucket']['name']
-        document = record['s3']['object']['key']
-    else:
-        bucket = event['ExternalBucketName']
-        document = event['ExternalDocumentPrefix']   
+        for record in event["Records"]:
+            s3Object = record['s3']['object']
+            documents.append((record['s3']['bucket']['name'], unquote_plus(s3Object['key']), s3Object.get('eTag'), s3Object.get('size')))
+    elif "tasks" in event:
+        #S3 Batch Operations invocation
+        batchTasks = event['tasks']
+        for task in batchTasks:
+            #Tasks of schema 2.0 name the bucket, earlier ones give its ARN
+            bucket = task['s3Bucket'] if 's3Bucket' in task else task['s3BucketArn'][task['s3BucketArn'].rfind(":")+1:]
+            documents.append((bucket, unquote_plus(task['s3Key']), None, None))
+    elif event.get('ExternalDocumentPrefix', '').endswith("/"):
+        with metrics.timer('Listing'):
+            documents = listDocuments(getClient('s3'), external_bucket, event['ExternalDocumentPrefix'], event.get('StartAfter'))
+    elif external_bucket != "" and event.get('ExternalDocumentPrefix', '') != "":
+        documents.append((external_bucket, event['ExternalDocumentPrefix'], None, None))
         
-    if bucket == "" or  document == "":
-        print("Bucket and/or Document not specified, nothing to do.")
+    if len(documents) == 0:
+        logger.info("Bucket and/or Document not specified, nothing to do.")
+        metrics.emit()
         return {}
 
-    textDetectionResponse = submitTextDetectionJob(bucket, document, 
-                                                    textDetectionTokenPrefix, 
-                                                    retryInterval, maxRetryAttempt, 
-                                                    textDetectionTopicArn, 
-                                                    roleArn, table_name)
-    print("TextDetectionResponse = {}".format(textDetectionResponse))
-
-    jsonresponse = textDetectionResponse
-
-    if 'Error' in jsonresponse:
-        return jsonresponse
+    if len(documents) == 1 and batchTasks is None:
+        bucket, document, etag, size = documents[0]
+        jobState = JobStateWriter(getClient('dynamodb'), table_name)
+        jsonresponse = submitTextDetectionJob(bucket, document, 
+                                              textDetectionTokenPrefix, 
+                                              textDetectionTopicArn, 
+                                              roleArn, table_name, jobState,
+                                              etag=etag, size=size)
+        writeJobRecords(jobState, [jsonresponse])
+        logger.info("TextDetectionResponse = %s", jsonresponse)
+        if 'Error' in jsonresponse:
+            metrics.emit()
+            return jsonresponse
+    else:
+        responses = submitTextDetectionJobs(documents, textDetectionTokenPrefix, 
+                                            textDetectionTopicArn, 
+                                            roleArn, table_name)
+        leftOver = [document for document, response in zip(documents, responses) if response is None]
+        submitted = [response for response in responses if response is not None and jobSubmitted(response)]
+        logger.info("%d of %d text detection jobs submitted, %d left for lack of time", len(submitted), len(documents), len(leftOver))
+        #Batch Operations retries the tasks left over, other documents carry on in a new invocation. An
+        #invocation that started nothing is out of time before it began, and would continue forever.
+        continued = 0
+        if len(leftOver) > 0 and batchTasks is None:
+            if len(leftOver) < len(documents) and context is not None:
+                try:
+                    continueDocuments(context, event, documents, leftOver)
+                    continued = len(leftOver)
+                    metrics.add('Continuations')
+                except Exception as e:
+                    logger.error("Continuation of %d documents failed: %s", len(leftOver), e)
+            else:
+                logger.error("No time left to submit %d documents", len(leftOver))
+        if batchTasks is not None:
+            results = []
+            for task, response in zip(batchTasks, responses):
+                if response is None:
+                    results.append({'taskId': task['taskId'], 'resultCode': 'TemporaryFailure', 'resultString': 'Invocation out of time'})
+                elif jobSubmitted(response):
+                    results.append({'taskId': task['taskId'], 'resultCode': 'Succeeded', 'resultString': response['TextDetectionJobId']})
+                elif 'Error' in response:
+                    results.append({'taskId': task['taskId'], 'resultCode': 'PermanentFailure', 'resultString': response['Error']})
+                else:
+                    results.append({'taskId': task['taskId'], 'resultCode': 'TemporaryFailure', 'resultString': 'Job submission failed'})
+            jsonresponse = {
+                'invocationSchemaVersion': event['invocationSchemaVersion'],
+                'treatMissingKeysAs': 'PermanentFailure',
+                'invocationId': event['invocationId'],
+                'results': results
+            }
+        else:
+            jsonresponse = {
+                'Submitted': len(submitted),
+                'Failed': len(documents) - len(submitted) - continued,
+                'Continued': continued,
+                'Jobs': [response for response in responses if response is not None]
+            }
+        #The external bucket policy is cleaned up by the invocation that ends the work
+        if continued > 0:
+            bucketAccessPolicyArn = None
         
     if bucketAccessPolicyArn is not None:
         detachExternalBucketPolicy(bucketAccessPolicyArn, event)
         
+    metrics.add('Documents', len(documents))
+    metrics.emit()
     return jsonresponse
@@ -0,0 +1,224 @@
+import io
+import os
+import sys
+import gzip
+import json
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from textract_util import beginInvocation, getMetrics, logger, mapInOrder, groupBlocksByType, extractTextBody, extractDocumentWords, \
+    pageNumberFromName, PageAssembler, DocumentWriter
+
+responseExtensions = ('.json', '.jsonl', '.json.gz', '.jsonl.gz')
+
+#Stand-in for the S3 client that stores objects as files under <root>/<bucket>/<key>, the layout S3-compatible
+#stores such as MinIO serve from a directory. Objects appear under their final name only once complete.
+class LocalStore(object):
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, bucket, key):
+        return os.path.join(self.root, bucket, *key.split('/'))
+
+    def put_object(self, Bucket, Key, Body=b'', **kwargs):
+        path = self.path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.upload', 'wb') as f:
+            f.write(Body)
+        os.replace(path + '.upload', path)
+        return {}
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        path = self.path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path + '.upload', 'wb').close()
+        return {'UploadId': path + '.upload'}
+
+    #Parts are uploaded one after the other by S3StreamWriter, so they are appended in order
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        with open(UploadId, 'ab') as f:
+            f.write(Body)
+        return {'ETag': str(PartNumber)}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        os.replace(UploadId, self.path(Bucket, Key))
+        return {}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        if os.path.exists(UploadId):
+            os.remove(UploadId)
+        return {}
+
+    #Gzip encoded objects are told apart by their magic number, the only encoding the writers use
+    def get_object(self, Bucket, Key, **kwargs):
+        with open(self.path(Bucket, Key), 'rb') as f:
+            body = f.read()
+        response = {'Body': io.BytesIO(body)}
+        if body[:2] == b'\x1f\x8b':
+            response['ContentEncoding'] = 'gzip'
+        return response
+
+#Function to open a saved response file, undoing gzip compression while it is read
+def openResponses(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8')
+    return open(path, 'r', encoding='utf-8')
+
+#Function to strip the response extension from a file name, leaving the document name
+def documentNameFromFile(file_name):
+    for extension in sorted(responseExtensions, key=len, reverse=True):
+        if file_name.endswith(extension):
+            return file_name[:-len(extension)]
+    return file_name
+
+#Generator yielding the saved responses under a directory, or a single file, in a stable order
+def findResponseFiles(input_path):
+    if os.path.isfile(input_path):
+        yield input_path
+        return
+    for directory, subdirectories, files in os.walk(input_path):
+        subdirectories.sort()
+        for file_name in sorted(files):
+            if file_name.endswith(responseExtensions):
+                yield os.path.join(directory, file_name)
+
+#Generator grouping items into lists of up to size items, so that a task carries several small documents
+def batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+#Function to rebuild the output of one saved result. A .json file holds one DetectDocumentText or
+#GetDocumentTextDetection response, or a list of them, and is parsed whole like the buffered result mode.
+#A .jsonl file holds one response per line and is streamed like the streaming result mode, every page
+#being written as soon as its blocks are in, so the size of the file does not bound memory.
+def reprocessFile(store, path, input_root, bucket, options):
+    relative = os.path.relpath(path, input_root) if os.path.isdir(input_root) else os.path.basename(path)
+    document_path = os.path.dirname(relative).replace(os.sep, '/')
+    document_name = documentNameFromFile(os.path.basename(relative))
+    upload_prefix = "{}/{}".format(document_path, document_name) if document_path != "" else document_name
+    writer = DocumentWriter(store, bucket, upload_prefix, document_name, options['layout'], compress=options['compress'],
+                            index=options['index'], words=options['words'])
+    metrics = getMetrics()
+    with openResponses(path) as f:
+        if path.endswith(('.jsonl', '.jsonl.gz')):
+            assembler = PageAssembler(options['words'])
+            for line in f:
+                if line.strip() == "":
+                    continue
+                with metrics.timer('Parse'):
+                    completePages = assembler.addBlocks(json.loads(line).get('Blocks', []))
+                for page in completePages:
+                    with metrics.timer('Parse'):
+                        page_words = assembler.pageWords(page) if options['words'] else None
+                        page_text = assembler.popPage(page)
+                    writer.writePage(page.page, page_text, page_words)
+            for page in assembler.remainingPages():
+                logger.warning("Page-%d of %s is missing blocks", page.page, path)
+                page_words = assembler.pageWords(page) if options['words'] else None
+                writer.writePage(page.page, assembler.popPage(page), page_words)
+        else:
+            with metrics.timer('Parse'):
+                responses = json.load(f)
+                if not isinstance(responses, list):
+                    responses = [responses]
+                blocks = groupBlocksByType([block for response in responses for block in response.get('Blocks', [])])
+                document_text, num_lines = extractTextBody(blocks)
+                document_words = extractDocumentWords(blocks) if options['words'] else {}
+            for page_name in sorted(document_text.keys(), key=pageNumberFromName):
+                page_number = pageNumberFromName(page_name)
+                writer.writePage(page_number, document_text[page_name], document_words.get(page_number))
+    writer.close()
+    return {'Pages': len(writer.pages), 'Lines': writer.numLines,
+            'Bytes': sum(output['Size'] or 0 for output in writer.outputFiles())}
+
+#Function run in the worker processes to reprocess one batch of files, returning its totals. A failed
+#file is reported without affecting the rest of the batch.
+def reprocessBatch(task):
+    paths, input_root, output_root, bucket, options = task
+    beginInvocation()
+    store = LocalStore(output_root)
+    totals = {'Files': 0, 'Pages': 0, 'Lines': 0, 'BytesIn': 0, 'BytesOut': 0, 'Failures': []}
+    for path in paths:
+        try:
+            result = reprocessFile(store, path, input_root, bucket, options)
+        except Exception as e:
+            logger.error("Reprocessing of %s failed: %s", path, e)
+            totals['Failures'].append({'File': path, 'Error': str(e)})
+            continue
+        totals['Files'] += 1
+        totals['Pages'] += result['Pages']
+        totals['Lines'] += result['Lines']
+        totals['BytesIn'] += os.path.getsize(path)
+        totals['BytesOut'] += result['Bytes']
+    totals['Metrics'] = dict(getMetrics().values)
+    return totals
+
+#Function to format the throughput of the totals so far
+def throughput(totals, elapsed):
+    elapsed = max(elapsed, 1e-9)
+    return "{} files, {} pages, {} lines in {:.1f}s: {:.1f} files/s, {:.1f} pages/s, {:.2f} MB/s read, {} failed".format(
+        totals['Files'], totals['Pages'], totals['Lines'], elapsed, totals['Files'] / elapsed, totals['Pages'] / elapsed,
+        totals['BytesIn'] / elapsed / 1e6, len(totals['Failures']))
+
+def main():
+    parser = argparse.ArgumentParser(description='Rebuild text output from saved Textract responses (.json, .jsonl, optionally .gz) '
+                                                 'into a local directory laid out as <output>/<bucket>/<key>')
+    parser.add_argument('input', help='saved response file, or directory searched for them')
+    parser.add_argument('output', help='directory the output objects are written under')
+    parser.add_argument('--bucket', default='postprocessedbucket', help='bucket name the output is stored under')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='worker processes, all cores by default')
+    parser.add_argument('--batch', type=int, default=16, help='files handed to a worker at a time')
+    parser.add_argument('--output-layout', default=os.environ.get('output_layout', 'document').lower(), choices=('document', 'pages'))
+    parser.add_argument('--output-compression', default=os.environ.get('output_compression', 'none').lower(), choices=('none', 'gzip'))
+    parser.add_argument('--reading-order', default=os.environ.get('reading_order', 'none'), choices=('none', 'geometry'))
+    parser.add_argument('--search-index', default=os.environ.get('search_index', 'true').lower(), choices=('true', 'false'))
+    parser.add_argument('--word-export', default=os.environ.get('word_export', 'none').lower(), choices=('none', 'columnar'))
+    parser.add_argument('--progress', type=float, default=10, help='seconds between throughput reports, 0 for none')
+    args = parser.parse_args()
+
+    #Workers read the reading order from the environment like the functions do
+    os.environ['reading_order'] = args.reading_order
+    options = {
+        'layout': args.output_layout,
+        'compress': args.output_compression == 'gzip',
+        'index': args.search_index == 'true',
+        'words': args.word_export == 'columnar'
+    }
+    input_root = os.path.abspath(args.input)
+    output_root = os.path.abspath(args.output)
+    tasks = ((paths, input_root, output_root, args.bucket, options)
+             for paths in batches(findResponseFiles(input_root), max(args.batch, 1)))
+
+    totals = {'Files': 0, 'Pages': 0, 'Lines': 0, 'BytesIn': 0, 'BytesOut': 0, 'Failures': []}
+    phases = {}
+    start = time.time()
+    lastReport = start
+    workers = max(args.workers, 1)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        #Only a few batches per worker are queued, so the file list is never held in memory
+        for result in mapInOrder(executor, reprocessBatch, tasks, 4 * workers):
+            for name in ('Files', 'Pages', 'Lines', 'BytesIn', 'BytesOut'):
+                totals[name] += result[name]
+            totals['Failures'].extend(result['Failures'])
+            for name, value in result['Metrics'].items():
+                phases[name] = phases.get(name, 0) + value
+            if args.progress > 0 and time.time() - lastReport >= args.progress:
+                print(throughput(totals, time.time() - start), file=sys.stderr)
+                lastReport = time.time()
+
+    print(throughput(totals, time.time() - start))
+    print("{:.2f} MB written, worker time: {}".format(totals['BytesOut'] / 1e6, ", ".join(
+        "{} {:.1f}s".format(name[:-len('Time')], phases[name] / 1000) for name in sorted(phases.keys()) if name.endswith('Time'))))
+    for failure in totals['Failures']:
+        print("Failed: {File}: {Error}".format(**failure), file=sys.stderr)
+    return 1 if len(totals['Failures']) > 0 else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
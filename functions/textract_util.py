@@ -1,110 +1,1444 @@
 import os
+import re
+import sys
+import json
+import mmap
 import time
-from xml.dom import minidom
-from xml.etree import ElementTree
-from collections import defaultdict
-from collections import OrderedDict 
-from xml.etree.ElementTree import Element, SubElement, Comment, tostring
+import zlib
+import bisect
+import random
+import struct
+import logging
+import threading
+import contextlib
+from array import array
+from collections import deque, OrderedDict
+
+#Logger shared by the functions. Per-field, per-page and per-request detail is logged at DEBUG and
+#formatted lazily, so it costs nothing unless log_level enables it.
+logger = logging.getLogger('textract')
+logger.setLevel(os.environ.get('log_level', 'INFO').upper())
+
+#AWS clients shared by every invocation of a warm container, see getClient
+clientRegistry = {}
+clientRegistryLock = threading.Lock()
+
+#Function to build the botocore configuration used by all registry clients
+def clientConfig():
+    from botocore.config import Config
+    poolSize = int(os.environ.get('max_pool_connections', '50'))
+    #Retries are left to callWithRetry, so botocore makes a single attempt per call
+    retries = {'max_attempts': 0}
+    try:
+        return Config(max_pool_connections=poolSize, tcp_keepalive=True, retries=retries)
+    except TypeError:
+        #tcp_keepalive needs botocore 1.27.84 or later
+        return Config(max_pool_connections=poolSize, retries=retries)
+
+#Function to return a client ('client') or resource ('resource') for a service, created on first use
+#and reused by later invocations of the same container; boto3 is only imported when first needed
+def getClient(service, kind='client'):
+    client = clientRegistry.get((kind, service))
+    if client is None:
+        with clientRegistryLock:
+            client = clientRegistry.get((kind, service))
+            if client is None:
+                import boto3
+                if kind == 'resource':
+                    client = boto3.resource(service, config=clientConfig())
+                else:
+                    client = boto3.client(service, config=clientConfig())
+                clientRegistry[(kind, service)] = client
+    return client
+
+#Function to return the shared resource object for a service
+def getResource(service):
+    return getClient(service, 'resource')
+
+#Function to replace the registry entry for a service, e.g. with a local stand-in for benchmarks
+def registerClient(service, client, kind='client'):
+    with clientRegistryLock:
+        clientRegistry[(kind, service)] = client
+
+#Function to drop every registered client
+def resetClients():
+    with clientRegistryLock:
+        clientRegistry.clear()
+
+#Function to return the error code of a botocore ClientError, or None for other exceptions
+def errorCode(e):
+    return getattr(e, 'response', {}).get('Error', {}).get('Code')
+
+#Error codes returned when a request was throttled, and for transient service or network failures
+throttlingErrorCodes = frozenset([
+    'ThrottlingException', 'Throttling', 'ThrottledException', 'RequestThrottled', 'RequestThrottledException',
+    'TooManyRequestsException', 'ProvisionedThroughputExceededException', 'RequestLimitExceeded',
+    'LimitExceededException', 'SlowDown', 'EC2ThrottledException', 'BandwidthLimitExceeded'
+])
+transientErrorCodes = frozenset([
+    'InternalServerError', 'InternalError', 'InternalFailure', 'ServiceUnavailable', 'ServiceUnavailableException',
+    'RequestTimeout', 'RequestTimeoutException', 'PriorRequestNotComplete', 'TransactionInProgressException',
+    '500', '502', '503', '504'
+])
+transientExceptionNames = frozenset([
+    'EndpointConnectionError', 'ConnectionClosedError', 'ConnectTimeoutError', 'ReadTimeoutError',
+    'ConnectionError', 'ProxyConnectionError'
+])
+
+#Function to tell whether a failed call is worth retrying
+def isRetryable(e):
+    code = errorCode(e)
+    if code is not None:
+        return code in throttlingErrorCodes or code in transientErrorCodes
+    return type(e).__name__ in transientExceptionNames
+
+#Retries left to the current invocation and the time by which they must be done, shared by all threads
+class RetryBudget(object):
+    __slots__ = ('remaining', 'deadline', 'lock')
+
+    def __init__(self, remaining, deadline=None):
+        self.remaining = remaining
+        self.deadline = deadline
+        self.lock = threading.Lock()
+
+    #Function to take one retry from the budget, returning False once it is spent
+    def take(self):
+        with self.lock:
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            return True
+
+    #Function to tell whether a delay still leaves time before the deadline
+    def allows(self, delay):
+        return self.deadline is None or time.time() + delay < self.deadline
+
+#Timers and counters of one invocation, written as a single CloudWatch embedded metric format record.
+#Timers add up the milliseconds spent in a phase, so phases run by several threads report their total.
+class Metrics(object):
+    def __init__(self, dimensions=None):
+        self.namespace = os.environ.get('metrics_namespace', 'TextractPipeline')
+        self.dimensions = dimensions or {}
+        self.values = {}
+        self.units = {}
+        self.lock = threading.Lock()
+
+    #Function to add to a metric, creating it on first use
+    def add(self, name, value=1, unit='Count'):
+        with self.lock:
+            self.values[name] = self.values.get(name, 0) + value
+            self.units[name] = unit
+
+    #Context manager timing one pass through a phase, recorded as <phase>Time and <phase>Calls
+    @contextlib.contextmanager
+    def timer(self, phase):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = (time.perf_counter() - start) * 1000
+            with self.lock:
+                self.values[phase + 'Time'] = self.values.get(phase + 'Time', 0) + elapsed
+                self.units[phase + 'Time'] = 'Milliseconds'
+                self.values[phase + 'Calls'] = self.values.get(phase + 'Calls', 0) + 1
+                self.units[phase + 'Calls'] = 'Count'
+
+    #Function to build the embedded metric format record of the values collected so far
+    def record(self):
+        with self.lock:
+            names = sorted(self.values.keys())
+            record = {
+                '_aws': {
+                    'Timestamp': int(time.time() * 1000),
+                    'CloudWatchMetrics': [{
+                        'Namespace': self.namespace,
+                        'Dimensions': [sorted(self.dimensions.keys())],
+                        'Metrics': [{'Name': name, 'Unit': self.units[name]} for name in names]
+                    }]
+                }
+            }
+            record.update(self.dimensions)
+            for name in names:
+                record[name] = round(self.values[name], 3)
+        return record
+
+    #Function to write the record to stdout, where CloudWatch Logs extracts the metrics from it
+    def emit(self):
+        if len(self.values) > 0:
+            print(json.dumps(self.record(), separators=(',', ':')))
+
+retryBudget = RetryBudget(int(os.environ.get('retry_budget', '50')))
+invocationMetrics = Metrics()
+invocationDeadline = None
+
+#Function to start the retry budget and metrics of a Lambda invocation. Retries end a few seconds
+#before the invocation times out so the handler can still report what failed.
+def beginInvocation(context=None):
+    global retryBudget, invocationMetrics, invocationDeadline
+    deadline = None
+    invocationDeadline = None
+    dimensions = {}
+    if context is not None and hasattr(context, 'get_remaining_time_in_millis'):
+        invocationDeadline = time.time() + context.get_remaining_time_in_millis() / 1000.0
+        deadline = invocationDeadline - float(os.environ.get('retry_deadline_margin', '5'))
+    if context is not None and hasattr(context, 'function_name'):
+        dimensions['FunctionName'] = context.function_name
+    retryBudget = RetryBudget(int(os.environ.get('retry_budget', '50')), deadline)
+    invocationMetrics = Metrics(dimensions)
+    return retryBudget
+
+#Function to return the seconds left before the current invocation times out, None outside of Lambda
+def remainingSeconds():
+    if invocationDeadline is None:
+        return None
+    return invocationDeadline - time.time()
+
+#Function to return the metrics of the current invocation
+def getMetrics():
+    return invocationMetrics
+
+#Function to call an AWS API, retrying throttled and transient failures with full jitter exponential
+#backoff while the invocation's retry budget and remaining time allow it. Other errors are raised at once.
+def callWithRetry(operation, *args, **kwargs):
+    maxAttempts = int(os.environ.get('max_retry_attempt', '5'))
+    baseDelay = float(os.environ.get('retry_base_delay', '0.5'))
+    maxDelay = float(os.environ.get('retry_max_delay', '20'))
+    attempt = 0
+    while True:
+        try:
+            return operation(*args, **kwargs)
+        except Exception as e:
+            attempt = attempt + 1
+            if not isRetryable(e) or attempt >= maxAttempts:
+                raise
+            delay = random.uniform(0, min(maxDelay, baseDelay * (2 ** attempt)))
+            budget = retryBudget
+            if not budget.allows(delay) or not budget.take():
+                logger.warning("Retry budget of this invocation exhausted, not retrying %s", getattr(operation, '__name__', operation))
+                invocationMetrics.add('RetriesExhausted')
+                raise
+            logger.warning("%s failed with %s, retry %d of %d in %.2f seconds",
+                getattr(operation, '__name__', operation), errorCode(e) or type(e).__name__, attempt, maxAttempts - 1, delay)
+            invocationMetrics.add('Retries')
+            time.sleep(delay)
+
+#Compact record of a single Textract block, holding only the fields used downstream
+class BlockRecord(object):
+    __slots__ = ('blockId', 'blockType', 'page', 'text', 'confidence', 'bbox', 'childIds', 'parentId')
+
+    def __init__(self, block):
+        self.blockId = block['Id']
+        self.blockType = block['BlockType']
+        self.page = block.get('Page', 1)
+        self.text = block.get('Text')
+        self.confidence = block.get('Confidence')
+        self.bbox = None
+        if 'Geometry' in block:
+            box = block['Geometry']['BoundingBox']
+            self.bbox = (box['Left'], box['Top'], box['Width'], box['Height'])
+        self.childIds = ()
+        for relationship in block.get('Relationships', ()):
+            if relationship['Type'] == 'CHILD':
+                self.childIds = tuple(relationship['Ids'])
+                break
+        self.parentId = None
+
+#Index over Textract blocks with O(1) lookup by Id and PAGE->LINE->WORD traversal
+class BlockIndex(object):
+    __slots__ = ('byId', 'byType', 'pendingParents')
+
+    def __init__(self, responseBlocks=None):
+        self.byId = {}
+        self.byType = {}
+        self.pendingParents = {}
+        if responseBlocks is not None:
+            self.addBlocks(responseBlocks)
+
+    def addBlock(self, block):
+        record = BlockRecord(block)
+        self.byId[record.blockId] = record
+        if record.blockType not in self.byType:
+            self.byType[record.blockType] = {}
+        self.byType[record.blockType][record.blockId] = record
+
+        #Children may arrive before or after their parent across paginated responses
+        record.parentId = self.pendingParents.pop(record.blockId, None)
+        for childId in record.childIds:
+            child = self.byId.get(childId)
+            if child is not None:
+                child.parentId = record.blockId
+            else:
+                self.pendingParents[childId] = record.blockId
+        return record
+
+    def addBlocks(self, responseBlocks):
+        for block in responseBlocks:
+            self.addBlock(block)
+
+    def removeBlock(self, record):
+        self.byId.pop(record.blockId, None)
+        self.byType[record.blockType].pop(record.blockId, None)
+        for childId in record.childIds:
+            if self.pendingParents.get(childId) == record.blockId:
+                del self.pendingParents[childId]
+
+    def getBlock(self, blockId):
+        return self.byId.get(blockId)
+
+    def blocksOfType(self, blockType):
+        return list(self.byType.get(blockType, {}).values())
+
+    def childrenOf(self, record, blockType=None):
+        children = []
+        for childId in record.childIds:
+            child = self.byId.get(childId)
+            if child is not None and (blockType is None or child.blockType == blockType):
+                children.append(child)
+        return children
+
+    def parentOf(self, record):
+        if record.parentId is None:
+            return None
+        return self.byId.get(record.parentId)
+
+    def pageLines(self, page):
+        return self.childrenOf(page, 'LINE')
+
+    def lineWords(self, line):
+        return self.childrenOf(line, 'WORD')
+
+    #Dictionary style access by block type, as returned by earlier versions of groupBlocksByType
+    def __getitem__(self, blockType):
+        if blockType not in self.byType:
+            raise KeyError(blockType)
+        return self.blocksOfType(blockType)
+
+    def __contains__(self, blockType):
+        return blockType in self.byType
+
+    def __len__(self):
+        return len(self.byId)
+
+    def keys(self):
+        return self.byType.keys()
 
 #Function to group all block elements from textract response by type
 def groupBlocksByType(responseBlocks):
-    blocks = {}
-
-    for block in responseBlocks:
-        blocktype = block['BlockType']
-        if blocktype not in blocks.keys():
-            blocks[blocktype] = [block]
-        else:
-            blocks[blocktype].append(block)
-    print("Extracted Block Types:")
-    for blocktype in blocks.keys():
-        print("                       {} = {}".format(blocktype, len(blocks[blocktype])))
+    blocks = BlockIndex(responseBlocks)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Extracted Block Types: %s", ", ".join("{} = {}".format(blocktype, len(blocks.byType[blocktype])) for blocktype in blocks.keys()))
     return blocks
 
-#Function to retrieve result of completed analysis job
-def GetTextDetectionResult(textract, jobId):
+#Generator yielding the page count, blocks and NextToken of a completed text detection job, one response
+#at a time, optionally starting from the NextToken of an earlier read
+def iterTextDetectionResult(textract, jobId, paginationToken=None):
     maxResults = int(os.environ['max_results']) #1000
-    paginationToken = None
     finished = False 
-    retryInterval = int(os.environ['retry_interval']) #30
-    maxRetryAttempt = int(os.environ['max_retry_attempt']) #5
-
-    result = []
 
     while finished == False:
-        retryCount = 0
+        response = None
 
         try:
-            if paginationToken is None:
-                response = textract.get_document_text_detection(JobId=jobId,
-                                            MaxResults=maxResults)  
-            else:
-                response = textract.get_document_text_detection(JobId=jobId,
-                                                MaxResults=maxResults,
-                                                NextToken=paginationToken)
+            with invocationMetrics.timer('TextractFetch'):
+                if paginationToken is None:
+                    response = callWithRetry(textract.get_document_text_detection, JobId=jobId,
+                                                MaxResults=maxResults)  
+                else:
+                    response = callWithRetry(textract.get_document_text_detection, JobId=jobId,
+                                                    MaxResults=maxResults,
+                                                    NextToken=paginationToken)
         except Exception as e:
-            exceptionType = str(type(e))
-            if exceptionType.find("AccessDeniedException") > 0:
+            code = errorCode(e)
+            if code == "AccessDeniedException":
                 finished = True
-                print("You aren't authorized to perform textract.analyze_document action.")    
-            elif exceptionType.find("InvalidJobIdException") > 0:
+                logger.error("You aren't authorized to perform textract.get_document_text_detection action.")    
+            elif code == "InvalidJobIdException":
                 finished = True
-                print("An invalid job identifier was passed.")   
-            elif exceptionType.find("InvalidParameterException") > 0:
+                logger.error("An invalid job identifier was passed.")   
+            elif code == "InvalidParameterException":
                 finished = True
-                print("An input parameter violated a constraint.")        
+                logger.error("An input parameter violated a constraint.")        
             else:
-                if retryCount < maxRetryAttempt:
-                    retryCount = retryCount + 1
-                else:
-                    print(e)
-                    print("Result retrieval failed, after {} retry, aborting".format(maxRetryAttempt))                       
-                if exceptionType.find("InternalServerError") > 0:
-                    print("Amazon Textract experienced a service issue. Trying in {} seconds.".format(retryInterval))   
-                    time.sleep(retryInterval)
-                elif exceptionType.find("ProvisionedThroughputExceededException") > 0:
-                    print("The number of requests exceeded your throughput limit. Trying in {} seconds.".format(retryInterval*3))
-                    time.sleep(retryInterval*3)
-                elif exceptionType.find("ThrottlingException") > 0:
-                    print("Amazon Textract is temporarily unable to process the request. Trying in {} seconds.".format(retryInterval*6))
+                logger.error("Result retrieval failed, aborting: %s", e)
+                raise
+
+        if response is None:
+            continue
 
         #Get the text blocks
         blocks=[]
         if 'Blocks' in response:
             blocks=response['Blocks']
-            print ('Retrieved {} Blocks from Textract Text Detection response'.format(len(blocks)))      
+            logger.debug("Retrieved %d Blocks from Textract Text Detection response", len(blocks))
+            invocationMetrics.add('Blocks', len(blocks))
         else:
-            print("No blocks found in Textract Text Detection response, could be a result of unreadable document.")
+            logger.warning("No blocks found in Textract Text Detection response, could be a result of unreadable document.")
             finished = True           
 
-        # Display block information
-        for block in blocks:
-            result.append(block)
-            if 'NextToken' in response:
-                paginationToken = response['NextToken']
+        if 'NextToken' in response:
+            paginationToken = response['NextToken']
+        else:
+            paginationToken = None
+            finished = True  
+
+        num_pages = 0
+        if 'DocumentMetadata' in response:
+            num_pages = response['DocumentMetadata']['Pages']
+        yield num_pages, blocks, paginationToken
+
+#Function to retrieve result of completed analysis job
+def GetTextDetectionResult(textract, jobId):
+    num_pages = 0
+    result = []
+    for num_pages, blocks, paginationToken in iterTextDetectionResult(textract, jobId):
+        result.extend(blocks)
+    return num_pages, result
+
+#Collects streamed PAGE and LINE blocks and reports each page once all of its lines have arrived
+class PageAssembler(object):
+    __slots__ = ('index', 'missingBlocks', 'arrivals', 'responses', 'words')
+
+    def __init__(self, words=False):
+        self.index = BlockIndex()
+        self.missingBlocks = {}
+        self.arrivals = {}
+        self.responses = 0
+        self.words = words
+
+    #Function to count the words of a line not retrieved yet, none unless words are kept
+    def missingWords(self, line):
+        if not self.words:
+            return 0
+        return sum(1 for childId in line.childIds if childId not in self.index.byId)
+
+    #Function to add one response worth of blocks, returning the pages completed by them. token is
+    #the NextToken the response was read with, remembered for the blocks still held, see resumeToken.
+    #Blocks of the pages in skipPages, e.g. pages written before a resume, are left out. With words set
+    #the WORD blocks are kept as well, and a page is only complete once the words of its lines are in.
+    def addBlocks(self, responseBlocks, token=None, skipPages=()):
+        completed = []
+        self.responses += 1
+        blockTypes = ('PAGE', 'LINE', 'WORD') if self.words else ('PAGE', 'LINE')
+        for block in responseBlocks:
+            if block['BlockType'] not in blockTypes or block.get('Page') in skipPages:
+                continue
+            record = self.index.addBlock(block)
+            self.arrivals[record.blockId] = (self.responses, token)
+            if record.blockType == 'PAGE':
+                missing = 0
+                for childId in record.childIds:
+                    child = self.index.byId.get(childId)
+                    missing += 1 if child is None else self.missingWords(child)
+                self.missingBlocks[record.blockId] = missing
+                if missing == 0:
+                    completed.append(record)
+                continue
+            if record.blockType == 'LINE':
+                pageId = record.parentId
+                found = 1 - self.missingWords(record)
             else:
-                paginationToken = None
-                finished = True  
-    
-    if 'DocumentMetadata' not in response:
-        return 0, result      
-    return response['DocumentMetadata']['Pages'], result
+                line = self.index.parentOf(record)
+                pageId = line.parentId if line is not None else None
+                found = 1
+            if pageId in self.missingBlocks:
+                self.missingBlocks[pageId] -= found
+                if self.missingBlocks[pageId] == 0:
+                    completed.append(self.index.getBlock(pageId))
+        return completed
+
+    #Function to extract the lines and words of a completed page as columns, before popPage drops them
+    def pageWords(self, page):
+        return extractPageWords(self.index, page)
+
+    #Function to extract the text of a completed page and drop its blocks from memory
+    def popPage(self, page):
+        page_text = extractPageText(self.index, page)
+        for line in self.index.pageLines(page):
+            for word in self.index.lineWords(line):
+                self.index.removeBlock(word)
+                self.arrivals.pop(word.blockId, None)
+            self.index.removeBlock(line)
+            self.arrivals.pop(line.blockId, None)
+        self.index.removeBlock(page)
+        self.arrivals.pop(page.blockId, None)
+        self.missingBlocks.pop(page.blockId, None)
+        return page_text
+
+    #Function to return the NextToken a later read has to start from so that no block of a page that
+    #was not popped yet is lost: that of the oldest response still held, else nextToken
+    def resumeToken(self, nextToken):
+        if len(self.arrivals) == 0:
+            return nextToken
+        return min(self.arrivals.values())[1]
+
+    #Function to return pages still waiting on lines or words once the result has been fully read
+    def remainingPages(self):
+        return [self.index.getBlock(pageId) for pageId in list(self.missingBlocks.keys())]
+
+#Function to build the object name of a single page of text output
+def pageTextFileName(document_name, page_number):
+    return "{}-text-{:04d}.json".format(document_name, page_number)
+
+#Function to build the object name of the text output of a whole document
+def documentTextFileName(document_name):
+    return "{}-text.json".format(document_name)
+
+#Function to build the object name of the manifest describing the text output of a document
+def manifestFileName(document_name):
+    return "{}-manifest.json".format(document_name)
+
+#Function to build the object name of the search index of a document
+def indexFileName(document_name):
+    return "{}-index.json".format(document_name)
+
+#Function to build the object name of the columnar words of a single page
+def pageWordsFileName(document_name, page_number):
+    return "{}-words-{:04d}.bin".format(document_name, page_number)
+
+#Function to build the object name of the columnar words of a whole document
+def documentWordsFileName(document_name):
+    return "{}-words.bin".format(document_name)
+
+pageTextFilePattern = re.compile(r'-text-(\d+)\.json$')
+
+#Function to recover the page number from a single page text object, None for whole document output
+def pageNumberFromTextFile(text_file):
+    match = pageTextFilePattern.search(text_file)
+    if match is None:
+        return None
+    return int(match.group(1))
+
+#Function to build the key of the PDF holding one page range of a document split into chunks. Chunks are
+#stored under the upload prefix of the parent job, so a chunk's key leads back to its parent's output.
+def chunkFileKey(upload_prefix, document_name, first_page, last_page):
+    return "{}/chunks/{}-pages-{:05d}-{:05d}.pdf".format(upload_prefix, document_name, first_page, last_page)
+
+chunkFilePattern = re.compile(r'^((?:.*/)?([^/]+))/chunks/(.+)-pages-(\d+)-(\d+)\.pdf$')
+
+#Function to recover (upload_prefix, parent job, document name, first page) from the key of a chunk, None for other keys
+def chunkFromKey(key):
+    match = chunkFilePattern.match(key)
+    if match is None:
+        return None
+    return match.group(1), match.group(2), match.group(3), int(match.group(4))
+
+#Function to recover the page number from a "Page-NN" output key
+def pageNumberFromName(page_name):
+    return int(page_name[page_name.rfind("-")+1:])
+
+#Function to parse a page selection such as "2", "2-5", "7-" or "1,3,7-9" into inclusive ranges
+def parsePageRanges(pages):
+    if pages is None or str(pages).strip() == "":
+        return None
+    ranges = []
+    for part in str(pages).split(","):
+        part = part.strip()
+        if part == "":
+            continue
+        if "-" in part:
+            start, end = part.split("-", 1)
+            start = int(start) if start.strip() != "" else 1
+            end = int(end) if end.strip() != "" else None
+        else:
+            start = end = int(part)
+        if start < 1 or (end is not None and end < start):
+            raise ValueError("Invalid page range {}".format(part))
+        ranges.append((start, end))
+    return ranges
+
+#Function to check whether a page falls in the ranges returned by parsePageRanges
+def pageSelected(page_number, ranges):
+    if ranges is None:
+        return True
+    for start, end in ranges:
+        if page_number >= start and (end is None or page_number <= end):
+            return True
+    return False
+
+#Horizontal resolution of the line coverage histogram used to find text columns, the share of the
+#busiest bin a gutter may still be crossed by (always at least one line), and the narrowest gutter
+#as a share of the page width
+readingOrderBins = 200
+gutterCoverage = 0.05
+gutterMinWidth = 0.01
+
+numpyModule = None
+
+#Function to import numpy on first use, None when it is not installed
+def optionalNumpy():
+    global numpyModule
+    if numpyModule is None:
+        try:
+            import numpy
+            numpyModule = numpy
+        except ImportError:
+            logger.info("numpy is not installed, reading order is computed without it")
+            numpyModule = False
+    return numpyModule or None
+
+#Function to find the gutters between text columns in the horizontal line coverage of a page, as
+#(left, right) page positions. Gutters are inner runs of bins crossed by few lines, such as a heading.
+def findGutters(coverage):
+    threshold = max(1, max(coverage) * gutterCoverage)
+    busy = [i for i, count in enumerate(coverage) if count > threshold]
+    if len(busy) == 0:
+        return []
+    gutters = []
+    start = None
+    for i in range(busy[0], busy[-1] + 1):
+        if coverage[i] <= threshold:
+            if start is None:
+                start = i
+        else:
+            if start is not None and float(i - start) / len(coverage) >= gutterMinWidth:
+                gutters.append((float(start) / len(coverage), float(i) / len(coverage)))
+            start = None
+    return gutters
+
+#Function to build the coverage histogram and order key of the lines with numpy
+def readingOrderNumpy(np, boxes):
+    boxes = np.asarray(boxes, dtype=np.float64)
+    left, top = boxes[:, 0], boxes[:, 1]
+    right = left + boxes[:, 2]
+    bins = readingOrderBins
+    first = np.clip((left * bins).astype(np.int64), 0, bins - 1)
+    last = np.clip((right * bins).astype(np.int64), 0, bins - 1)
+    coverage = np.cumsum(np.bincount(first, minlength=bins+1) - np.bincount(last + 1, minlength=bins+1))[:bins]
+    gutters = findGutters(coverage.tolist())
+
+    spanning = np.zeros(len(boxes), dtype=bool)
+    for gutterLeft, gutterRight in gutters:
+        spanning |= (left <= gutterLeft) & (right >= gutterRight)
+    centers = np.array([(gutterLeft + gutterRight) / 2 for gutterLeft, gutterRight in gutters])
+    column = np.searchsorted(centers, (left + right) / 2)
+    #Lines spanning a gutter split the page into bands that are each read column by column
+    spanTops = np.sort(top[spanning])
+    band = 2 * np.searchsorted(spanTops, top)
+    band[spanning] += 1
+    column[spanning] = 0
+    return np.lexsort((left, top, column, band)).tolist()
+
+#Function to build the coverage histogram and order key of the lines without numpy
+def readingOrderPython(boxes):
+    bins = readingOrderBins
+    coverage = [0] * (bins + 1)
+    for box in boxes:
+        coverage[min(max(int(box[0] * bins), 0), bins - 1)] += 1
+        coverage[min(max(int((box[0] + box[2]) * bins), 0), bins - 1) + 1] -= 1
+    for i in range(1, bins + 1):
+        coverage[i] += coverage[i-1]
+    gutters = findGutters(coverage[:bins])
+
+    keys = []
+    spanTops = sorted(box[1] for box in boxes if any(box[0] <= gutterLeft and box[0] + box[2] >= gutterRight for gutterLeft, gutterRight in gutters))
+    for i, box in enumerate(boxes):
+        left, top, right = box[0], box[1], box[0] + box[2]
+        band = 2 * bisect.bisect_left(spanTops, top)
+        if any(left <= gutterLeft and right >= gutterRight for gutterLeft, gutterRight in gutters):
+            keys.append((band + 1, 0, top, left, i))
+        else:
+            column = sum(1 for gutterLeft, gutterRight in gutters if (gutterLeft + gutterRight) / 2 < (left + right) / 2)
+            keys.append((band, column, top, left, i))
+    return [key[-1] for key in sorted(keys)]
+
+#Function to order the lines of a page for reading from their bounding boxes, returning their indexes.
+#Text columns are found from gaps in the horizontal coverage of the lines and read top to bottom one
+#after the other, restarting below every line that spans them. Lines without geometry come last.
+def readingOrder(lines):
+    placed = [i for i, line in enumerate(lines) if line.bbox is not None]
+    unplaced = [i for i, line in enumerate(lines) if line.bbox is None]
+    if len(placed) == 0:
+        return unplaced
+    boxes = [lines[i].bbox for i in placed]
+    np = optionalNumpy()
+    order = readingOrderNumpy(np, boxes) if np is not None else readingOrderPython(boxes)
+    return [placed[i] for i in order] + unplaced
+
+#Function to extract lines of text from a single page of the block index. Lines keep the order of the
+#PAGE block; with reading_order set to geometry every line also records its position in reading order
+#as Order, next to its Text, so that the page holds nothing but its lines.
+def extractPageText(blocks, page):
+    page_text = {}
+    lines = blocks.pageLines(page)
+    for i, line in enumerate(lines):
+        page_text['Line-{0:04d}'.format(i+1)] = {'Text': line.text}
+    if os.environ.get('reading_order', 'none') == 'geometry' and len(lines) > 0:
+        with invocationMetrics.timer('Layout'):
+            for position, i in enumerate(readingOrder(lines)):
+                page_text['Line-{0:04d}'.format(i+1)]['Order'] = position + 1
+    return page_text
 
 #Function to extract lines of text from all pages from textract response
 def extractTextBody(blocks):
     total_line = 0
     document_text = {}
-    for page in blocks['PAGE']:
-        document_text['Page-{0:02d}'.format(page['Page'])] = {}
-        print("Page-{} contains {} Lines".format(page['Page'], len(page['Relationships'][0]['Ids'])))
-        total_line += len(page['Relationships'][0]['Ids'])
-        for i, line_id in enumerate(page['Relationships'][0]['Ids']):
-            page_line = None
-            for line in blocks['LINE']:
-                if line['Id'] == line_id:
-                    page_line = line
-                    break
-            document_text['Page-{0:02d}'.format(page['Page'])]['Line-{0:04d}'.format(i+1)] = {}
-            document_text['Page-{0:02d}'.format(page['Page'])]['Line-{0:04d}'.format(i+1)]['Text'] = page_line['Text']
-    print(total_line)
+    for page in blocks.blocksOfType('PAGE'):
+        page_text = extractPageText(blocks, page)
+        document_text['Page-{0:02d}'.format(page.page)] = page_text
+        logger.debug("Page-%d contains %d Lines", page.page, len(page_text))
+        total_line += len(page_text)
+    logger.debug("%d Lines extracted", total_line)
     return document_text, total_line
+
+#Layout of the columnar words: a 32 byte header of magic, version, row count and text size, then one
+#little-endian array per column and the offsets of every row's text, each starting at a multiple of 8
+#bytes, and last the UTF-8 text of all rows. Readers can view the columns in place, e.g. over mmap.
+wordColumnsMagic = b'RVWORDS\0'
+wordColumnsVersion = 1
+wordColumnsHeader = struct.Struct('<8sIII12x')
+uint32Code = 'I' if array('I').itemsize == 4 else 'L'
+wordColumnTypes = (
+    ('BlockType', 'B'),
+    ('Page', uint32Code),
+    ('Line', uint32Code),
+    ('Confidence', 'f'),
+    ('Left', 'f'),
+    ('Top', 'f'),
+    ('Width', 'f'),
+    ('Height', 'f')
+)
+wordBlockTypes = ('LINE', 'WORD')
+
+#Function to view a little-endian column of a buffer as an indexable sequence, without copying it
+#unless the host is big-endian
+def columnView(buffer, typecode):
+    if sys.byteorder == 'little':
+        return buffer.cast(typecode)
+    values = array(typecode, buffer.tobytes())
+    values.byteswap()
+    return values
+
+#Columns of the lines and words of a page or document, one row per block: its type (0 for LINE, 1 for
+#WORD), page, line number within the page, confidence and bounding box, missing values being NaN. The
+#words of a line follow it. Text is held in one string table, the text of row i being text[offsets[i]:
+#offsets[i+1]]. Tables are built with typed arrays, or read with fromBuffer as views of the stored bytes.
+class WordColumns(object):
+    __slots__ = ('columns', 'textOffsets', 'text')
+
+    def __init__(self):
+        self.columns = OrderedDict((name, array(typecode)) for name, typecode in wordColumnTypes)
+        self.textOffsets = array(uint32Code, [0])
+        self.text = bytearray()
+
+    def __len__(self):
+        return len(self.columns['BlockType'])
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    #Function to add one LINE or WORD block record as a row
+    def addRow(self, record, page_number, line_number):
+        bbox = record.bbox if record.bbox is not None else (float('nan'),) * 4
+        self.columns['BlockType'].append(wordBlockTypes.index(record.blockType))
+        self.columns['Page'].append(page_number)
+        self.columns['Line'].append(line_number)
+        self.columns['Confidence'].append(record.confidence if record.confidence is not None else float('nan'))
+        for name, value in zip(('Left', 'Top', 'Width', 'Height'), bbox):
+            self.columns[name].append(value)
+        self.text += (record.text or '').encode('utf-8')
+        self.textOffsets.append(len(self.text))
+
+    #Function to append the rows of another table
+    def extend(self, other):
+        for name, values in self.columns.items():
+            values.extend(other.columns[name])
+        base = self.textOffsets[-1]
+        self.textOffsets.extend(base + offset for offset in other.textOffsets[1:])
+        self.text += other.text
+
+    #Function to renumber the pages of the rows, e.g. from a chunk's job to the whole document
+    def offsetPages(self, offset):
+        self.columns['Page'] = array(uint32Code, (page + offset for page in self.columns['Page']))
+
+    #Function to return the text of one row
+    def rowText(self, i):
+        return bytes(self.text[self.textOffsets[i]:self.textOffsets[i+1]]).decode('utf-8')
+
+    #Function to return one row as a dictionary
+    def row(self, i):
+        row = dict((name, self.columns[name][i]) for name, typecode in wordColumnTypes)
+        row['BlockType'] = wordBlockTypes[row['BlockType']]
+        row['Text'] = self.rowText(i)
+        return row
+
+    #Function to serialize the table in the layout described above
+    def toBytes(self):
+        body = bytearray(wordColumnsHeader.pack(wordColumnsMagic, wordColumnsVersion, len(self), len(self.text)))
+        for values in list(self.columns.values()) + [self.textOffsets]:
+            body += bytes(-len(body) % 8)
+            if sys.byteorder != 'little':
+                values = array(values.typecode, values)
+                values.byteswap()
+            body += values.tobytes()
+        body += bytes(-len(body) % 8)
+        body += self.text
+        return bytes(body)
+
+    #Function to read a table from serialized bytes, a memoryview or an mmap, viewing its columns in place
+    @classmethod
+    def fromBuffer(cls, buffer):
+        view = memoryview(buffer)
+        magic, version, rows, textBytes = wordColumnsHeader.unpack_from(view)
+        if magic != wordColumnsMagic or version != wordColumnsVersion:
+            raise ValueError("Not a version {} word columns object".format(wordColumnsVersion))
+        table = cls.__new__(cls)
+        table.columns = OrderedDict()
+        offset = wordColumnsHeader.size
+        for name, typecode in wordColumnTypes + (('TextOffsets', uint32Code),):
+            offset += -offset % 8
+            size = array(typecode).itemsize * (rows + 1 if name == 'TextOffsets' else rows)
+            if offset + size > len(view):
+                raise ValueError("Word columns object is truncated")
+            table.columns[name] = columnView(view[offset:offset+size], typecode)
+            offset += size
+        table.textOffsets = table.columns.pop('TextOffsets')
+        offset += -offset % 8
+        if offset + textBytes > len(view):
+            raise ValueError("Word columns object is truncated")
+        table.text = view[offset:offset+textBytes]
+        return table
+
+#Function to memory map a columnar words file, returning a WordColumns over the mapped bytes
+def readWordColumns(path):
+    with open(path, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return WordColumns.fromBuffer(mapped)
+
+#Function to extract the lines of a single page of the block index, each followed by its words, as columns
+def extractPageWords(blocks, page):
+    table = WordColumns()
+    for i, line in enumerate(blocks.pageLines(page)):
+        table.addRow(line, page.page, i + 1)
+        for word in blocks.lineWords(line):
+            table.addRow(word, page.page, i + 1)
+    return table
+
+#Function to extract the columnar words of all pages of the block index, by page number
+def extractDocumentWords(blocks):
+    return dict((page.page, extractPageWords(blocks, page)) for page in blocks.blocksOfType('PAGE'))
+
+#Function to build the DocumentIndex sort key, so that the jobs of a document sort by start time
+def documentIndexPath(document, jobStartTimeStamp):
+    return "{}#{:012d}".format(document, int(float(jobStartTimeStamp)))
+
+#Function to split a DocumentIndex sort key back into the document key
+def documentFromIndexPath(documentPath):
+    return documentPath[:documentPath.rfind("#")]
+
+#Least recently used cache bounded by the total size of its values, as estimated by the caller.
+#Values larger than the whole cache are not kept.
+class LRUCache(object):
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value, size):
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.bytes -= previous[1]
+            if size > self.maxBytes:
+                return
+            self.entries[key] = (value, size)
+            self.bytes += size
+            while self.bytes > self.maxBytes:
+                evictedKey, evicted = self.entries.popitem(last=False)
+                self.bytes -= evicted[1]
+
+    def pop(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.bytes -= entry[1]
+                return entry[0]
+            return None
+
+    def __len__(self):
+        return len(self.entries)
+
+#Client side token bucket pacing calls made from any number of worker threads
+class TokenBucket(object):
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated', 'lock')
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity) if capacity is not None else max(self.rate, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    #Function to block until a token is available and take it
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+                wait = (1.0 - self.tokens) / self.rate
+            time.sleep(wait)
+
+#Generator applying fn to items on an executor, yielding results in order with at most window calls in flight
+def mapInOrder(executor, fn, items, window):
+    pending = deque()
+    try:
+        for item in items:
+            pending.append(executor.submit(fn, item))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while len(pending) > 0:
+            yield pending.popleft().result()
+    finally:
+        #Consumers may stop early, e.g. once a line limit is reached
+        for future in pending:
+            future.cancel()
+
+#Uploads a stream of bytes to S3 from memory, switching to a multipart upload once the data
+#outgrows a single part and optionally gzip encoding it on the way
+class S3StreamWriter(object):
+
+    def __init__(self, s3, bucket, key, compress=False, partSize=None, contentType='application/json'):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.partSize = max(partSize or int(os.environ.get('multipart_part_size', 8*1024*1024)), 5*1024*1024)
+        self.objectArgs = {'Bucket': bucket, 'Key': key, 'ContentType': contentType}
+        self.compressor = None
+        if compress:
+            self.compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            self.objectArgs['ContentEncoding'] = 'gzip'
+        self.buffer = bytearray()
+        self.uploadId = None
+        self.parts = []
+        self.bytesIn = 0
+        self.bytesOut = 0
+
+    def write(self, data):
+        self.bytesIn += len(data)
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        self.buffer += data
+        if len(self.buffer) >= self.partSize:
+            self.uploadPart()
+
+    def uploadPart(self):
+        if self.uploadId is None:
+            self.uploadId = callWithRetry(self.s3.create_multipart_upload, **self.objectArgs)['UploadId']
+        with invocationMetrics.timer('Upload'):
+            part = callWithRetry(self.s3.upload_part, Bucket=self.bucket, Key=self.key, UploadId=self.uploadId,
+                                 PartNumber=len(self.parts)+1, Body=bytes(self.buffer))
+        self.parts.append({'PartNumber': len(self.parts)+1, 'ETag': part['ETag']})
+        self.bytesOut += len(self.buffer)
+        invocationMetrics.add('BytesUploaded', len(self.buffer), 'Bytes')
+        self.buffer = bytearray()
+
+    #Function to finish the upload, returning the number of bytes stored in S3
+    def close(self):
+        try:
+            if self.compressor is not None:
+                self.buffer += self.compressor.flush()
+            if self.uploadId is None:
+                with invocationMetrics.timer('Upload'):
+                    callWithRetry(self.s3.put_object, Body=bytes(self.buffer), **self.objectArgs)
+                self.bytesOut += len(self.buffer)
+                invocationMetrics.add('BytesUploaded', len(self.buffer), 'Bytes')
+            else:
+                self.uploadPart()
+                with invocationMetrics.timer('Upload'):
+                    callWithRetry(self.s3.complete_multipart_upload, Bucket=self.bucket, Key=self.key, UploadId=self.uploadId,
+                                  MultipartUpload={'Parts': self.parts})
+        except Exception:
+            self.abort()
+            raise
+        return self.bytesOut
+
+    #Function to discard a multipart upload that will not be completed
+    def abort(self):
+        if self.uploadId is not None:
+            callWithRetry(self.s3.abort_multipart_upload, Bucket=self.bucket, Key=self.key, UploadId=self.uploadId)
+            self.uploadId = None
+
+#Function to upload one in-memory object, returning the number of bytes stored in S3
+def putObject(s3, bucket, key, body, compress=False):
+    stream = S3StreamWriter(s3, bucket, key, compress)
+    try:
+        stream.write(body)
+    except Exception:
+        stream.abort()
+        raise
+    return stream.close()
+
+#Function to build the URL of an object
+def objectUrl(bucket, key):
+    return "https://s3.amazonaws.com/{}/{}".format(bucket, key)
+
+#Function to read an object written by S3StreamWriter or putObject, undoing any gzip encoding
+def getObjectBytes(s3, bucket, key, **getArgs):
+    return readObject(s3, bucket, key, **getArgs)[0]
+
+#Function to read an object like getObjectBytes, also returning its ETag for later conditional reads
+def readObject(s3, bucket, key, **getArgs):
+    s3_response = callWithRetry(s3.get_object, Bucket=bucket, Key=key, **getArgs)
+    body = s3_response['Body'].read()
+    if s3_response.get('ContentEncoding') == 'gzip':
+        body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    return body, s3_response.get('ETag')
+
+#Function to tell whether a conditional read failed only because the object is unchanged
+def notModified(e):
+    return errorCode(e) in ('304', 'NotModified')
+
+#Index terms are runs of letters and digits, compared in lower case
+termPattern = re.compile(r'\w+', re.UNICODE)
+
+#Function to split text into index terms
+def tokenize(text):
+    return termPattern.findall(text.lower())
+
+#Inverted index of the text of one document. Each term maps to a flat list of (page, line, position)
+#triples, sorted, where line is the number of its Line-NNNN entry and position counts terms in the line.
+class TermIndex(object):
+    def __init__(self):
+        self.postings = {}
+
+    #Function to add the terms of one page of extracted text
+    def addPage(self, page_number, page_text):
+        for line_name, line in page_text.items():
+            if not line_name.startswith('Line-'):
+                continue
+            line_number = int(line_name[5:])
+            for position, term in enumerate(tokenize(line['Text'])):
+                postings = self.postings.get(term)
+                if postings is None:
+                    postings = self.postings[term] = []
+                postings.extend((page_number, line_number, position))
+
+    #Function to serialize the index, triples of each term in page and line order
+    def toJson(self, document_name):
+        terms = {}
+        for term, postings in self.postings.items():
+            triples = sorted(zip(postings[0::3], postings[1::3], postings[2::3]))
+            terms[term] = [value for triple in triples for value in triple]
+        return json.dumps({'DocumentName': document_name, 'Terms': terms}, separators=(',', ':'), sort_keys=True).encode('utf-8')
+
+#Function to find the (page, line) pairs of an index holding every term of a query, or the terms
+#in sequence when phrase is set. terms maps each term to its flat list of postings.
+def searchTerms(terms, query, phrase=False):
+    queryTerms = tokenize(query)
+    if len(queryTerms) == 0:
+        return []
+    matches = None
+    for offset, term in enumerate(queryTerms):
+        postings = terms.get(term)
+        if postings is None:
+            return []
+        if phrase:
+            found = set(zip(postings[0::3], postings[1::3], [position - offset for position in postings[2::3]]))
+        else:
+            found = set(zip(postings[0::3], postings[1::3]))
+        matches = found if matches is None else matches & found
+        if len(matches) == 0:
+            return []
+    return sorted(set(match[:2] for match in matches))
+
+#Writes the text output of one job to S3, either as one compact object per page or as a single
+#document streamed page by page, followed by a manifest listing every page with its line count,
+#location and size. Document layout offsets let readers fetch single pages with ranged GETs. With
+#index set, a TermIndex of the text is written before the manifest, which names it as IndexFile.
+#A writer for one chunk of a split document adds pageOffset to the page numbers of the chunk's job.
+#Every object written is remembered with its stored size, so the output is known without listing it.
+#With words set the lines and words of every page are also written as WordColumns, one object per page
+#or per document as for the text, never compressed so that they can be memory mapped once downloaded.
+class DocumentWriter(object):
+
+    def __init__(self, s3, bucket, upload_prefix, document_name, layout='document', executor=None, maxPending=8,
+                 compress=False, index=False, pageOffset=0, words=False):
+        if layout not in ('pages', 'document'):
+            raise ValueError("Unknown output layout {}".format(layout))
+        self.s3 = s3
+        self.bucket = bucket
+        self.upload_prefix = upload_prefix
+        self.document_name = document_name
+        self.layout = layout
+        self.executor = executor
+        self.maxPending = maxPending
+        self.compress = compress
+        self.pending = deque()
+        self.stored = OrderedDict()
+        self.pages = {}
+        self.stream = None
+        self.numLines = 0
+        self.index = TermIndex() if index else None
+        self.index_file = None
+        self.resumedPages = []
+        self.pageOffset = pageOffset
+        self.words = words
+        self.wordTables = {}
+        self.word_files = []
+
+    #Tells whether a page, numbered as in the job being written, has been written
+    def __contains__(self, page_number):
+        return page_number + self.pageOffset in self.pages
+
+    def key(self, file_name):
+        return "{}/{}".format(self.upload_prefix, file_name)
+
+    def upload(self, key, body, compress):
+        if self.executor is None:
+            self.stored[key] = putObject(self.s3, self.bucket, key, body, compress)
+            return
+        #Bound the serialized pages held in memory while their uploads are in flight
+        while len(self.pending) >= self.maxPending:
+            self.pending.popleft().result()
+        self.pending.append(self.executor.submit(putObject, self.s3, self.bucket, key, body, compress))
+        self.stored[key] = self.pending[-1]
+
+    #Function to return the size an object takes in S3, None when it is not known
+    def storedSize(self, key):
+        size = self.stored.get(key)
+        return size.result() if hasattr(size, 'result') else size
+
+    #Function to add the lines of one page, and with words set its WordColumns, uploading or streaming it
+    #out straight away. The writer takes over the WordColumns given to it.
+    def writePage(self, page_number, page_text, words=None):
+        page_number += self.pageOffset
+        page_name = 'Page-{0:02d}'.format(page_number)
+        if self.words:
+            words = words if words is not None else WordColumns()
+            if self.pageOffset != 0:
+                words.offsetPages(self.pageOffset)
+            if self.layout == 'pages':
+                with invocationMetrics.timer('Serialize'):
+                    body = words.toBytes()
+                self.upload(self.key(pageWordsFileName(self.document_name, page_number)), body, False)
+            else:
+                self.wordTables[page_number] = words
+        entry = {'Page': page_number, 'Lines': len(page_text)}
+        self.numLines += entry['Lines']
+        if self.index is not None:
+            with invocationMetrics.timer('Index'):
+                self.index.addPage(page_number, page_text)
+        if self.layout == 'pages':
+            with invocationMetrics.timer('Serialize'):
+                body = json.dumps({page_name: page_text}, separators=(',', ':')).encode('utf-8')
+            entry['Key'] = self.key(pageTextFileName(self.document_name, page_number))
+            entry['Bytes'] = len(body)
+            self.upload(entry['Key'], body, self.compress)
+        else:
+            #Pages are appended in arrival order, readers must not rely on key order
+            entry['Key'] = self.key(documentTextFileName(self.document_name))
+            if self.stream is None:
+                self.stream = S3StreamWriter(self.s3, self.bucket, entry['Key'], self.compress)
+                prefix = '{'
+            else:
+                prefix = ','
+            with invocationMetrics.timer('Serialize'):
+                body = json.dumps(page_text, separators=(',', ':')).encode('utf-8')
+            try:
+                self.stream.write('{}"{}":'.format(prefix, page_name).encode('utf-8'))
+                entry['Offset'] = self.stream.bytesIn
+                entry['Bytes'] = len(body)
+                self.stream.write(body)
+            except Exception:
+                self.stream.abort()
+                raise
+        self.pages[page_number] = entry
+
+    #Function to describe the pages written so far as [page, lines, bytes, stored bytes] entries, once their
+    #uploads are done. Only single page objects can be resumed, a streamed document is written in one go.
+    def checkpoint(self):
+        if self.layout != 'pages':
+            raise ValueError("Output layout {} cannot be checkpointed".format(self.layout))
+        self.wait()
+        return [[entry['Page'], entry['Lines'], entry['Bytes'], self.storedSize(entry['Key'])] for entry in self.pages.values()]
+
+    #Function to take over the pages written by an earlier invocation, as returned by checkpoint. Checkpoints
+    #saved before stored sizes were recorded have three entries per page.
+    def resume(self, pages):
+        for page in pages:
+            page_number, lines, size = page[:3]
+            key = self.key(pageTextFileName(self.document_name, page_number))
+            self.pages[page_number] = {'Page': page_number, 'Lines': lines, 'Key': key, 'Bytes': size}
+            self.stored[key] = page[3] if len(page) > 3 else None
+            if self.words:
+                self.stored[self.key(pageWordsFileName(self.document_name, page_number))] = None
+            self.numLines += lines
+            self.resumedPages.append(page_number)
+
+    #Function to upload the remaining output and the manifest, returning the text files and manifest key
+    def close(self):
+        if len(self.pages) == 0:
+            return [], None
+        if self.stream is not None:
+            try:
+                self.stream.write(b'}')
+            except Exception:
+                self.stream.abort()
+                raise
+            self.stored[self.stream.key] = self.stream.close()
+            self.stream = None
+
+        lineOffset = 0
+        manifestPages = []
+        for page_number in sorted(self.pages.keys()):
+            entry = self.pages[page_number]
+            entry['LineOffset'] = lineOffset
+            lineOffset += entry['Lines']
+            manifestPages.append(entry)
+        text_files = []
+        for entry in manifestPages:
+            if len(text_files) == 0 or text_files[-1] != entry['Key']:
+                text_files.append(entry['Key'])
+        if self.words:
+            if self.layout == 'pages':
+                self.word_files = [self.key(pageWordsFileName(self.document_name, entry['Page'])) for entry in manifestPages]
+            else:
+                #Pages arrive in any order, the document's rows are kept in page order
+                words = WordColumns()
+                for page_number in sorted(self.wordTables.keys()):
+                    words.extend(self.wordTables.pop(page_number))
+                self.word_files = [self.key(documentWordsFileName(self.document_name))]
+                with invocationMetrics.timer('Serialize'):
+                    body = words.toBytes()
+                self.upload(self.word_files[0], body, False)
+
+        manifest = {
+            'DocumentName': self.document_name,
+            'Layout': self.layout,
+            'ContentEncoding': 'gzip' if self.compress else 'identity',
+            'NumPages': len(manifestPages),
+            'NumLines': self.numLines,
+            'Pages': manifestPages
+        }
+        if self.words:
+            manifest['WordFiles'] = self.word_files
+        if self.index is not None:
+            #Pages written by earlier invocations are read back for their terms
+            def readPage(page_number):
+                return page_number, getObjectBytes(self.s3, self.bucket, self.pages[page_number]['Key'])
+            if self.executor is None:
+                resumed = map(readPage, self.resumedPages)
+            else:
+                resumed = mapInOrder(self.executor, readPage, self.resumedPages, self.maxPending)
+            for page_number, body in resumed:
+                with invocationMetrics.timer('Index'):
+                    for page_text in json.loads(body).values():
+                        self.index.addPage(page_number, page_text)
+            with invocationMetrics.timer('Index'):
+                body = self.index.toJson(self.document_name)
+            self.index_file = self.key(indexFileName(self.document_name))
+            self.upload(self.index_file, body, self.compress)
+            manifest['IndexFile'] = self.index_file
+        manifest_file = self.key(manifestFileName(self.document_name))
+        self.upload(manifest_file, json.dumps(manifest, separators=(',', ':')).encode('utf-8'), False)
+        return text_files, manifest_file
+
+    #Function to wait for every upload started by the writer, raising the first failure
+    def wait(self):
+        while len(self.pending) > 0:
+            self.pending.popleft().result()
+
+    #Function to list the objects written, as Bucket, Key, Size and Url, once their uploads are done
+    def outputFiles(self):
+        self.wait()
+        return [{'Bucket': self.bucket, 'Key': key, 'Size': self.storedSize(key), 'Url': objectUrl(self.bucket, key)}
+                for key in self.stored.keys()]
+
+#Function to count the keys or write requests of a batch request
+def batchSize(requestItems):
+    return sum(len(requests['Keys']) if 'Keys' in requests else len(requests) for requests in requestItems.values())
+
+#Function to run a batch request until DynamoDB has processed all of it, backing off between attempts as
+#callWithRetry does. Attempts are only counted while DynamoDB makes no progress, a throttled table still
+#processes part of every batch. Returns the responses and whatever is left once attempts or budget run out.
+def batchWithRetry(operation, requestItems, unprocessedKey):
+    maxAttempts = int(os.environ.get('max_retry_attempt', '5'))
+    baseDelay = float(os.environ.get('retry_base_delay', '0.5'))
+    maxDelay = float(os.environ.get('retry_max_delay', '20'))
+    responses = []
+    attempt = 0
+    while True:
+        requested = batchSize(requestItems)
+        response = callWithRetry(operation, RequestItems=requestItems)
+        responses.append(response)
+        requestItems = response.get(unprocessedKey) or {}
+        unprocessed = batchSize(requestItems)
+        if unprocessed == 0:
+            return responses, requestItems
+        attempt = 1 if unprocessed < requested else attempt + 1
+        if attempt >= maxAttempts:
+            return responses, requestItems
+        delay = random.uniform(0, min(maxDelay, baseDelay * (2 ** attempt)))
+        if not retryBudget.allows(delay) or not retryBudget.take():
+            invocationMetrics.add('RetriesExhausted')
+            return responses, requestItems
+        logger.warning("%s left %d of %d requests unprocessed, retrying in %.2f seconds",
+            getattr(operation, '__name__', operation), unprocessed, requested, delay)
+        invocationMetrics.add('UnprocessedRetries')
+        time.sleep(delay)
+
+#Writes the job records of an invocation. The submit and post-process functions change the same records at
+#the same time, so records are created and the outcome of a job recorded with single atomic update_item
+#calls: create only sets the attributes a record does not have yet, and update appends the text files of a
+#job only when the record does not list them already, so that a redelivered notification leaves them as
+#they were. Only blind writes, whole records that replace any earlier one and deletions, are queued for
+#flush to coalesce into BatchWriteItem calls.
+class JobStateWriter(object):
+    maxBatchWrite = 25
+
+    def __init__(self, dynamodb, table_name, jobType='TextDetection'):
+        self.dynamodb = dynamodb
+        self.table_name = table_name
+        self.jobType = jobType
+        self.requests = OrderedDict()
+        self.lock = threading.Lock()
+
+    def key(self, jobId):
+        return {'JobId': {'S': jobId}, 'JobType': {'S': self.jobType}}
+
+    #Function to create a job record unless it already exists, returning the previous values read back in the same keyed write
+    def create(self, jobId, record):
+        attributeNames = {}
+        attributeValues = {}
+        updates = []
+        for i, attribute in enumerate(record.keys()):
+            attributeNames['#a{}'.format(i)] = attribute
+            attributeValues[':v{}'.format(i)] = record[attribute]
+            updates.append('#a{0} = if_not_exists(#a{0}, :v{0})'.format(i))
+        with getMetrics().timer('DynamoDBUpdate'):
+            response = callWithRetry(self.dynamodb.update_item,
+                TableName=self.table_name,
+                Key=self.key(jobId),
+                ExpressionAttributeNames=attributeNames,
+                ExpressionAttributeValues=attributeValues,
+                UpdateExpression='SET ' + ', '.join(updates),
+                ReturnValues='UPDATED_OLD'
+            )
+        return response.get('Attributes')
+
+    #Function to set and remove attributes of a job record and append text files to its TextFiles in one write.
+    #When the record already lists the text files only the attributes are written, and False is returned.
+    def update(self, jobId, values, remove=(), text_files=()):
+        attributeNames = {}
+        attributeValues = {}
+        updates = []
+        for i, attribute in enumerate(values.keys()):
+            attributeNames['#a{}'.format(i)] = attribute
+            attributeValues[':v{}'.format(i)] = values[attribute]
+            updates.append('#a{0} = :v{0}'.format(i))
+        updateArgs = {}
+        if len(text_files) > 0:
+            attributeNames['#tf'] = 'TextFiles'
+            attributeValues[':text_files'] = {'L': [{'S': text_file} for text_file in text_files]}
+            attributeValues[':no_files'] = {'L': []}
+            attributeValues[':text_file'] = {'S': text_files[0]}
+            updates.append('#tf = list_append(if_not_exists(#tf, :no_files), :text_files)')
+            updateArgs['ConditionExpression'] = 'attribute_not_exists(#tf) OR NOT contains(#tf, :text_file)'
+        updateExpression = 'SET ' + ', '.join(updates) if len(updates) > 0 else ''
+        removed = [attribute for attribute in remove if attribute not in values]
+        if len(removed) > 0:
+            for i, attribute in enumerate(removed):
+                attributeNames['#r{}'.format(i)] = attribute
+            updateExpression += ' REMOVE ' + ', '.join('#r{}'.format(i) for i in range(len(removed)))
+        if len(attributeValues) > 0:
+            updateArgs['ExpressionAttributeValues'] = attributeValues
+        try:
+            with getMetrics().timer('DynamoDBUpdate'):
+                callWithRetry(self.dynamodb.update_item,
+                    TableName=self.table_name,
+                    Key=self.key(jobId),
+                    ExpressionAttributeNames=attributeNames,
+                    UpdateExpression=updateExpression.strip(),
+                    **updateArgs
+                )
+        except Exception as e:
+            if errorCode(e) != 'ConditionalCheckFailedException':
+                raise
+            logger.info("Job record %s already lists its text files", jobId)
+            getMetrics().add('JobRecordsRepeated')
+            self.update(jobId, values, remove)
+            return False
+        return True
+
+    #Function to queue a whole record to replace any record of the job
+    def put(self, jobId, item):
+        item = dict(item)
+        item.update(self.key(jobId))
+        with self.lock:
+            self.requests[jobId] = {'PutRequest': {'Item': item}}
+
+    #Function to queue the deletion of a job record
+    def delete(self, jobId):
+        with self.lock:
+            self.requests[jobId] = {'DeleteRequest': {'Key': self.key(jobId)}}
+
+    def __len__(self):
+        return len(self.requests)
+
+    #Function to write the queued puts and deletions, returning the JobIds of those that could not be written
+    def flush(self):
+        with self.lock:
+            requests, self.requests = self.requests, OrderedDict()
+        if len(requests) == 0:
+            return []
+        metrics = getMetrics()
+        jobIds = list(requests.keys())
+        failed = []
+        with metrics.timer('DynamoDBBatch'):
+            for i in range(0, len(jobIds), self.maxBatchWrite):
+                batch = jobIds[i:i+self.maxBatchWrite]
+                try:
+                    responses, unprocessed = batchWithRetry(self.dynamodb.batch_write_item,
+                        {self.table_name: [requests[jobId] for jobId in batch]}, 'UnprocessedItems')
+                except Exception as e:
+                    logger.error("Writing %d job records failed: %s", len(batch), e)
+                    failed.extend(batch)
+                    continue
+                for request in unprocessed.get(self.table_name, []):
+                    key = request['PutRequest']['Item'] if 'PutRequest' in request else request['DeleteRequest']['Key']
+                    failed.append(key['JobId']['S'])
+        for jobId in failed:
+            logger.error("Job record %s was not written", jobId)
+        metrics.add('JobRecordsWritten', len(requests) - len(failed))
+        if len(failed) > 0:
+            metrics.add('JobRecordsFailed', len(failed))
+        return failed
+
+#Function to record the outcome of a job in its record: the output written for it or, without text, its status alone.
+#A page layout output is recorded by its manifest, which lists the page objects, as the key of every page of a
+#long document would not fit the 400 KB item size limit. Returns False when a redelivered notification found
+#the text files already recorded.
+def completeJob(jobState, jobId, textractStatus, textractTimestamp, bucket, num_pages, num_lines, writer, text_files, manifest_file,
+                outputs=()):
+    values = {
+        'JobStatus': {'S': textractStatus},
+        'JobCompleteTimeStamp': {'N': str(textractTimestamp)}
+    }
+    if len(text_files) > 0:
+        values.update({
+            'ManifestFile': {'S': manifest_file},
+            'OutputBucket': {'S': bucket},
+            'NumLines': {'N': str(num_lines)},
+            'NumPages': {'N': str(num_pages)}
+        })
+        if writer is not None and writer.index_file is not None:
+            values['IndexFile'] = {'S': writer.index_file}
+        #Only totals are recorded, the objects themselves are listed by the manifest, as a record of every
+        #object of a long document would not fit the 400 KB item size limit
+        values['OutputCount'] = {'N': str(len(outputs))}
+        values['OutputBytes'] = {'N': str(sum(output['Size'] or 0 for output in outputs))}
+        if writer is not None and writer.layout == 'pages':
+            text_files = [manifest_file]
+    return jobState.update(jobId, values, remove=('Checkpoint',), text_files=text_files)